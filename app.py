@@ -3,9 +3,29 @@ import requests
 import base64
 import urllib.parse
 import os, json, copy, re
+import gzip
+import functools
+import math
+import heapq
+import itertools
 import threading
 import time
+import uuid
+import random
+import hashlib
+import sys
+import io
+import tempfile
+import cProfile
+import pstats
+import tracemalloc
+import queue
+from array import array
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
+from types import SimpleNamespace
 from flask import Flask, render_template_string, request, Response
 from flask_socketio import SocketIO, emit
 import openai
@@ -19,12 +39,35 @@ os.makedirs(SAVE_PATH, exist_ok=True)
 DATA_FILE = os.path.join(SAVE_PATH, "save_data.json")
 ADULT_KEY = os.getenv('ADULT_KEY')
 
+save_lock = threading.Lock()
+
+# 마지막으로 디스크에 쓴 (state 버전, client_map) — 같으면 다시 안 씀
+last_saved_key = None
+
 def save_data():
+    global last_saved_key
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            state_to_save = copy.deepcopy(state)
-            state_to_save["client_map"] = client_map
-            json.dump(state_to_save, f, ensure_ascii=False, indent=2)
+        # writer가 만든 스냅샷은 읽기 전용이라 복사 없이 바로 직렬화
+        version, snap = session_writer.current
+        cmap = dict(client_map)
+        key = (version, tuple(sorted(cmap.items())))
+        with save_lock:
+            if key == last_saved_key:
+                dirty_stats["saves_skipped"] += 1
+                return
+            with span("save_data"):
+                t0 = time.perf_counter()
+                state_to_save = dict(snap)
+                state_to_save["client_map"] = cmap
+                tmp = DATA_FILE + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(state_to_save, f, ensure_ascii=False, indent=2, default=json_default)
+                    size = f.tell()
+                os.replace(tmp, DATA_FILE)
+                last_saved_key = key
+                dirty_stats["saves"] += 1
+                SAVE_SECONDS.observe(time.perf_counter() - t0)
+                SAVE_BYTES.observe(size)
     except: pass
 
 def load_data():
@@ -42,21 +85,214 @@ def load_data():
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', '1234') # 기본비번 1234
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '120'))  # 초 (SDK 기본은 10분이라 막히면 너무 오래 기다림)
 
 
-gemini_model = None
 client = None
 
 try:
     if OPENAI_API_KEY:
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        client = openai.OpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT)
     
     if GEMINI_API_KEY:
         genai.configure(api_key=GEMINI_API_KEY)
-        gemini_model = genai.GenerativeModel('gemini-3-pro-preview')
 except Exception as e:
     print(f"❌ 설정 오류: {e}")
 
+# =========================
+# Fake LLM (키 없이 오프라인 테스트/부하 측정용. OpenAI chat / Gemini 인터페이스를 흉내냄)
+# =========================
+FAKE_LLM = os.getenv("FAKE_LLM", "").lower() in ("1", "true", "yes")  # 켜면 모든 모델 호출이 가짜로 감
+FAKE_MODELS = ("fake-openai", "fake-gemini")                          # ai_model로 고르면 이 모델만 가짜
+SHOW_FAKE_MODELS = FAKE_LLM or os.getenv("SHOW_FAKE_MODELS", "").lower() in ("1", "true", "yes")  # 관리자 엔진 목록에 가짜 모델도 보임
+FAKE_LLM_TTFT = float(os.getenv("FAKE_LLM_TTFT", "0.5"))              # 첫 토큰까지 초
+FAKE_LLM_TPS = float(os.getenv("FAKE_LLM_TPS", "80"))                 # 초당 토큰
+FAKE_LLM_TOKENS = int(os.getenv("FAKE_LLM_TOKENS", "600"))            # 응답 길이 (max_tokens가 더 작으면 그쪽)
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_REFUSAL_RATE = float(os.getenv("FAKE_LLM_REFUSAL_RATE", "0"))
+FAKE_LLM_SEED = os.getenv("FAKE_LLM_SEED", "0")
+FAKE_STREAM_CHUNK = 4  # 스트리밍 조각 하나에 든 토큰 수
+FAKE_REFUSAL_TEXT = "죄송하지만 이 요청에는 응답할 수 없습니다."
+FAKE_WORDS = (
+    "숨결이", "떨리는", "눈동자가", "천천히", "차가운", "손끝에", "머문다", "먼지가", "빛 속에서", "흩어지고",
+    "그는", "그녀는", "잠시", "말없이", "시선을", "피했다", "낮은", "목소리로", "심장이", "조용히",
+    "뜨거운", "공기가", "어깨를", "스치고", "창밖으로", "바람이", "분다", "입술이", "달싹인다", "망설임이",
+)
+
+fake_fault_rng = random.Random(FAKE_LLM_SEED)  # 오류/거절 주입 (돌릴 때마다 같은 순서)
+fake_fault_lock = threading.Lock()
+
+class FakeLLMError(Exception):
+    pass
+
+def is_fake_model(model):
+    return FAKE_LLM or model in FAKE_MODELS
+
+def fake_plan(model, prompt_text, max_tokens, json_mode=False):
+    """(응답 토큰 목록, 입력 토큰 수, "ok" | "error" | "refusal"). 응답은 모델+프롬프트로 정해짐"""
+    with fake_fault_lock: roll = fake_fault_rng.random()
+    outcome = "error" if roll < FAKE_LLM_ERROR_RATE else ("refusal" if roll < FAKE_LLM_ERROR_RATE + FAKE_LLM_REFUSAL_RATE else "ok")
+    rng = random.Random(hashlib.sha256(f"{FAKE_LLM_SEED}|{model}|{prompt_text}".encode("utf-8")).hexdigest())
+    if outcome == "refusal":
+        tokens = [FAKE_REFUSAL_TEXT]
+    elif json_mode:
+        tokens = [json.dumps({k: "#%06x" % rng.randrange(0x1000000) for k in ("bg", "panel", "accent")})]
+    else:
+        n = min(FAKE_LLM_TOKENS, max_tokens or FAKE_LLM_TOKENS)
+        tokens = [rng.choice(FAKE_WORDS) + ("." if rng.random() < 0.12 else "") + " " for _ in range(n)]
+    return tokens, max(1, len(prompt_text) // 2), outcome
+
+def fake_stream(tokens):
+    """TTFT만큼 기다린 뒤 초당 FAKE_LLM_TPS 토큰 속도로 조각을 내보냄"""
+    time.sleep(FAKE_LLM_TTFT)
+    for i in range(0, len(tokens), FAKE_STREAM_CHUNK):
+        piece = tokens[i:i + FAKE_STREAM_CHUNK]
+        if i and FAKE_LLM_TPS > 0: time.sleep(len(piece) / FAKE_LLM_TPS)
+        yield "".join(piece)
+
+def fake_fail():
+    time.sleep(FAKE_LLM_TTFT)
+    raise FakeLLMError("fake provider: injected upstream error")
+
+class FakeChatCompletions:
+    """client.chat.completions.create(...) 흉내 (stream=True면 chunk 이터레이터)"""
+    def create(self, model, messages, stream=False, max_tokens=None, max_completion_tokens=None, response_format=None, stream_options=None, **_):
+        prompt_text = "\n".join(str(m.get("content", "")) for m in messages)
+        json_mode = (response_format or {}).get("type") == "json_object"
+        tokens, prompt_tokens, outcome = fake_plan(model, prompt_text, max_completion_tokens or max_tokens, json_mode)
+        if outcome == "error": fake_fail()
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(tokens), total_tokens=prompt_tokens + len(tokens),
+                                prompt_tokens_details=SimpleNamespace(cached_tokens=0))
+        if stream:
+            return self._chunks(model, tokens, usage, (stream_options or {}).get("include_usage"))
+        text = "".join(fake_stream(tokens))
+        message = SimpleNamespace(role="assistant", content=text, refusal=text if outcome == "refusal" else None)
+        return SimpleNamespace(model=model, choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")], usage=usage)
+
+    def _chunks(self, model, tokens, usage, include_usage):
+        for piece in fake_stream(tokens):
+            yield SimpleNamespace(model=model, choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=piece), finish_reason=None)], usage=None)
+        yield SimpleNamespace(model=model, choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=None), finish_reason="stop")], usage=None)
+        if include_usage: yield SimpleNamespace(model=model, choices=[], usage=usage)
+
+class FakeGeminiResponse:
+    """generate_content() 결과 흉내. 차단(거절)이면 진짜처럼 .text에서 ValueError"""
+    def __init__(self, pieces, prompt_tokens, completion_tokens, blocked=False):
+        self._pieces, self._parts, self._blocked = pieces, [], blocked
+        self._completion_tokens = completion_tokens
+        self.prompt_feedback = SimpleNamespace(block_reason="SAFETY" if blocked else None)
+        self.usage_metadata = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=0, cached_content_token_count=0)
+
+    def __iter__(self):
+        for piece in self._pieces:
+            self._parts.append(piece)
+            yield SimpleNamespace(text=piece)
+        self._pieces = iter(())
+        self.usage_metadata.candidates_token_count = self._completion_tokens  # 진짜처럼 다 받은 뒤에 채워짐
+
+    def resolve(self):
+        for _ in self: pass
+        return self
+
+    @property
+    def text(self):
+        self.resolve()
+        if self._blocked: raise ValueError("The response was blocked (fake provider refusal).")
+        return "".join(self._parts)
+
+class FakeGeminiModel:
+    def __init__(self, model):
+        self.model_name = model
+
+    def generate_content(self, prompt, stream=False, generation_config=None, safety_settings=None, **_):
+        prompt_text = prompt if isinstance(prompt, str) else "\n".join(map(str, prompt))
+        cfg = generation_config or {}
+        tokens, prompt_tokens, outcome = fake_plan(self.model_name, prompt_text, cfg.get("max_output_tokens"),
+                                                   cfg.get("response_mime_type") == "application/json")
+        if outcome == "error": fake_fail()
+        blocked = outcome == "refusal"
+        res = FakeGeminiResponse(fake_stream([] if blocked else tokens), prompt_tokens, 0 if blocked else len(tokens), blocked)
+        return res if stream else res.resolve()
+
+fake_client = SimpleNamespace(chat=SimpleNamespace(completions=FakeChatCompletions()))
+
+if FAKE_LLM: print("🧪 FAKE_LLM 켜짐: 모든 모델 호출이 가짜 응답으로 갑니다")
+
+# =========================
+# OpenAI-compatible providers (llama.cpp / vLLM 같은 로컬 서버를 모델로 붙임. PROVIDERS_FILE에 적음)
+# =========================
+# {
+#   "local": {
+#     "base_url": "http://127.0.0.1:8080/v1", "api_key_env": "LOCAL_LLM_KEY",
+#     "timeout": 30, "max_concurrency": 2, "queue_timeout": 5,
+#     "models": {"local-small": {"model": "qwen2.5-7b-instruct", "tier": "local", "tasks": ["summary", "theme"], "price": [0, 0, 0]}}
+#   }
+# }
+# models의 키가 라우터/ai_model에 쓰는 이름, "model"이 서버에 보내는 이름.
+# tier는 MODEL_TIERS 등급 (새 등급이면 그 등급끼리만 서로 대신함), tasks에 적은 작업은 이 등급을 먼저 시도.
+PROVIDERS_FILE = os.getenv("PROVIDERS_FILE", os.path.join(SAVE_PATH, "providers.json"))
+
+class ProviderClient:
+    """base_url 서버용 openai 클라이언트. 라우터 모델 이름을 서버 모델 이름으로 바꾸고, 동시 호출을 max_concurrency개로 제한"""
+    def __init__(self, name, cfg):
+        self.name = name
+        self.api = openai.OpenAI(base_url=cfg["base_url"], api_key=cfg.get("api_key") or os.getenv(cfg.get("api_key_env", ""), "") or "none",
+                                 timeout=float(cfg.get("timeout", 60)), max_retries=int(cfg.get("max_retries", 0)))
+        self.max_concurrency = int(cfg.get("max_concurrency", 0))
+        self.slots = threading.BoundedSemaphore(self.max_concurrency) if self.max_concurrency > 0 else None
+        self.queue_timeout = float(cfg.get("queue_timeout", 10))
+        self.chat = SimpleNamespace(completions=self)  # client.chat.completions.create(...) 그대로 쓰게
+
+    def create(self, model, **kwargs):
+        upstream = provider_models[model]["model"]
+        if self.slots is None: return self.api.chat.completions.create(model=upstream, **kwargs)
+        t0 = time.perf_counter()
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            raise RuntimeError(f"{self.name}: 동시 호출 {self.max_concurrency}개가 {self.queue_timeout:g}초 동안 안 비었음")
+        LLM_QUEUE_SECONDS.observe(time.perf_counter() - t0, provider=self.name)
+        try:
+            res = self.api.chat.completions.create(model=upstream, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        if kwargs.get("stream"): return self._release_after(res)
+        self.slots.release()
+        return res
+
+    def _release_after(self, chunks):
+        # 스트리밍은 다 받을 때까지 자리를 잡고 있음
+        try: yield from chunks
+        finally: self.slots.release()
+
+def load_providers():
+    """PROVIDERS_FILE을 읽어 {공급자: ProviderClient}, {라우터 모델 이름: 설정(+provider)}"""
+    try:
+        with open(PROVIDERS_FILE, "r", encoding="utf-8") as f:
+            conf = json.load(f)
+    except FileNotFoundError:
+        return {}, {}
+    except Exception as e:
+        print(f"⚠️ 공급자 설정 읽기 실패: {e}")
+        return {}, {}
+    clients, models = {}, {}
+    for name, cfg in conf.items():
+        try:
+            clients[name] = ProviderClient(name, cfg)
+        except Exception as e:
+            print(f"❌ 공급자 {name} 설정 오류: {e}")
+            continue
+        for alias, m in cfg.get("models", {}).items():
+            models[alias] = dict(m, provider=name, model=m.get("model", alias))
+        print(f"🔌 공급자 {name}: {cfg['base_url']} (모델 {', '.join(cfg.get('models', {})) or '-'})")
+    return clients, models
+
+provider_clients, provider_models = load_providers()
+
+def openai_client(model):
+    if is_fake_model(model): return fake_client
+    if model in provider_models: return provider_clients[provider_models[model]["provider"]]
+    return client
+
 # =========================
 # App
 # =========================
@@ -64,6 +300,579 @@ app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 socketio = SocketIO(app, cors_allowed_origins="*")
 
+# =========================
+# Metrics (/metrics에서 Prometheus 텍스트 형식으로 내보냄, 외부 라이브러리 없음)
+# =========================
+METRICS_ACTIVE_WINDOW = 300.0  # 이 시간 안에 누가 긁어갔을 때만 비싼 측정(페이로드 크기 등)을 함
+
+metrics_registry = []
+metrics_last_scrape = 0.0
+
+def metrics_active():
+    return time.time() - metrics_last_scrape < METRICS_ACTIVE_WINDOW
+
+def _label_value(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_str(names, values):
+    if not names: return ""
+    return "{" + ",".join(f'{n}="{_label_value(v)}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, n=1, **labels):
+        key = tuple(labels.get(l, "") for l in self.labels)
+        with self.lock: self.values[key] = self.values.get(key, 0) + n
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock: items = sorted(self.values.items())
+        if not items and not self.labels: items = [((), 0)]
+        out += [f"{self.name}{_label_str(self.labels, k)} {v}" for k, v in items]
+        return out
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # 라벨 -> [버킷별 개수..., 합계, 개수]
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(l, "") for l in self.labels)
+        with self.lock:
+            s = self.series.get(key)
+            if s is None: s = self.series[key] = [0] * (len(self.buckets) + 2)
+            for i, b in enumerate(self.buckets):
+                if value <= b: s[i] += 1; break
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock: items = sorted((k, list(v)) for k, v in self.series.items())
+        for key, s in items:
+            acc = 0
+            for i, b in enumerate(self.buckets):
+                acc += s[i]
+                out.append(f"{self.name}_bucket{_label_str(self.labels + ('le',), key + (repr(float(b)),))} {acc}")
+            out.append(f"{self.name}_bucket{_label_str(self.labels + ('le',), key + ('+Inf',))} {s[-1]}")
+            out.append(f"{self.name}_sum{_label_str(self.labels, key)} {s[-2]}")
+            out.append(f"{self.name}_count{_label_str(self.labels, key)} {s[-1]}")
+        return out
+
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+BYTE_BUCKETS = (1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7)
+
+ROUND_SECONDS = Histogram("dream_round_latency_seconds", "Last player input to round commit", LATENCY_BUCKETS)
+LLM_TTFT_SECONDS = Histogram("dream_llm_ttft_seconds", "Time to first streamed token per model (streaming calls only)", LATENCY_BUCKETS, ("model", "task"))
+LLM_SECONDS = Histogram("dream_llm_duration_seconds", "Total LLM call time per model", LATENCY_BUCKETS, ("model", "task"))
+LLM_ERRORS = Counter("dream_llm_errors_total", "Failed LLM calls", ("model", "task"))
+LLM_QUEUE_SECONDS = Histogram("dream_llm_queue_wait_seconds", "Wait for a free concurrency slot on a configured provider", FAST_BUCKETS, ("provider",))
+LLM_RETRIES = Counter("dream_llm_retries_total", "Calls retried on another model", ("task",))
+GENERATION_ERRORS = Counter("dream_generation_errors_total", "Rounds where every model failed")
+LLM_TOKENS = Counter("dream_llm_tokens_total", "Tokens used per model (kind: prompt, completion, cached)", ("model", "kind"))
+LLM_COST = Counter("dream_llm_cost_usd_total", "Estimated spend per model from the price table", ("model",))
+LORE_ACTIVATIONS = Counter("dream_lore_activations_total", "Lorebook entries injected into prompts")
+SAVE_SECONDS = Histogram("dream_save_duration_seconds", "save_data duration", FAST_BUCKETS)
+SAVE_BYTES = Histogram("dream_save_bytes", "save_data file size", BYTE_BUCKETS)
+FANOUT_SECONDS = Histogram("dream_broadcast_fanout_seconds", "emit_state_to_players fan-out time", FAST_BUCKETS)
+PAYLOAD_BYTES = Histogram("dream_broadcast_payload_bytes", "initial_state payload size (measured only while /metrics is being scraped)", BYTE_BUCKETS)
+
+def render_metrics():
+    lines = []
+    for m in metrics_registry: lines += m.render()
+    # 이미 세고 있던 값들은 그대로 노출
+    for k, v in dirty_stats.items():
+        lines += [f"# TYPE dream_state_{k}_total counter", f"dream_state_{k}_total {v}"]
+    lines += ["# TYPE dream_connected_sockets gauge", f"dream_connected_sockets {len(outbound_queues)}"]
+    # 부하 테스트(tools/loadtest.py)가 서버 CPU/메모리를 여기서 읽음
+    lines += ["# TYPE process_cpu_seconds_total counter", f"process_cpu_seconds_total {time.process_time():.3f}"]
+    rss = process_rss_bytes()
+    if rss: lines += ["# TYPE process_resident_memory_bytes gauge", f"process_resident_memory_bytes {rss}"]
+    return "\n".join(lines) + "\n"
+
+def process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:  # 리눅스만
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return None
+
+# =========================
+# Tracing (라운드/핸들러 단계별 소요 시간. 샘플링된 것만 기록)
+# =========================
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))        # 소켓 핸들러
+TRACE_ROUND_SAMPLE_RATE = float(os.getenv("TRACE_ROUND_SAMPLE_RATE", "1.0"))  # 라운드 생성 (원래 몇 초씩 걸려서 기록 비용은 무시할 만함)
+TRACE_RING_SIZE = 200
+TRACE_FILE = os.getenv("TRACE_FILE")  # 지정하면 끝난 트레이스를 JSONL로 이어 씀
+
+trace_local = threading.local()
+trace_ring = deque(maxlen=TRACE_RING_SIZE)
+trace_file_lock = threading.Lock()
+
+def _open_span(tr, name, attrs):
+    rec = {"id": len(tr["spans"]), "parent": tr["_stack"][-1] if tr["_stack"] else None, "name": name,
+           "start_ms": round((time.perf_counter() - tr["_t0"]) * 1000, 2), "_t0": time.perf_counter()}
+    if attrs: rec["attrs"] = attrs
+    tr["spans"].append(rec)
+    tr["_stack"].append(rec["id"])
+    return rec
+
+def _close_span(tr, rec):
+    rec["dur_ms"] = round((time.perf_counter() - rec.pop("_t0")) * 1000, 2)
+    if tr["_stack"] and tr["_stack"][-1] == rec["id"]: tr["_stack"].pop()
+
+@contextmanager
+def span(name, **attrs):
+    """진행 중인 트레이스가 있을 때만 구간 기록 (없으면 아무것도 안 함)"""
+    tr = getattr(trace_local, "trace", None)
+    if tr is None:
+        yield None
+        return
+    rec = _open_span(tr, name, attrs)
+    try:
+        yield rec
+    except Exception as e:
+        rec["error"] = str(e)[:200]
+        raise
+    finally:
+        _close_span(tr, rec)
+
+def trace_phase(name, **attrs):
+    """순서대로 이어지는 단계용: 열려 있던 단계를 닫고 새 단계를 엶 (name=None이면 닫기만)"""
+    tr = getattr(trace_local, "trace", None)
+    if tr is None: return
+    prev = tr.get("_phase")
+    if prev is not None: _close_span(tr, prev)
+    tr["_phase"] = _open_span(tr, name, attrs) if name else None
+
+@contextmanager
+def trace(name, round_id=None, sample_rate=None):
+    """트레이스 시작. 이미 트레이스 안이면 그 안의 구간이 됨. 샘플링에서 빠지면 아무것도 기록 안 함"""
+    outer = getattr(trace_local, "trace", None)
+    if outer is not None:
+        saved_phase = outer.get("_phase")
+        outer["_phase"] = None
+        with span(name, round_id=round_id) as rec:
+            try:
+                yield rec
+            finally:
+                trace_phase(None)
+                outer["_phase"] = saved_phase
+        return
+    if random.random() >= (TRACE_SAMPLE_RATE if sample_rate is None else sample_rate):
+        yield None
+        return
+    tr = {"trace_id": uuid.uuid4().hex[:12], "name": name, "round_id": round_id,
+          "ts": datetime.now().strftime("%H:%M:%S"), "spans": [], "_stack": [], "_t0": time.perf_counter(), "_phase": None}
+    trace_local.trace = tr
+    try:
+        yield tr
+    except Exception as e:
+        tr["error"] = str(e)[:200]
+        raise
+    finally:
+        trace_phase(None)
+        trace_local.trace = None
+        finish_trace(tr)
+
+def set_trace_round(rid):
+    tr = getattr(trace_local, "trace", None)
+    if tr is not None and tr.get("round_id") is None: tr["round_id"] = rid
+
+def finish_trace(tr):
+    tr["dur_ms"] = round((time.perf_counter() - tr.pop("_t0")) * 1000, 2)
+    for k in ("_stack", "_phase"): tr.pop(k, None)
+    trace_ring.appendleft(tr)
+    if TRACE_FILE:
+        try:
+            with trace_file_lock, open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(tr, ensure_ascii=False) + "\n")
+        except Exception as e:
+            print(f"⚠️ 트레이스 기록 실패: {e}")
+
+def traced(event):
+    """소켓 핸들러를 트레이스로 감쌈 (@socketio.on 바로 아래에). 프로파일 수집 중이면 같이 프로파일"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if session_recorder is not None: record_inbound(event, args[0] if args else None)
+            with trace("socket:" + event, round_id=current_snapshot().get("round_id")):
+                return run_profiled(fn, *args, **kwargs)
+        return wrapper
+    return deco
+
+# =========================
+# Profiling (운영 중인 서버에서 관리자가 켜고 끄는 프로파일러)
+# =========================
+# cprofile: 소켓 핸들러/라운드 생성 호출마다 cProfile을 걸어 합침 (그 스레드에서 돈 코드만 잡힘)
+#           3.12부터는 cProfile이 프로세스에 하나만 켜질 수 있어서 한 번에 한 호출만 잡고, 겹친 호출은 그냥 실행 (skipped)
+# sample: 모든 스레드의 스택을 주기적으로 떠서 collapsed stack으로 (flamegraph.pl / speedscope용)
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 300
+PROFILE_MAX_ROUNDS = 50
+PROFILE_STACK_DEPTH = 64
+TRACEMALLOC_FRAMES = 25
+
+profile_lock = threading.Lock()
+cprofile_run_lock = threading.Lock()  # 지금 cProfile로 잡고 있는 호출 (하나만)
+profile_capture = None   # 진행 중인 수집
+profile_result = None    # 마지막으로 끝난 수집
+profile_local = threading.local()
+memory_baseline = None   # tracemalloc 기준 스냅샷
+
+def start_profile(mode, seconds=None, rounds=None):
+    """다음 N초 또는 N라운드 동안 수집 시작. 이미 수집 중이면 에러 문자열 반환"""
+    global profile_capture
+    if mode not in ("cprofile", "sample"): return "mode는 cprofile 또는 sample"
+    if not seconds and not rounds: seconds = 30
+    seconds = min(float(seconds), PROFILE_MAX_SECONDS) if seconds else PROFILE_MAX_SECONDS
+    rounds = min(int(rounds), PROFILE_MAX_ROUNDS) if rounds else None
+    with profile_lock:
+        if profile_capture is not None: return "이미 수집 중"
+        profile_capture = {"mode": mode, "started": time.time(), "until": time.time() + seconds, "rounds_left": rounds,
+                           "rounds": 0, "calls": 0, "skipped": 0, "samples": 0, "stats": None, "stacks": {}}
+    socketio.start_background_task(profile_worker, profile_capture)
+    print(f"🔬 프로파일 시작 ({mode}, {seconds:g}초" + (f" / {rounds}라운드" if rounds else "") + ")")
+    return None
+
+def finish_profile(cap):
+    global profile_capture, profile_result
+    with profile_lock:
+        if profile_capture is not cap: return
+        profile_capture = None
+        cap["finished"] = time.time()
+        profile_result = cap
+    print(f"🔬 프로파일 끝 ({cap['mode']}, 라운드 {cap['rounds']}, 샘플 {cap['samples']}, 호출 {cap['calls']}, 겹쳐서 건너뜀 {cap['skipped']})")
+
+def profile_worker(cap):
+    me = threading.get_ident()
+    while profile_capture is cap and time.time() < cap["until"]:
+        if cap["mode"] == "sample": take_stack_sample(cap, me)
+        socketio.sleep(PROFILE_SAMPLE_INTERVAL if cap["mode"] == "sample" else 0.2)
+    finish_profile(cap)
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def take_stack_sample(cap, skip_ident):
+    names = {t.ident: t.name for t in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+        if ident == skip_ident: continue
+        stack = []
+        while frame is not None and len(stack) < PROFILE_STACK_DEPTH:
+            stack.append(_frame_label(frame.f_code))
+            frame = frame.f_back
+        stack.append(names.get(ident, f"thread-{ident}"))
+        key = ";".join(reversed(stack))
+        with profile_lock:
+            cap["stacks"][key] = cap["stacks"].get(key, 0) + 1
+    with profile_lock: cap["samples"] += 1
+
+def run_profiled(fn, *args, **kwargs):
+    """cprofile 수집 중이면 fn 호출 하나를 프로파일해서 합침 (안쪽 호출은 바깥 것에 포함되므로 그냥 실행)"""
+    cap = profile_capture
+    if cap is None or cap["mode"] != "cprofile" or getattr(profile_local, "active", False):
+        return fn(*args, **kwargs)
+    if not cprofile_run_lock.acquire(blocking=False):
+        with profile_lock: cap["skipped"] += 1
+        return fn(*args, **kwargs)
+    prof = cProfile.Profile()
+    try:
+        try:
+            prof.enable()
+        except ValueError:  # 디버거 등 다른 프로파일러가 켜져 있음
+            prof = None
+            with profile_lock: cap["skipped"] += 1
+            return fn(*args, **kwargs)
+        profile_local.active = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            prof.disable()
+            profile_local.active = False
+    finally:
+        cprofile_run_lock.release()
+        if prof is not None:
+            stats = pstats.Stats(prof)
+            with profile_lock:
+                if cap["stats"] is None: cap["stats"] = stats
+                else: cap["stats"].add(stats)
+                cap["calls"] += 1
+
+def profile_round_done():
+    cap = profile_capture
+    if cap is None: return
+    with profile_lock:
+        cap["rounds"] += 1
+        done = cap["rounds_left"] is not None and cap["rounds"] >= cap["rounds_left"]
+    if done: finish_profile(cap)
+
+def profile_status():
+    def info(cap):
+        if cap is None: return None
+        return {"mode": cap["mode"], "started": cap["started"], "finished": cap.get("finished"),
+                "remaining_s": max(0, round(cap["until"] - time.time(), 1)) if not cap.get("finished") else 0,
+                "rounds": cap["rounds"], "rounds_target": cap["rounds_left"], "samples": cap["samples"], "calls": cap["calls"], "skipped": cap["skipped"]}
+    return {"running": info(profile_capture), "last": info(profile_result), "tracemalloc": tracemalloc.is_tracing()}
+
+def profile_output(fmt):
+    """마지막 결과를 (bytes, 파일 확장자)로. 없거나 형식이 안 맞으면 (None, 이유)"""
+    cap = profile_result
+    if cap is None: return None, "끝난 프로파일 없음"
+    if fmt == "collapsed":
+        if cap["mode"] != "sample": return None, "collapsed는 sample 모드에서만"
+        lines = [f"{k} {v}" for k, v in sorted(cap["stacks"].items(), key=lambda kv: -kv[1])]
+        return ("\n".join(lines) + "\n").encode("utf-8"), "collapsed.txt"
+    if cap["mode"] != "cprofile" or cap["stats"] is None: return None, "pstats/txt는 cprofile 모드에서만 (호출이 하나도 없었을 수도 있음)"
+    if fmt == "pstats":
+        with tempfile.NamedTemporaryFile(suffix=".pstats", delete=False) as f: path = f.name
+        try:
+            cap["stats"].dump_stats(path)
+            with open(path, "rb") as f: return f.read(), "pstats"
+        finally:
+            os.remove(path)
+    buf = io.StringIO()
+    with profile_lock:
+        stats = cap["stats"]
+        stats.stream = buf
+        stats.sort_stats("cumulative").print_stats(60)
+    return buf.getvalue().encode("utf-8"), "txt"
+
+def memory_start():
+    global memory_baseline
+    if not tracemalloc.is_tracing(): tracemalloc.start(TRACEMALLOC_FRAMES)
+    memory_baseline = tracemalloc.take_snapshot()
+
+def memory_diff(top=30, group="lineno"):
+    """기준 스냅샷 이후 늘어난 메모리 상위 N개 (텍스트)"""
+    if memory_baseline is None or not tracemalloc.is_tracing(): return None
+    snap = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    stats = snap.compare_to(memory_baseline, "traceback" if group == "traceback" else "lineno")
+    current, peak = tracemalloc.get_traced_memory()
+    out = [f"traced now {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB", ""]
+    for st in stats[:top]:
+        out.append(f"{st.size_diff / 1024:+.1f} KiB ({st.count_diff:+d} blocks)  total {st.size / 1024:.1f} KiB")
+        frames = st.traceback.format()
+        out.extend("    " + line for line in (frames if group == "traceback" else frames[:1]))
+    return "\n".join(out) + "\n"
+
+def memory_stop():
+    global memory_baseline
+    memory_baseline = None
+    if tracemalloc.is_tracing(): tracemalloc.stop()
+
+# =========================
+# Session record & replay (들어온 소켓 이벤트 + 모델 응답을 JSONL로 남기고, tools/replay.py로 새 서버에 다시 틀기)
+# =========================
+RECORD_DIR = os.path.join(SAVE_PATH, "recordings")
+REDACT_FIELDS = ("password", "auth_key")  # 비밀번호류는 항상 지움 (재생 쪽이 자기 비밀번호로 채움)
+REDACTED = "<redacted>"
+REPLAY_FILE = os.getenv("REPLAY_FILE")                           # 지정하면 모델을 안 부르고 녹화된 응답을 순서대로 돌려줌
+REPLAY_LLM_SPEED = float(os.getenv("REPLAY_LLM_SPEED", "1.0"))   # 녹화된 지연에 곱함 (0이면 바로)
+
+record_lock = threading.Lock()
+session_recorder = None  # {"file", "path", "started", "redact_bios", "sids", "events"}
+replay_llm = None        # task -> deque[녹화된 응답]
+
+def redact_event(data, redact_bios):
+    if not isinstance(data, dict): return data
+    out = {k: (REDACTED if k in REDACT_FIELDS and v else v) for k, v in data.items()}
+    if redact_bios:
+        for k in ("bio", "canon"):
+            if out.get(k): out[k] = REDACTED
+    return out
+
+def write_record(entry):
+    rec = session_recorder
+    if rec is None: return
+    entry["t"] = round(time.time() - rec["started"], 3)
+    line = json.dumps(entry, ensure_ascii=False, default=json_default)
+    with record_lock:
+        if session_recorder is not rec: return
+        rec["file"].write(line + "\n")
+        rec["events"] += 1
+
+def record_alias(sid):
+    """소켓 id 대신 c1, c2... (재생할 때 클라이언트 하나씩 대응)"""
+    rec = session_recorder
+    with record_lock:
+        return rec["sids"].setdefault(sid, f"c{len(rec['sids']) + 1}")
+
+def record_inbound(event, data):
+    rec = session_recorder
+    if rec is None: return
+    try:
+        write_record({"kind": "event", "client": record_alias(request.sid), "event": event, "data": redact_event(data, rec["redact_bios"])})
+    except Exception as e:
+        print(f"⚠️ 녹화 실패: {e}")
+
+def record_disconnect(sid):
+    rec = session_recorder
+    if rec is None or sid not in rec["sids"]: return
+    write_record({"kind": "disconnect", "client": rec["sids"][sid]})
+
+def record_llm(task, model, result=None, latency=0.0, usage=None, error=None):
+    if session_recorder is None: return
+    entry = {"kind": "llm", "task": task, "model": model, "latency": round(latency, 3)}
+    if error is not None: entry["error"] = str(error)[:300]
+    else: entry.update(result=result, usage=usage)
+    write_record(entry)
+
+def start_recording(redact_bios=False):
+    """녹화 시작. 첫 줄은 지금 state (재생 서버가 이걸로 시작)"""
+    global session_recorder
+    os.makedirs(RECORD_DIR, exist_ok=True)
+    path = os.path.join(RECORD_DIR, f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+    snap = dict(current_snapshot())
+    snap["client_map"] = dict(client_map)
+    snap.pop("admin_password", None)
+    if redact_bios: snap["profiles"] = {u: dict(p, bio=REDACTED, canon=REDACTED) for u, p in snap["profiles"].items()}
+    header = {"kind": "header", "version": 1, "started": datetime.now().isoformat(timespec="seconds"), "redact_bios": redact_bios, "snapshot": snap}
+    with record_lock:
+        if session_recorder is not None: return None
+        f = open(path, "w", encoding="utf-8")
+        f.write(json.dumps(header, ensure_ascii=False, default=json_default) + "\n")
+        session_recorder = {"file": f, "path": path, "started": time.time(), "redact_bios": redact_bios, "sids": {}, "events": 0}
+    print(f"⏺️ 세션 녹화 시작: {path}")
+    return path
+
+def stop_recording():
+    global session_recorder
+    with record_lock:
+        rec, session_recorder = session_recorder, None
+    if rec is None: return None
+    rec["file"].close()
+    print(f"⏹️ 세션 녹화 끝: {rec['path']} (이벤트 {rec['events']}개)")
+    return rec["path"]
+
+def recording_status():
+    rec = session_recorder
+    last = sorted(os.listdir(RECORD_DIR))[-5:] if os.path.isdir(RECORD_DIR) else []
+    return {"recording": rec is not None, "path": rec and os.path.basename(rec["path"]), "events": rec and rec["events"],
+            "clients": rec and len(rec["sids"]), "files": last}
+
+def load_replay_llm(path):
+    """녹화 파일에서 모델 응답만 작업별로 순서대로"""
+    queues = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get("kind") == "llm": queues.setdefault(entry["task"], deque()).append(entry)
+    print(f"🔁 재생 모드: 녹화된 모델 응답 {sum(map(len, queues.values()))}개 ({REPLAY_FILE})")
+    return queues
+
+def replay_llm_call(task, on_select=None):
+    """route_call 대신: 녹화된 다음 응답을 녹화된 지연만큼 (REPLAY_LLM_SPEED배) 기다렸다가 돌려줌"""
+    with record_lock:
+        q = replay_llm.get(task)
+        entry = q.popleft() if q else None
+    if entry is None: raise RuntimeError(f"재생: 녹화된 {task} 응답이 더 없음")
+    if on_select and entry.get("model"): on_select(entry["model"])
+    if REPLAY_LLM_SPEED > 0: time.sleep(entry["latency"] * REPLAY_LLM_SPEED)
+    if "error" in entry: raise RuntimeError(f"재생: {entry['error']}")
+    record_model_call(entry["model"], entry["latency"], True)
+    record_usage(task, entry["model"], entry["latency"], entry.get("usage"))
+    return entry["result"], entry["model"]
+
+if REPLAY_FILE: replay_llm = load_replay_llm(REPLAY_FILE)
+
+# =========================
+# Round records (라운드 하나 = 플레이어 입력들 + AI 응답)
+# =========================
+class RoundRecord:
+    """라운드 기록. 만든 뒤엔 고치지 않고 수정은 replace()로 새 객체를 만듦 (스냅샷끼리 그대로 공유)"""
+    __slots__ = ("round_id", "actions", "ai_text", "model", "usage", "started_at", "finished_at", "_wire")
+
+    def __init__(self, round_id, actions=(), ai_text="", model="", usage=None, started_at=None, finished_at=None):
+        self.round_id = int(round_id)
+        self.actions = tuple((uid, name, text) for uid, name, text in actions)  # (uid, 이름, 입력)
+        self.ai_text = ai_text or ""
+        self.model = model or ""
+        self.usage = tuple(usage) if usage else None  # (prompt_tokens, completion_tokens, cached_tokens)
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self._wire = None
+
+    def replace(self, **changes):
+        fields = {k: getattr(self, k) for k in self.__slots__ if k != "_wire"}
+        fields.update(changes)
+        return RoundRecord(**fields)
+
+    def to_dict(self):
+        """저장 파일/클라이언트 공용 형식 (한 번 만들면 캐시)"""
+        if self._wire is None:
+            self._wire = {
+                "id": self.round_id,
+                "actions": [{"uid": u, "name": n, "text": t} for u, n, t in self.actions],
+                "ai": self.ai_text,
+                "model": self.model,
+                "usage": usage_dict(self.usage) if self.usage else None,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+        return self._wire
+
+    @classmethod
+    def from_dict(cls, d):
+        u = d.get("usage")
+        return cls(
+            d.get("id", 0),
+            [(a.get("uid"), a.get("name", ""), a.get("text", "")) for a in d.get("actions", [])],
+            d.get("ai", ""), d.get("model", ""),
+            (u.get("prompt_tokens", 0), u.get("completion_tokens", 0), u.get("cached_tokens", 0)) if u else None,
+            d.get("started_at"), d.get("finished_at"),
+        )
+
+    def prompt_lines(self):
+        """프롬프트에 넣을 (role, text) 목록. 모델이 보던 예전 문자열 형식 그대로"""
+        lines = []
+        if self.actions:
+            lines.append(("user", "**Round**: " + " / ".join(f"{n}: {t}" for _, n, t in self.actions)))
+        if self.ai_text:
+            lines.append(("assistant", f"**AI**: {self.ai_text}"))
+        return lines
+
+def migrate_history(lines, profiles, next_round_id=None):
+    """옛 저장 파일의 "**Round**: A: x / B: y", "**AI**: ..." 문자열 목록을 RoundRecord로 변환"""
+    by_name = {p.get("name"): uid for uid, p in profiles.items()}
+    records = []
+    for line in lines:
+        if line.startswith("**AI**:"):
+            text = line[len("**AI**:"):].strip()
+            if records and not records[-1].ai_text:
+                records[-1] = records[-1].replace(ai_text=text)
+            else:
+                records.append(RoundRecord(0, (), text))
+            continue
+        body = line[len("**Round**:"):].strip() if line.startswith("**Round**:") else line
+        actions = []
+        for part in body.split(" / "):
+            name, sep, text = part.partition(":")
+            if not sep and actions:
+                # 입력 본문에 " / "가 있었던 경우 (예전 형식이 잘못 쪼갠 것) → 앞 입력에 다시 붙임
+                uid, prev_name, prev_text = actions[-1]
+                actions[-1] = (uid, prev_name, prev_text + " / " + part)
+            elif sep: actions.append((by_name.get(name.strip()), name.strip(), text.strip()))
+            else: actions.append((None, "", part.strip()))
+        records.append(RoundRecord(0, actions))
+    # 번호는 다음 라운드 번호 바로 앞에서 끝나게 매김
+    first = 1
+    if next_round_id and next_round_id > len(records): first = next_round_id - len(records)
+    return [r.replace(round_id=first + i) for i, r in enumerate(records)]
+
+def json_default(o):
+    if isinstance(o, RoundRecord): return o.to_dict()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
 # =========================
 # State
 # =========================
@@ -71,6 +880,7 @@ initial_state = {
     "session_title": "드림놀이",
     "theme": {"bg": "#ffffff", "panel": "#f1f3f5", "accent": "#e91e63"},
     "ai_model": "gpt-5.2",
+    "allow_provider_switch": False,  # 집필 모델이 막혔을 때 다른 공급자(OpenAI <-> Gemini)로 넘어가도 되는지
     "admin_password": ADMIN_PASSWORD,
     "output_limit": 2000,
     "player_count": 3,
@@ -82,7 +892,10 @@ initial_state = {
         "user3": {"name": "Player 3", "bio": "", "canon": "", "locked": False}
     },
     "pending_inputs": {},
-    "ai_history": [],
+    "round_id": 1,
+    "round_phase": "collecting",
+    "rounds": [],
+    "archive": [],  # 디스크로 내린 옛 라운드 묶음 목록 (file, first_id, last_id, count)
     "summary": "",
     "prologue": "",
     "sys_prompt": "당신은 숙련된 TRPG 마스터입니다.",
@@ -101,6 +914,20 @@ if saved_data:
     if "player_count" not in state:
         state["player_count"] = 3
 
+    # ✅ 옛날 문자열 기록(ai_history)은 라운드 기록으로 변환
+    if "rounds" in state:
+        state["rounds"] = [RoundRecord.from_dict(d) for d in state["rounds"]]
+    else:
+        state["rounds"] = migrate_history(state.get("ai_history", []), state["profiles"], state.get("round_id"))
+    state.pop("ai_history", None)
+    # 보관 묶음은 목록만 들고 있고 내용은 필요할 때 읽음 (시작할 땐 안 읽음)
+    state.setdefault("archive", [])
+    # ✅ 라운드 번호가 없던 저장 파일이면 기록 뒤로 이어서 매김
+    last_rid = state["rounds"][-1].round_id if state["rounds"] else 0
+    state["round_id"] = max(state.get("round_id", 1), last_rid + 1)
+    # 집필 도중 서버가 꺼졌으면 그 라운드는 다시 입력받기
+    state["round_phase"] = "collecting"
+
     # 기존 ip_map은 버리고 client_map(고유 ID용) 사용
     state.pop("ip_map", None)
     client_map = state.pop("client_map", {})
@@ -114,6 +941,130 @@ readonly_sids = set()
 admin_sids = set()
 typing_users = set()
 
+# =========================
+# State writer (state 변경은 전부 이 큐를 거쳐 writer 스레드 하나에서만)
+# =========================
+_MISSING = object()
+_SCALAR_TYPES = (str, int, float, bool, type(None), RoundRecord)  # RoundRecord는 원래 불변
+
+class FrozenDict(dict):
+    """스냅샷용 읽기 전용 dict. json 직렬화는 그냥 dict처럼 되고, 고치려 하면 TypeError"""
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("snapshot is read-only")
+    __setitem__ = __delitem__ = _readonly
+    update = pop = popitem = setdefault = clear = _readonly
+
+    def __copy__(self): return self
+    def __deepcopy__(self, memo): return self
+    def __reduce__(self): return (FrozenDict, (dict(self),))
+
+def freeze(value, prev=None):
+    """value를 불변 구조(FrozenDict/tuple)로. prev(이전 스냅샷의 같은 자리)와 같은 가지는 그대로 재사용해서
+    바뀐 가지만 새로 만들어짐 → 안 바뀌었으면 prev 자체가 돌아옴 (is로 비교 가능)"""
+    if isinstance(value, dict):
+        if isinstance(prev, FrozenDict) and value == prev: return prev
+        old = prev if isinstance(prev, FrozenDict) else {}
+        items = {k: freeze(v, old.get(k)) for k, v in value.items()}
+        if old and len(old) == len(items) and all(old.get(k, _MISSING) is v for k, v in items.items()):
+            return prev
+        return FrozenDict(items)
+    if isinstance(value, (list, tuple)):
+        items = tuple(value)
+        if isinstance(prev, tuple) and items == prev: return prev
+        # 히스토리처럼 문자열만 든 리스트는 원소를 그대로 공유 (포인터 복사뿐)
+        if all(type(v) in _SCALAR_TYPES for v in items): return items
+        old = prev if isinstance(prev, tuple) else ()
+        items = tuple(freeze(v, old[i] if i < len(old) else None) for i, v in enumerate(items))
+        if isinstance(prev, tuple) and len(old) == len(items) and all(a is b for a, b in zip(items, old)):
+            return prev
+        return items
+    if prev is not None and type(prev) is type(value) and prev == value:
+        return prev
+    return value
+
+# 변경 추적 카운터 (관리자 모니터 탭에서 확인)
+dirty_stats = {
+    "mutations": 0, "noop_mutations": 0,
+    "saves": 0, "saves_skipped": 0,
+    "emits": 0, "emits_skipped": 0,
+}
+
+# 클라이언트 화면에서 안 쓰는 필드: 전송할 때 빼고, 이것만 바뀐 변경은 다시 보내지 않음
+SERVER_ONLY_FIELDS = frozenset(("admin_password", "round_phase"))
+
+class StateWriter:
+    """변경 명령을 순서대로 실행하고, 실제로 바뀐 필드가 있을 때만 버전을 올려 읽기 전용 스냅샷을 새로 만듦.
+    저장/전송/프롬프트 조립은 스냅샷만 읽으니 따로 복사할 필요가 없음."""
+
+    def __init__(self):
+        self.commands = queue.Queue()
+        self.current = (0, freeze(state))  # (version, snapshot)
+        self.field_versions = {}  # 필드 이름 -> 마지막으로 바뀐 버전
+        self.broadcast_version = 0  # 전송하는 필드(SERVER_ONLY_FIELDS 말고)가 마지막으로 바뀐 버전
+        self.thread_id = None
+        self.start_lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        with self.start_lock:
+            if self.started: return
+            self.started = True
+        socketio.start_background_task(self.run)
+
+    def run(self):
+        self.thread_id = threading.get_ident()
+        while True:
+            fn, args, fut = self.commands.get()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                result, error = None, e
+            else:
+                error = None
+            self.commit()
+            if error is not None: fut.set_exception(error)
+            else: fut.set_result(result)
+
+    def commit(self):
+        """이전 스냅샷과 가지 단위로 비교해서 바뀐 가지만 새로 만듦 (안 바뀐 건 그대로 공유, 깊은 복사 없음)"""
+        version, prev = self.current
+        snap = freeze(state, prev)
+        dirty_stats["mutations"] += 1
+        if snap is prev:
+            dirty_stats["noop_mutations"] += 1
+            return
+        changed = [k for k in set(prev) | set(snap) if snap.get(k, _MISSING) is not prev.get(k, _MISSING)]
+        for k in changed: self.field_versions[k] = version + 1
+        if any(k not in SERVER_ONLY_FIELDS for k in changed): self.broadcast_version = version + 1
+        self.current = (version + 1, snap)
+
+    def submit(self, fn, *args):
+        # writer 안에서 또 부르면 바로 실행 (자기 자신을 기다리는 교착 방지)
+        if threading.get_ident() == self.thread_id:
+            return fn(*args)
+        self.start()
+        fut = Future()
+        self.commands.put((fn, args, fut))
+        return fut.result()
+
+session_writer = StateWriter()
+
+def mutate(fn, *args):
+    """state를 바꾸는 코드는 전부 이걸로 감싸서 실행 (결과/예외는 호출한 쪽으로 돌아옴)"""
+    return session_writer.submit(fn, *args)
+
+def current_snapshot():
+    """최신 state 스냅샷 (읽기 전용! 바꾸지 말 것)"""
+    return session_writer.current[1]
+
+def state_version():
+    return session_writer.current[0]
+
+def broadcast_version():
+    return session_writer.broadcast_version
+
 # =========================
 # Helpers
 # =========================
@@ -123,57 +1074,738 @@ def sanitize_filename(name: str) -> str:
     return name[:60] or "session"
 
 def get_export_config_only():
+    snap = current_snapshot()
     return {
-        "session_title": state.get("session_title", ""),
-        "sys_prompt": state.get("sys_prompt", ""),
-        "prologue": state.get("prologue", ""),
-        "examples": state.get("examples", [{"q":"","a":""},{"q":"","a":""},{"q":"","a":""}]),
-        "lorebook": state.get("lorebook", []),
-        "output_limit": state.get("output_limit", 2000),
-        "theme": state.get("theme"),
+        "session_title": snap.get("session_title", ""),
+        "sys_prompt": snap.get("sys_prompt", ""),
+        "prologue": snap.get("prologue", ""),
+        "examples": snap.get("examples", [{"q":"","a":""},{"q":"","a":""},{"q":"","a":""}]),
+        "lorebook": snap.get("lorebook", []),
+        "output_limit": snap.get("output_limit", 2000),
+        "theme": snap.get("theme"),
         "_export_type": "dream_config_only_v1"
     }
 
+def redact_profiles(profiles, keep=None):
+    """keep을 제외한 프로필의 비밀 정보(bio/canon)만 지운 새 dict (원본은 안 건드림)"""
+    return {u: (p if u == keep else dict(p, bio="", canon="")) for u, p in profiles.items()}
+
 def get_sanitized_state():
-    safe = copy.deepcopy(state)
-    for u in ["user1", "user2", "user3"]: # ✅ 반복문으로 처리하면 깔끔해
-        safe["profiles"][u]["bio"] = ""
-        safe["profiles"][u]["canon"] = ""
+    safe = {k: v for k, v in current_snapshot().items() if k not in SERVER_ONLY_FIELDS}
+    safe["profiles"] = redact_profiles(safe["profiles"])
+    safe["rounds"] = rounds_wire(safe.get("rounds", ()))
     return safe
 
-def emit_state_to_players(save=True):
-    if save: save_data()
+# 스냅샷의 rounds 튜플이 그대로면 전송용 목록도 그대로 재사용
+_rounds_wire_cache = ((), [])
 
-    base_state = copy.deepcopy(state)
-    base_state["pending_status"] = list(state.get("pending_inputs", {}).keys())
-    base_state["typing_status"] = list(typing_users)
+def rounds_wire(rounds):
+    global _rounds_wire_cache
+    cached_for, wire = _rounds_wire_cache
+    if cached_for is not rounds:
+        wire = [r.to_dict() for r in rounds]
+        _rounds_wire_cache = (rounds, wire)
+    return wire
 
-    # ✅ 설정된 인원수에 상관없이 일단 user1~3까지 다 챙기도록 안전장치
-    players = ["user1", "user2", "user3"]
+# writer 안에서만 고침: round id -> state["rounds"] 안의 위치
+round_index = {}
 
-    for me in players:
-        # 내 전용 state 복사본 생성
-        my_view = copy.deepcopy(base_state)
+def rebuild_round_index():
+    round_index.clear()
+    for i, r in enumerate(state.get("rounds", [])): round_index[r.round_id] = i
 
-        # '나'를 제외한 다른 사람들의 비밀 정보 지우기
-        for other in players:
-            if me != other:
-                # 만약 다른 유저 정보가 존재할 때만 지우기 (KeyError 방지)
-                if other in my_view["profiles"]:
-                    my_view["profiles"][other]["bio"] = ""
-                    my_view["profiles"][other]["canon"] = ""
+rebuild_round_index()
 
-        # 해당 유저가 접속해 있다면 전송
-        if connected_users.get(me):
-            socketio.emit("initial_state", my_view, room=connected_users[me])
+def find_round(rid, rounds=None):
+    """round id로 기록 찾기 (rounds를 안 주면 최신 스냅샷에서)"""
+    rounds = current_snapshot().get("rounds", ()) if rounds is None else rounds
+    pos = round_index.get(rid)
+    if pos is not None and pos < len(rounds) and rounds[pos].round_id == rid: return rounds[pos]
+    return next((r for r in rounds if r.round_id == rid), None)
 
-    # 관전자용
+# =========================
+# Event log (브로드캐스트마다 seq를 붙여두고, 재접속하면 놓친 것만 다시 보냄)
+# =========================
+SERVER_EPOCH = uuid.uuid4().hex[:8]  # 서버가 재시작되면 seq가 0부터라 구분용
+EVENT_LOG_SIZE = 500
+# 이 이벤트들은 마지막 것만 의미가 있어서 재전송할 때 하나로 합침
+LATEST_WINS_EVENTS = ("initial_state", "typing_update")
+
+event_lock = threading.Lock()
+event_seq = 0
+event_log = deque(maxlen=EVENT_LOG_SIZE)  # (seq, event, payload)
+
+def broadcast_event(event, payload):
+    """모두에게 보내는 이벤트는 전부 여기로: seq 부여 + 링버퍼 기록"""
+    global event_seq
+    with event_lock:
+        event_seq += 1
+        payload = dict(payload, seq=event_seq)
+        event_log.append((event_seq, event, payload))
+        for sid in list(outbound_queues):
+            send_to(sid, event, payload)
+
+def mark_state_broadcast():
+    """initial_state는 받는 사람마다 내용이 달라서 로그엔 자리만 남기고 재접속 때 새로 만듦"""
+    global event_seq
+    with event_lock:
+        event_seq += 1
+        event_log.append((event_seq, "initial_state", None))
+        return event_seq
+
+def events_since(last_seq, epoch):
+    """last_seq 이후에 놓친 이벤트. 버퍼에서 이미 밀려났으면 None (스냅샷 필요)"""
+    if epoch != SERVER_EPOCH or not isinstance(last_seq, int): return None
+    with event_lock:
+        if last_seq > event_seq: return None
+        if last_seq < event_seq and (not event_log or last_seq < event_log[0][0] - 1): return None
+        missed = [e for e in event_log if e[0] > last_seq]
+
+    last_idx = {}
+    for i, (_, ev, _) in enumerate(missed):
+        if ev in LATEST_WINS_EVENTS: last_idx[ev] = i
+    return [e for i, e in enumerate(missed) if e[1] not in LATEST_WINS_EVENTS or last_idx[e[1]] == i]
+
+def resume_or_snapshot(sid, role, data):
+    missed = events_since(data.get("last_seq"), data.get("epoch"))
+    if missed is None:
+        emit_state_to_sid(sid, role)
+        return
+
+    need_snapshot = False
+    for _, ev, payload in missed:
+        if ev == "initial_state":
+            need_snapshot = True
+            continue
+        send_to(sid, ev, payload)
+    # 스냅샷은 맨 마지막에 (타자기 재생이 끝난 뒤 화면이 최신 상태로 맞춰지게)
+    if need_snapshot: emit_state_to_sid(sid, role)
+
+def build_base_view(seq=None):
+    # 스냅샷은 읽기 전용이라 겉 dict만 새로 만들고 안쪽은 그대로 공유
+    base_state = {k: v for k, v in current_snapshot().items() if k not in SERVER_ONLY_FIELDS}
+    base_state["rounds"] = rounds_wire(base_state.get("rounds", ()))
+    base_state["pending_status"] = list(base_state.get("pending_inputs", {}).keys())
+    base_state["typing_status"] = list(typing_users)
+    base_state["seq"] = event_seq if seq is None else seq
+    base_state["epoch"] = SERVER_EPOCH
+    return base_state
+
+def build_player_view(base_state, me):
+    # '나'를 제외한 다른 사람들의 비밀 정보 지우기 (profiles 부분만 새로 만듦)
+    my_view = dict(base_state)
+    my_view["profiles"] = redact_profiles(base_state["profiles"], keep=me)
+    return my_view
+
+def build_spectator_view(seq=None):
     safe_view = get_sanitized_state()
-    safe_view["pending_status"] = list(state.get("pending_inputs", {}).keys())
+    safe_view["pending_status"] = list(safe_view.get("pending_inputs", {}).keys())
     safe_view["typing_status"] = list(typing_users)
+    safe_view["seq"] = event_seq if seq is None else seq
+    safe_view["epoch"] = SERVER_EPOCH
+    return safe_view
+
+# 마지막으로 전체 전송한 (전송 필드 버전, 입력 중 목록) — 같으면 다시 안 보냄
+last_broadcast_key = None
 
-    for rsid in readonly_sids:
-        socketio.emit("initial_state", safe_view, room=rsid)
+def emit_state_to_players(save=True):
+    global last_broadcast_key
+    if save: save_data()
+
+    key = (broadcast_version(), frozenset(typing_users))
+    with broadcast_lock:
+        if key == last_broadcast_key:
+            dirty_stats["emits_skipped"] += 1
+            return
+        last_broadcast_key = key
+    dirty_stats["emits"] += 1
+
+    with span("fanout"):
+        t0 = time.perf_counter()
+        seq = mark_state_broadcast()
+        base_state = build_base_view(seq)
+        if metrics_active():
+            PAYLOAD_BYTES.observe(len(json.dumps(base_state, ensure_ascii=False, default=json_default)))
+
+        # ✅ 설정된 인원수에 상관없이 일단 user1~3까지 다 챙기도록 안전장치
+        for me in ["user1", "user2", "user3"]:
+            # 해당 유저가 접속해 있다면 전송
+            if connected_users.get(me):
+                send_to(connected_users[me], "initial_state", build_player_view(base_state, me))
+
+        # 관전자용
+        safe_view = build_spectator_view(seq)
+        for rsid in list(readonly_sids):
+            send_to(rsid, "initial_state", safe_view)
+        FANOUT_SECONDS.observe(time.perf_counter() - t0)
+
+def emit_state_to_sid(sid, role):
+    """방금 들어온 소켓 하나에만 바로 스냅샷 전송 (전체 브로드캐스트는 따로 모아서)"""
+    if role in ("user1", "user2", "user3"):
+        view = build_player_view(build_base_view(), role)
+    else:
+        view = build_spectator_view()
+    send_to(sid, "initial_state", view)
+
+# =========================
+# Outbound queues (소켓별 송신 대기열: 느린 소켓은 스냅샷을 최신 것 하나만 남김)
+# =========================
+OUTBOUND_MAX_BACKLOG = 8      # engine.io 송신 큐에 이만큼 밀려 있으면 잠시 보류
+OUTBOUND_RETRY_DELAY = 0.05   # 보류 중 재확인 간격(초)
+
+class OutboundQueue:
+    def __init__(self, sid):
+        self.sid = sid
+        self.lock = threading.Lock()
+        self.items = deque()  # (event, payload)
+        self.draining = False
+        self.closed = False
+        self.sent = 0
+        self.dropped_snapshots = 0
+
+outbound_lock = threading.Lock()
+outbound_queues = {}  # sid -> OutboundQueue (join_game 한 소켓만)
+
+def register_outbound(sid):
+    with outbound_lock:
+        if sid not in outbound_queues:
+            outbound_queues[sid] = OutboundQueue(sid)
+
+def drop_outbound(sid):
+    with outbound_lock:
+        q = outbound_queues.pop(sid, None)
+    if q: q.closed = True
+
+def transport_backlog(sid):
+    """engine.io 소켓 송신 큐에 아직 안 나간 패킷 수 (내부 구조라 못 읽으면 0)"""
+    try:
+        eio_sid = socketio.server.manager.eio_sid_from_sid(sid, "/")
+        return socketio.server.eio.sockets[eio_sid].queue.qsize()
+    except Exception:
+        return 0
+
+def send_to(sid, event, payload):
+    q = outbound_queues.get(sid)
+    if q is None:
+        # 아직 join_game 전인 소켓 (대기열 없이 바로)
+        socketio.emit(event, payload, room=sid)
+        return
+
+    with q.lock:
+        if event in LATEST_WINS_EVENTS:
+            # 아직 못 보낸 같은 종류가 있으면 버리고 최신 것만 뒤에 붙임
+            for i, (ev, _) in enumerate(q.items):
+                if ev == event:
+                    del q.items[i]
+                    if event == "initial_state": q.dropped_snapshots += 1
+                    break
+        q.items.append((event, payload))
+        if q.draining: return
+        q.draining = True
+    drain_outbound(q)
+
+def drain_outbound(q, background=False):
+    while not q.closed:
+        if transport_backlog(q.sid) >= OUTBOUND_MAX_BACKLOG:
+            # 느린 소켓: 호출한 쪽은 기다리지 않게 백그라운드로 넘김
+            if not background:
+                socketio.start_background_task(drain_outbound, q, True)
+                return
+            socketio.sleep(OUTBOUND_RETRY_DELAY)
+            continue
+        with q.lock:
+            if not q.items:
+                q.draining = False
+                return
+            event, payload = q.items.popleft()
+        socketio.emit(event, payload, room=q.sid)
+        q.sent += 1
+
+def get_outbound_stats():
+    out = []
+    for sid, q in list(outbound_queues.items()):
+        role = next((r for r, s in connected_users.items() if s == sid), "readonly" if sid in readonly_sids else "-")
+        out.append({
+            "sid": sid[:8], "role": role, "depth": len(q.items), "backlog": transport_backlog(sid),
+            "sent": q.sent, "dropped_snapshots": q.dropped_snapshots,
+        })
+    return out
+
+# =========================
+# Coalesced broadcast (접속/퇴장이나 설정 변경이 몰려도 창마다 한 번만 저장+전송)
+# =========================
+BROADCAST_COALESCE_WINDOW = 0.15  # 접속/퇴장 묶는 창(초)
+MUTATION_COALESCE_WINDOW = 0.02   # 관리자 편집처럼 연달아 오는 변경 묶는 창(초)
+
+broadcast_lock = threading.Lock()
+broadcast_scheduled = False
+broadcast_needs_save = False
+
+def schedule_state_broadcast(save=False, delay=BROADCAST_COALESCE_WINDOW):
+    global broadcast_scheduled, broadcast_needs_save
+    with broadcast_lock:
+        broadcast_needs_save = broadcast_needs_save or save
+        if broadcast_scheduled: return
+        broadcast_scheduled = True
+    socketio.start_background_task(flush_state_broadcast, delay)
+
+def flush_state_broadcast(delay):
+    global broadcast_scheduled, broadcast_needs_save
+    socketio.sleep(delay)
+    with broadcast_lock:
+        broadcast_scheduled = False
+        save = broadcast_needs_save
+        broadcast_needs_save = False
+    emit_state_to_players(save=save)
+
+txn_local = threading.local()
+
+@contextmanager
+def transaction():
+    """with transaction(): 안에서 mutate/publish_state를 여러 번 해도 저장+전송은 끝날 때 한 번"""
+    depth = getattr(txn_local, "depth", 0)
+    txn_local.depth = depth + 1
+    try:
+        yield
+    finally:
+        txn_local.depth = depth
+        if depth == 0 and getattr(txn_local, "dirty", False):
+            txn_local.dirty = False
+            schedule_state_broadcast(save=True, delay=MUTATION_COALESCE_WINDOW)
+
+def publish_state():
+    """변경을 저장+전송 예약. 짧은 창 안에 여러 핸들러가 불러도 한 번으로 합쳐짐.
+    바로 뒤에 status_update를 보내야 해서 순서가 중요한 곳은 emit_state_to_players()를 직접 씀."""
+    if getattr(txn_local, "depth", 0) > 0:
+        txn_local.dirty = True
+        return
+    schedule_state_broadcast(save=True, delay=MUTATION_COALESCE_WINDOW)
+
+# =========================
+# Typing presence (입력 중 표시는 서버에서 모아서 가끔만 보냄)
+# =========================
+TYPING_BROADCAST_INTERVAL = 0.5  # typing_update 브로드캐스트 최소 간격(초)
+TYPING_EVENT_MIN_GAP = 0.2       # sid당 start_typing 처리 최소 간격(초). 더 빨리 오면 버리지 않고 간격이 지난 뒤 반영
+
+typing_lock = threading.Lock()
+typing_flush_scheduled = False
+typing_last_sent = frozenset()
+typing_last_sent_at = 0.0
+typing_last_event = {}  # sid -> 마지막으로 받아준 start_typing 시각
+typing_deferred = {}    # sid -> 간격 때문에 미뤄 둔 start_typing의 uid (그 사이 stop_typing이 오면 취소)
+
+def set_typing(uid, on):
+    """입력 중 상태를 바꾸고, 실제로 바뀌었을 때만 브로드캐스트를 예약"""
+    with typing_lock:
+        before = uid in typing_users
+        if on: typing_users.add(uid)
+        else: typing_users.discard(uid)
+        if before == on: return
+    schedule_typing_broadcast()
+
+def schedule_typing_broadcast():
+    global typing_flush_scheduled
+    with typing_lock:
+        if typing_flush_scheduled: return
+        typing_flush_scheduled = True
+    socketio.start_background_task(flush_typing_presence)
+
+def flush_typing_presence():
+    global typing_flush_scheduled, typing_last_sent, typing_last_sent_at
+    wait = TYPING_BROADCAST_INTERVAL - (time.time() - typing_last_sent_at)
+    if wait > 0: socketio.sleep(wait)
+
+    with typing_lock:
+        typing_flush_scheduled = False
+        current = frozenset(typing_users)
+        # 간격 동안 켰다 껐다 해서 결국 그대로면 보내지 않음
+        if current == typing_last_sent: return
+        typing_last_sent = current
+        typing_last_sent_at = time.time()
+    broadcast_event("typing_update", {"typing_users": sorted(current)})
+
+def typing_rate_limited(sid):
+    now = time.time()
+    if now - typing_last_event.get(sid, 0.0) < TYPING_EVENT_MIN_GAP: return True
+    typing_last_event[sid] = now
+    return False
+
+def defer_start_typing(sid, uid):
+    """간격 안에 다시 온 start_typing: 클라이언트는 입력이 이어지는 동안 다시 안 보내므로 버리면 표시가 꺼진 채로 남음"""
+    with typing_lock:
+        scheduled = sid in typing_deferred
+        typing_deferred[sid] = uid
+    if scheduled: return
+    def apply_later():
+        socketio.sleep(max(0.0, TYPING_EVENT_MIN_GAP - (time.time() - typing_last_event.get(sid, 0.0))))
+        with typing_lock: uid_now = typing_deferred.pop(sid, None)
+        if uid_now is None or connected_users.get(uid_now) != sid: return
+        typing_last_event[sid] = time.time()
+        set_typing(uid_now, True)
+    socketio.start_background_task(apply_later)
+
+def cancel_deferred_typing(sid):
+    with typing_lock: typing_deferred.pop(sid, None)
+
+# =========================
+# Model router (작업 종류별 모델 후보 중 빠르고 멀쩡한 걸 골라 호출)
+# =========================
+# 품질 등급: 같은 등급 안에서만 서로 대신함. narration/retry는 관리자가 허용하지 않으면 고른 모델의 공급자 안에서만
+# (OpenAI와 Gemini는 프롬프트 모양이 달라서 세션 도중에 공급자가 바뀌면 서술 톤이 바뀜)
+MODEL_TIERS = {
+    "gpt-5.2": "premium", "gemini-3-pro-preview": "premium",
+    "gpt-4o": "standard", "gemini-3-flash-preview": "standard",
+    "gpt-4o-mini": "light", "gemini-2.0-flash-lite": "light",
+    "fake-openai": "test", "fake-gemini": "test",  # 가짜 모델 (FAKE_LLM 없이도 ai_model로 고를 수 있음. 고르면 모든 작업이 이 등급 안에서만)
+}
+# 작업 종류 -> 쓸 등급 (앞에서부터). narration/retry는 관리자가 고른 모델의 등급이 먼저
+TASK_TIERS = {
+    "narration": ["premium", "standard"],
+    "retry": ["standard", "premium", "light"],
+    "summary": ["light", "standard"],
+    "theme": ["light", "standard"],
+}
+# 설정 파일의 공급자 모델: 등급에 넣고, tasks에 적은 작업은 그 등급을 맨 앞으로
+for _alias, _m in provider_models.items():
+    MODEL_TIERS[_alias] = _m.get("tier", "standard")
+    for _task in _m.get("tasks", ()):
+        TASK_TIERS[_task] = [MODEL_TIERS[_alias]] + [t for t in TASK_TIERS.get(_task, ["standard"]) if t != MODEL_TIERS[_alias]]
+
+ROUTER_WINDOW = 50            # 모델마다 최근 호출 몇 개로 통계를 낼지
+ROUTER_MIN_SAMPLES = 5        # 이보다 적으면 오류율로 판단하지 않음
+ROUTER_MAX_ERROR_RATE = 0.5
+ROUTER_FAIL_STREAK = 3        # 연속 실패가 이만큼이면 잠시 쉬게 함
+ROUTER_COOLDOWN = 60.0        # 초
+ROUTER_SWITCH_MARGIN = 1.2    # 고른 모델보다 p95가 이 배수 이상 빨라야 다른 모델로 바꿈
+
+router_lock = threading.Lock()
+model_calls = {}              # 모델 -> deque[(지연 초, 성공 여부)]
+model_fail_streak = {}
+model_cooldown_until = {}
+router_decisions = deque(maxlen=50)
+gemini_models = {}            # 모델명 -> genai.GenerativeModel (매번 새로 만들지 않게)
+
+def model_provider(model):
+    return "gemini" if model.startswith("gemini") or model == "fake-gemini" else "openai"
+
+def model_available(model):
+    if is_fake_model(model) or model in provider_models: return True
+    return bool(GEMINI_API_KEY) if model_provider(model) == "gemini" else client is not None
+
+def get_gemini(model):
+    if model not in gemini_models:
+        gemini_models[model] = FakeGeminiModel(model) if is_fake_model(model) else genai.GenerativeModel(model)
+    return gemini_models[model]
+
+def openai_token_kwargs(model, n):
+    # 새 세대 모델은 max_tokens 대신 max_completion_tokens만 받음
+    return {"max_completion_tokens": n} if model.startswith(("gpt-5", "o1", "o3", "o4")) else {"max_tokens": n}
+
+def percentile(values, q):
+    if not values: return None
+    vals = sorted(values)
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+def model_stats(model):
+    with router_lock:
+        calls = list(model_calls.get(model, ()))
+        cooldown = model_cooldown_until.get(model, 0) - time.time()
+    ok_lat = [lat for lat, ok in calls if ok]
+    errors = sum(1 for _, ok in calls if not ok)
+    return {
+        "model": model, "tier": MODEL_TIERS.get(model, "-"), "calls": len(calls),
+        "p50": percentile(ok_lat, 0.5), "p95": percentile(ok_lat, 0.95),
+        "error_rate": (errors / len(calls)) if calls else 0.0,
+        "cooldown": max(0.0, round(cooldown, 1)), "available": model_available(model),
+    }
+
+def model_healthy(st):
+    if not st["available"] or st["cooldown"] > 0: return False
+    return st["calls"] < ROUTER_MIN_SAMPLES or st["error_rate"] <= ROUTER_MAX_ERROR_RATE
+
+def record_model_call(model, latency, ok):
+    with router_lock:
+        model_calls.setdefault(model, deque(maxlen=ROUTER_WINDOW)).append((latency, ok))
+        if ok:
+            model_fail_streak[model] = 0
+        else:
+            model_fail_streak[model] = model_fail_streak.get(model, 0) + 1
+            if model_fail_streak[model] >= ROUTER_FAIL_STREAK:
+                model_cooldown_until[model] = time.time() + ROUTER_COOLDOWN
+                model_fail_streak[model] = 0
+
+def route_candidates(task, preferred=None):
+    """시도할 순서대로 모델 목록. 등급 안에서는 p95가 빠른 순, 통계 없는 모델은 뒤로 (고른 모델은 예외).
+    관리자가 가짜 모델을 골랐으면 (preferred가 없으면 세션의 ai_model로 봄) 모든 작업이 가짜 모델끼리만 → 유료 모델로 안 넘어감"""
+    snap = current_snapshot()
+    selected = preferred or snap.get("ai_model")
+    tiers = list(TASK_TIERS.get(task, ["standard"]))
+    if MODEL_TIERS.get(selected) == "test":
+        tiers = ["test"]
+    elif preferred in MODEL_TIERS and task in ("narration", "retry"):
+        tier = MODEL_TIERS[preferred]
+        tiers = [tier] + [t for t in tiers if t != tier]
+    order = []
+    for tier in tiers:
+        stats = [model_stats(m) for m, t in MODEL_TIERS.items() if t == tier]
+        stats = [st for st in stats if model_healthy(st)]
+        stats.sort(key=lambda st: st["p95"] if st["p95"] is not None else float("inf"))
+        models = [st["model"] for st in stats]
+        if preferred in models:
+            # 고른 모델은 다른 모델이 확실히 빠를 때만 밀려남 (왔다갔다 방지)
+            pst = next(st for st in stats if st["model"] == preferred)
+            best = stats[0]
+            if best["model"] == preferred or pst["p95"] is None or best["p95"] is None or pst["p95"] < best["p95"] * ROUTER_SWITCH_MARGIN:
+                models.remove(preferred)
+                models.insert(0, preferred)
+        order.extend(models)
+    if preferred and task in ("narration", "retry") and not snap.get("allow_provider_switch", False):
+        order = [m for m in order if model_provider(m) == model_provider(preferred)]
+    if preferred and preferred not in MODEL_TIERS and task in ("narration", "retry") and model_healthy(model_stats(preferred)):
+        # 목록에 없는 모델 이름 (app.py의 모델명을 직접 바꾼 경우): 그 모델 하나짜리 등급으로 보고 맨 앞에
+        order.insert(0, preferred)
+    return order
+
+def route_call(task, run, preferred=None, on_select=None):
+    """run(model)을 고른 모델로 실행. 실패하면 다음 후보로 (retry). 반환: (결과, 모델). 전부 실패하면 마지막 예외"""
+    if replay_llm is not None: return replay_llm_call(task, on_select)
+    t_start = time.perf_counter()
+    try:
+        result, model = _route_call(task, run, preferred, on_select)
+    except Exception as e:
+        record_llm(task, preferred, latency=time.perf_counter() - t_start, error=e)
+        raise
+    record_llm(task, model, result, time.perf_counter() - t_start, usage_local.last)
+    return result, model
+
+def _route_call(task, run, preferred, on_select):
+    candidates = route_candidates(task, preferred)
+    last_error = None
+    for attempt, model in enumerate(candidates):
+        label = task if attempt == 0 else "retry"
+        reason = "preferred" if model == preferred else ("fastest healthy" if attempt == 0 else f"fallback after {candidates[attempt - 1]}")
+        decision = {"ts": datetime.now().strftime("%H:%M:%S"), "task": label, "model": model, "reason": reason}
+        if preferred and model_provider(model) != model_provider(preferred):
+            decision["provider_switch"] = f"{model_provider(preferred)} → {model_provider(model)}"
+            print(f"🔀 {task}: 공급자 바뀜 {preferred} → {model}")
+        router_decisions.appendleft(decision)
+        if on_select: on_select(model)
+        if attempt: LLM_RETRIES.inc(task=task)
+        t0 = time.perf_counter()
+        usage_local.last = None
+        usage_local.first_token = None
+        try:
+            with span("llm_call", task=label, model=model):
+                result = run(model)
+        except Exception as e:
+            record_model_call(model, time.perf_counter() - t0, False)
+            record_usage(label, model, time.perf_counter() - t0, usage_local.last, ok=False)
+            LLM_ERRORS.inc(model=model, task=task)
+            router_decisions[0]["error"] = str(e)[:120]
+            print(f"⚠️ {model} 실패 ({task}): {e}")
+            last_error = e
+            continue
+        elapsed = time.perf_counter() - t0
+        record_model_call(model, elapsed, True)
+        record_usage(label, model, elapsed, usage_local.last)
+        LLM_SECONDS.observe(elapsed, model=model, task=task)
+        if usage_local.first_token is not None:  # 스트리밍한 호출만 (나머지는 첫 토큰 시각을 모름)
+            LLM_TTFT_SECONDS.observe(usage_local.first_token - t0, model=model, task=task)
+        router_decisions[0]["latency"] = round(time.perf_counter() - t0, 2)
+        return result, model
+    raise last_error or RuntimeError(f"사용 가능한 모델 없음 ({task})")
+
+def get_router_stats():
+    return {
+        "models": [model_stats(m) for m in list(MODEL_TIERS) + [m for m in list(model_calls) if m not in MODEL_TIERS]],
+        "decisions": list(router_decisions)[:20],
+    }
+
+# =========================
+# Usage & cost (호출마다 토큰/지연 기록, 날짜·세션·모델별로 합산)
+# =========================
+# 1M 토큰당 USD (입력, 캐시된 입력, 출력). 대략값이라 PRICE_FILE로 덮어씀
+DEFAULT_PRICES = {
+    "gpt-5.2": (1.75, 0.175, 14.00),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gemini-3-pro-preview": (2.00, 0.20, 12.00),
+    "gemini-3-flash-preview": (0.50, 0.05, 3.00),
+    "gemini-2.0-flash-lite": (0.075, 0.075, 0.30),
+}
+PRICE_FILE = os.getenv("PRICE_FILE", os.path.join(SAVE_PATH, "prices.json"))  # {"모델": [입력, 캐시 입력, 출력]}
+USAGE_FILE = os.path.join(SAVE_PATH, "usage.json")
+USAGE_KEEP_DAYS = 90
+USAGE_KEEP_SESSIONS = 200     # 세션(제목)별 합계는 최근에 쓴 세션 이만큼만
+USAGE_RECENT_CALLS = 200
+USAGE_SAVE_DELAY = 5.0        # 사용량 파일은 호출마다 안 쓰고 이만큼 모았다가 한 번에 (초)
+
+usage_lock = threading.Lock()
+usage_save_lock = threading.Lock()
+usage_save_scheduled = False
+usage_local = threading.local()  # last: run() 안에서 본 응답의 사용량, round_id: 지금 생성 중인 라운드
+recent_calls = deque(maxlen=USAGE_RECENT_CALLS)
+
+def load_prices():
+    prices = dict(DEFAULT_PRICES)
+    prices.update({m: tuple(c.get("price", (0, 0, 0))) for m, c in provider_models.items()})  # 로컬 서버는 기본 0원
+    try:
+        with open(PRICE_FILE, "r", encoding="utf-8") as f:
+            prices.update({m: tuple(v) for m, v in json.load(f).items()})
+    except FileNotFoundError: pass
+    except Exception as e: print(f"⚠️ 가격표 읽기 실패: {e}")
+    return prices
+
+model_prices = load_prices()
+
+def load_usage_book():
+    # 합계 행은 [호출 수, 입력 토큰, 출력 토큰, 캐시 토큰, 비용 USD] (파일을 작게)
+    try:
+        with open(USAGE_FILE, "r", encoding="utf-8") as f:
+            book = json.load(f)
+    except Exception:
+        book = {}
+    book.setdefault("days", {})
+    book.setdefault("sessions", {})
+    return book
+
+usage_book = load_usage_book()
+
+def usage_dict(u):
+    d = {"prompt_tokens": u[0], "completion_tokens": u[1]}
+    if len(u) > 2 and u[2]: d["cached_tokens"] = u[2]
+    return d
+
+def note_usage(res):
+    """run() 안에서 응답을 넘기면 (입력, 출력, 캐시) 토큰을 뽑아 route_call이 기록하게 남김"""
+    u = None
+    try:
+        meta = getattr(res, "usage_metadata", None)  # Gemini
+        if meta is not None:
+            u = (meta.prompt_token_count or 0, meta.candidates_token_count or 0, getattr(meta, "cached_content_token_count", 0) or 0)
+        elif getattr(res, "usage", None) is not None:  # OpenAI
+            details = getattr(res.usage, "prompt_tokens_details", None)
+            u = (res.usage.prompt_tokens or 0, res.usage.completion_tokens or 0, getattr(details, "cached_tokens", 0) or 0)
+    except Exception: pass
+    usage_local.last = u
+    return u
+
+def note_first_token():
+    """스트리밍 run() 안에서 첫 조각을 받았을 때 부름 → route_call이 TTFT로 기록"""
+    if getattr(usage_local, "first_token", None) is None: usage_local.first_token = time.perf_counter()
+
+# 모델별 실제 (프롬프트 글자 수 / 프롬프트 토큰) — 라운드마다 조금씩 갱신. 없으면 어림셈
+chars_per_token = {}
+TOKEN_RATIO_SMOOTHING = 0.2
+
+def observe_token_ratio(model, chars, tokens):
+    if not chars or not tokens: return
+    ratio = chars / tokens
+    prev = chars_per_token.get(model)
+    chars_per_token[model] = ratio if prev is None else prev + (ratio - prev) * TOKEN_RATIO_SMOOTHING
+
+def estimate_tokens(text, model=None):
+    ratio = chars_per_token.get(model)
+    if ratio: return int(len(text) / ratio)
+    # 영어는 4글자에 1토큰쯤, 한글은 글자당 1토큰 가까이
+    ascii_chars = sum(1 for ch in text if ch < "\x80")
+    return int(ascii_chars / 4 + (len(text) - ascii_chars) * 0.8)
+
+def usage_cost(model, u):
+    price = model_prices.get(model)
+    if not price or not u: return 0.0
+    prompt, completion, cached = u
+    return ((prompt - cached) * price[0] + cached * price[1] + completion * price[2]) / 1_000_000
+
+def _add_usage_row(bucket, model, u, cost):
+    row = bucket.setdefault(model, [0, 0, 0, 0, 0.0])
+    row[0] += 1
+    row[1] += u[0]; row[2] += u[1]; row[3] += u[2]
+    row[4] = round(row[4] + cost, 6)
+
+def save_usage_book():
+    with usage_lock:
+        text = json.dumps(usage_book, ensure_ascii=False, separators=(",", ":"))
+    with usage_save_lock:
+        tmp = USAGE_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, USAGE_FILE)
+
+def schedule_usage_save():
+    # usage_lock 안에서 부름. 창 안에 몇 번 불러도 파일은 한 번만 씀
+    global usage_save_scheduled
+    if usage_save_scheduled: return
+    usage_save_scheduled = True
+    socketio.start_background_task(flush_usage_book)
+
+def flush_usage_book():
+    global usage_save_scheduled
+    socketio.sleep(USAGE_SAVE_DELAY)
+    with usage_lock:
+        usage_save_scheduled = False
+    try:
+        save_usage_book()
+    except Exception as e:
+        print(f"⚠️ 사용량 저장 실패: {e}")
+
+def record_usage(task, model, latency, u, ok=True):
+    u = tuple(u) if u else (0, 0, 0)
+    cost = usage_cost(model, u)
+    day = datetime.now().strftime("%Y-%m-%d")
+    session = current_snapshot().get("session_title") or "(제목 없음)"
+    rid = getattr(usage_local, "round_id", None)
+    recent_calls.appendleft({"ts": datetime.now().strftime("%H:%M:%S"), "task": task, "model": model, "round_id": rid,
+                             "session": session, "ok": ok, "usage": u, "latency": round(latency, 2), "cost": round(cost, 6)})
+    if not ok and not any(u): return  # 응답을 받고 나서 실패했으면 토큰은 이미 과금됨
+    LLM_TOKENS.inc(u[0], model=model, kind="prompt")
+    LLM_TOKENS.inc(u[1], model=model, kind="completion")
+    LLM_TOKENS.inc(u[2], model=model, kind="cached")
+    LLM_COST.inc(cost, model=model)
+    with usage_lock:
+        days = usage_book["days"]
+        _add_usage_row(days.setdefault(day, {}), model, u, cost)
+        sessions = usage_book["sessions"]
+        sessions[session] = sessions.pop(session, {})  # 최근에 쓴 세션을 맨 뒤로 (앞에서부터 버림)
+        _add_usage_row(sessions[session], model, u, cost)
+        for old in sorted(days)[:-USAGE_KEEP_DAYS]: del days[old]
+        for old in list(sessions)[:-USAGE_KEEP_SESSIONS]: del sessions[old]
+        schedule_usage_save()
+
+def _sum_rows(rows):
+    total = [0, 0, 0, 0, 0.0]
+    for row in rows:
+        for i, v in enumerate(row): total[i] += v
+    total[4] = round(total[4], 6)
+    return total
+
+def get_usage_stats():
+    with usage_lock:
+        days = {d: dict(b) for d, b in usage_book["days"].items()}
+        sessions = {t: dict(b) for t, b in usage_book["sessions"].items()}
+    models = {}
+    for bucket in days.values():
+        for m, row in bucket.items(): models.setdefault(m, []).append(row)
+    # 라운드별은 최근 호출 기록에서 (재시도·실패 포함)
+    calls = list(recent_calls)
+    session = current_snapshot().get("session_title") or "(제목 없음)"
+    rounds = {}
+    for c in calls:
+        if c["round_id"] is None or c["session"] != session: continue
+        r = rounds.setdefault(c["round_id"], {"round_id": c["round_id"], "calls": 0, "prompt": 0, "completion": 0, "cached": 0, "cost": 0.0, "latency": 0.0})
+        r["calls"] += 1
+        r["prompt"] += c["usage"][0]; r["completion"] += c["usage"][1]; r["cached"] += c["usage"][2]
+        r["cost"] = round(r["cost"] + c["cost"], 6)
+        r["latency"] = round(r["latency"] + c["latency"], 2)
+    return {
+        "today": _sum_rows(days.get(datetime.now().strftime("%Y-%m-%d"), {}).values()),
+        "days": [[d] + _sum_rows(days[d].values()) for d in sorted(days, reverse=True)[:14]],
+        "sessions": sorted(([t] + _sum_rows(b.values()) for t, b in sessions.items()), key=lambda r: -r[5])[:20],
+        "models": sorted(([m] + _sum_rows(rows) for m, rows in models.items()), key=lambda r: -r[5]),
+        "rounds": sorted(rounds.values(), key=lambda r: -r["round_id"])[:15],
+        "recent": calls[:20],
+        "prices": model_prices,
+    }
 
 def analyze_theme_color(title, sys_prompt):
     prompt_text = (
@@ -196,43 +1828,38 @@ def analyze_theme_color(title, sys_prompt):
         "반드시 JSON 형식만 반환: {\"bg\":\"#RRGGBB\",\"panel\":\"#RRGGBB\",\"accent\":\"#RRGGBB\"}"
     )
 
-    default_theme = state.get("theme", {"bg": "#ffffff", "panel": "#f1f3f5", "accent": "#e91e63"})
+    default_theme = current_snapshot().get("theme", {"bg": "#ffffff", "panel": "#f1f3f5", "accent": "#e91e63"})
 
-    # --- 1단계: OpenAI 시도 ---
-    if client:
-        try:
-            res = client.chat.completions.create(
-                model="gpt-4o-mini",
+    def run(model):
+        if model_provider(model) == "openai":
+            res = openai_client(model).chat.completions.create(
+                model=model,
                 messages=[
                     {"role": "system", "content": "Return a single JSON object only."},
                     {"role": "user", "content": prompt_text}
                 ],
                 response_format={"type": "json_object"}
             )
-            obj = json.loads(res.choices[0].message.content)
-            print("🎨 OpenAI로 테마 분석 완료")
-            return apply_theme_logic(obj, default_theme)
-        except Exception as e:
-            print(f"⚠️ OpenAI 분석 실패: {e}")
+            note_usage(res)
+            return json.loads(res.choices[0].message.content)
 
-    # --- 2단계: Gemini 시도 ---
-    if GEMINI_API_KEY:
-        try:
-            model = genai.GenerativeModel('gemini-2.0-flash-lite')
-            response = model.generate_content(
-                prompt_text,
-                generation_config={"response_mime_type": "application/json"}
-            )
-            obj = json.loads(response.text)
-
-            # [핵심 수정] Gemini가 리스트([...])로 줬을 경우를 대비해 첫 번째 항목만 추출!
-            if isinstance(obj, list) and len(obj) > 0:
-                obj = obj[0]
+        response = get_gemini(model).generate_content(
+            prompt_text,
+            generation_config={"response_mime_type": "application/json"}
+        )
+        note_usage(response)
+        obj = json.loads(response.text)
+        # [핵심 수정] Gemini가 리스트([...])로 줬을 경우를 대비해 첫 번째 항목만 추출!
+        if isinstance(obj, list) and len(obj) > 0:
+            obj = obj[0]
+        return obj
 
-            print("🎨 Gemini Flash로 테마 분석 완료")
-            return apply_theme_logic(obj, default_theme)
-        except Exception as e:
-            print(f"⚠️ Gemini 분석 실패: {e}")
+    try:
+        obj, model = route_call("theme", run)
+        print(f"🎨 {model}로 테마 분석 완료")
+        return apply_theme_logic(obj, default_theme)
+    except Exception as e:
+        print(f"⚠️ 테마 분석 실패: {e}")
 
     return default_theme
 
@@ -241,7 +1868,7 @@ def apply_theme_logic(obj, current_theme):
     if not isinstance(obj, dict):
         return current_theme
 
-    out = copy.deepcopy(current_theme)
+    out = dict(current_theme)
     for k in ("bg", "panel", "accent"):
         v = obj.get(k)
         if isinstance(v, str) and v.startswith("#") and len(v) == 7:
@@ -254,63 +1881,105 @@ HISTORY_SOFT_LIMIT_CHARS = 9500
 SUMMARY_MAX_CHARS = 500
 TARGET_MAX_TOKENS = 1100
 
-def build_history_block():
-    history = state.get("ai_history", [])
+def history_window(snap=None, limit=HISTORY_SOFT_LIMIT_CHARS):
+    """최근 라운드부터 거슬러 올라가며 예산 안에 드는 (role, text) 목록과, 거기 들어간 round id들"""
+    rounds = (snap or current_snapshot()).get("rounds", ())
     collected = []
+    ids = set()
     total = 0
-    for msg in reversed(history):
-        add_len = len(msg) + 1
-        if total + add_len > HISTORY_SOFT_LIMIT_CHARS: break
-        collected.append(msg)
-        total += add_len
+    for rec in reversed(rounds):
+        lines = rec.prompt_lines()
+        for role, msg in reversed(lines):
+            add_len = len(msg) + 1
+            if total + add_len > limit: break
+            collected.append((role, msg))
+            ids.add(rec.round_id)
+            total += add_len
+        else:
+            continue
+        break
     collected.reverse()
-    return collected
+    return collected, ids
+
+def history_messages(snap=None, limit=HISTORY_SOFT_LIMIT_CHARS):
+    return history_window(snap, limit)[0]
+
+def build_history_block(snap=None, limit=HISTORY_SOFT_LIMIT_CHARS):
+    return [msg for _, msg in history_messages(snap, limit)]
+
+# 최근 기록 창 밖의 옛 라운드 중 지금 행동과 관련 있는 것만 골라 다시 넣음 (검색 색인 재사용, 외부 호출 없음)
+RECALL_TOP_K = 3
+RECALL_BUDGET_CHARS = 1500   # 이만큼은 최근 기록 예산에서 빼서 씀 → 전체 길이는 그대로
+RECALL_ITEM_CHARS = 500
+RECALL_QUERY_AI_TAIL = 300   # 직전 AI 응답은 끝부분만 (순위 매길 때만)
+# 플레이어 입력만으로 낸 BM25 점수가 (한 문서에만 있는 term의 idf × 이 값)보다 낮으면 안 불러옴.
+# 캐릭터 이름/조사처럼 어디에나 있는 말은 idf가 0에 가까워서 그것만 겹치는 라운드는 못 넘고, 드문 2-gram이 두어 개는 겹쳐야 넘음
+RECALL_MIN_RARE_TERMS = 1.5
+
+def recall_rounds(query_text, exclude_ids, snap=None, ids_out=None, context_text=""):
+    """관련 있는 옛 라운드 텍스트 목록 (예산 안에서, 관련도 순). ids_out에 리스트를 넘기면 고른 round id를 채움.
+    query_text(플레이어 입력)로 최소 점수를 넘는 라운드만 고르고, 순위는 context_text(직전 AI 응답 끝)까지 합쳐 매김"""
+    if not query_text.strip(): return []
+    if not search_index.built: return []  # 시작 직후 색인 중이면 불러오기 없이 (집필 중에 색인을 만들지 않음)
+    snap = snap or current_snapshot()
+    eligible = lambda key: key[0] == "r" and key[1] not in exclude_ids  # 창 안의 라운드/키워드북은 순위에서부터 뺌
+    min_score = RECALL_MIN_RARE_TERMS * search_index.max_idf()
+    hits = dict(search_index.query(query_text, RECALL_TOP_K * 4, keep=eligible, min_score=min_score))
+    ranked = search_index.query(f"{query_text} {context_text}", len(hits), keep=hits.__contains__) if context_text.strip() and hits else hits.items()
+    out = []
+    used = 0
+    for (kind, rid), _ in sorted(ranked, key=lambda kv: -kv[1]):
+        if len(out) >= RECALL_TOP_K: break
+        rec = find_any_round(rid, snap)
+        if rec is None: continue
+        text = f"[Round {rid}] " + " ".join(msg for _, msg in rec.prompt_lines())
+        if len(text) > RECALL_ITEM_CHARS: text = text[:RECALL_ITEM_CHARS] + "…"
+        if used + len(text) > RECALL_BUDGET_CHARS: break
+        out.append(text)
+        if ids_out is not None: ids_out.append(rid)
+        used += len(text) + 1
+    return out
 
 def would_overflow_context(extra_incoming: str) -> bool:
-    sys_p = state.get("sys_prompt","")
-    pro = state.get("prologue","")
-    summ = state.get("summary","")
-    hist = "\n".join(build_history_block())
+    snap = current_snapshot()
+    sys_p = snap.get("sys_prompt","")
+    pro = snap.get("prologue","")
+    summ = snap.get("summary","")
+    hist = "\n".join(build_history_block(snap))
     return (len(sys_p)+len(pro)+len(summ)+len(hist)+len(extra_incoming)+2000) > MAX_CONTEXT_CHARS_BUDGET
 
 def auto_summary_apply():
     def run_once():
-        recent_log = "\n".join(state.get("ai_history", [])[-60:])
+        snap = current_snapshot()
+        recent_log = "\n".join(msg for rec in snap.get("rounds", ())[-30:] for _, msg in rec.prompt_lines())
         if not recent_log: return None
 
-        current_model = state.get("ai_model", "gpt-5.2").lower()
-
-        # 1. 제미나이 모델을 사용 중일 때 요약 (Gemini Flash 사용)
-        if "gemini" in current_model and gemini_model:
-            try:
-                # 요약 전용으로 빠르고 가벼운 Flash 모델 호출
-                summary_engine = genai.GenerativeModel('gemini-2.0-flash-lite')
-                response = summary_engine.generate_content(
+        # 요약은 가벼운 모델로 (라우터가 빠르고 멀쩡한 쪽을 고름)
+        def run(model):
+            if model_provider(model) == "gemini":
+                response = get_gemini(model).generate_content(
                     f"다음 대화 내역을 바탕으로, 이후 서사 진행에 필요한 핵심 사건과 감정선 위주로 아주 간결하게 요약해줘:\n\n{recent_log}"
                 )
-                if response.text:
-                    return response.text.strip()
-            except Exception as e:
-                print(f"⚠️ 제미나이 요약 실패: {e}")
-                # 제미나이 요약 실패하면 아래 GPT 로직으로 자연스럽게 넘어감
-
-        # 2. GPT 모델을 사용 중이거나 제미나이 요약이 실패했을 때 (OpenAI 사용)
-        if client:
-            try:
-                res = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[{"role":"user","content":f"다음 대화 내용을 핵심 위주로 요약해줘:\n{recent_log}"}]
-                )
-                return (res.choices[0].message.content or "").strip()
-            except Exception as e:
-                print(f"⚠️ GPT 요약 실패: {e}")
+                note_usage(response)
+                return (response.text or "").strip()
+            res = openai_client(model).chat.completions.create(
+                model=model,
+                messages=[{"role":"user","content":f"다음 대화 내용을 핵심 위주로 요약해줘:\n{recent_log}"}]
+            )
+            note_usage(res)
+            return (res.choices[0].message.content or "").strip()
 
+        try:
+            return route_call("summary", run)[0]
+        except Exception as e:
+            print(f"⚠️ 요약 실패: {e}")
         return None
 
     try:
         s = run_once()
         if s:
-            state["summary"] = s[:SUMMARY_MAX_CHARS]
+            def apply(): state["summary"] = s[:SUMMARY_MAX_CHARS]
+            mutate(apply)
             save_data()
             print("📝 자동 요약 완료!")
     except:
@@ -331,10 +2000,78 @@ def simple_decrypt(data, key):
 # =========================
 @app.route("/")
 def index():
-    return render_template_string(HTML_TEMPLATE, theme=state.get("theme"))
+    return render_template_string(HTML_TEMPLATE, theme=current_snapshot().get("theme"), provider_models=provider_models, show_fake_models=SHOW_FAKE_MODELS)
 
 #여기까지 삭제
 
+@app.route("/metrics")
+def metrics():
+    global metrics_last_scrape
+    metrics_last_scrape = time.time()
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+def admin_request_ok():
+    # 헤더로만 받음 (URL에 넣으면 접속 로그에 비밀번호가 남음)
+    pw = request.headers.get("X-Admin-Password")
+    return pw is not None and str(pw) == str(current_snapshot().get("admin_password"))
+
+@app.route("/debug/profile/start", methods=["POST"])
+def debug_profile_start():
+    if not admin_request_ok(): return "forbidden", 403
+    args = request.args
+    err = start_profile(args.get("mode", "sample"), args.get("seconds", type=float), args.get("rounds", type=int))
+    if err: return {"success": False, "msg": err}, 409
+    return {"success": True, **profile_status()}
+
+@app.route("/debug/profile/stop", methods=["POST"])
+def debug_profile_stop():
+    if not admin_request_ok(): return "forbidden", 403
+    cap = profile_capture
+    if cap is not None: finish_profile(cap)
+    return profile_status()
+
+@app.route("/debug/profile")
+def debug_profile_status():
+    if not admin_request_ok(): return "forbidden", 403
+    return profile_status()
+
+@app.route("/debug/profile/download")
+def debug_profile_download():
+    """format=pstats (snakeviz 등) | txt (누적 시간순 요약) | collapsed (flamegraph)"""
+    if not admin_request_ok(): return "forbidden", 403
+    data, ext = profile_output(request.args.get("format", "txt"))
+    if data is None: return ext, 404
+    fname = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}"
+    mimetype = "application/octet-stream" if ext == "pstats" else "text/plain; charset=utf-8"
+    return Response(data, mimetype=mimetype, headers={"Content-Disposition": f"attachment; filename={fname}"})
+
+@app.route("/debug/recording/<name>")
+def debug_recording_download(name):
+    if not admin_request_ok(): return "forbidden", 403
+    path = os.path.join(RECORD_DIR, os.path.basename(name))
+    if not os.path.isfile(path): return "없는 녹화 파일", 404
+    with open(path, "rb") as f: data = f.read()
+    return Response(data, mimetype="application/x-ndjson", headers={"Content-Disposition": f"attachment; filename={os.path.basename(path)}"})
+
+@app.route("/debug/memory/start", methods=["POST"])
+def debug_memory_start():
+    if not admin_request_ok(): return "forbidden", 403
+    memory_start()
+    return profile_status()
+
+@app.route("/debug/memory/diff")
+def debug_memory_diff():
+    if not admin_request_ok(): return "forbidden", 403
+    text = memory_diff(request.args.get("top", 30, type=int), request.args.get("group", "lineno"))
+    if text is None: return "먼저 /debug/memory/start", 404
+    return Response(text, mimetype="text/plain; charset=utf-8")
+
+@app.route("/debug/memory/stop", methods=["POST"])
+def debug_memory_stop():
+    if not admin_request_ok(): return "forbidden", 403
+    memory_stop()
+    return profile_status()
+
 @app.route("/export")
 def export_config():
     cfg = get_export_config_only()
@@ -353,6 +2090,23 @@ def export_config():
     return resp
 
 
+@app.route("/export_history")
+def export_history():
+    """보관 묶음까지 포함한 전체 기록을 하나씩 읽어가며 내려보냄 (한꺼번에 메모리에 올리지 않음)"""
+    snap = current_snapshot()
+    title = snap.get("session_title") or "session"
+    fname = f"{sanitize_filename(title)}_history_{datetime.now().strftime('%Y%m%d_%H%M')}.json"
+
+    def generate():
+        yield '{"session_title": ' + json.dumps(title, ensure_ascii=False) + ', "rounds": ['
+        for i, r in enumerate(iter_rounds(snap)):
+            yield ("," if i else "") + "\n" + json.dumps(r.to_dict(), ensure_ascii=False)
+        yield "\n]}\n"
+
+    resp = Response(generate(), mimetype="application/json; charset=utf-8")
+    resp.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{urllib.parse.quote(fname)}"
+    return resp
+
 @app.route("/import", methods=["POST", "OPTIONS"]) # OPTIONS 메서드 추가
 def import_config():
     if request.method == "OPTIONS": # Preflight 요청 처리 (CORS 에러 방지)
@@ -371,14 +2125,14 @@ def import_config():
         content = file.read().decode('utf-8')
         data = json.loads(content)
 
-        import_config_only(data)
-
-        # 테마 재분석
-        combined = state.get("sys_prompt", "") + "\n" + state.get("prologue", "")
-        state["theme"] = analyze_theme_color(state.get("session_title", ""), combined)
+        with transaction():
+            mutate(import_config_only, data)
 
-        save_data()
-        emit_state_to_players()
+            # 테마 재분석 (느린 외부 호출이라 writer 밖에서)
+            snap = current_snapshot()
+            combined = snap.get("sys_prompt", "") + "\n" + snap.get("prologue", "")
+            set_theme(analyze_theme_color(snap.get("session_title", ""), combined))
+            publish_state()
 
         # 성공 응답에도 헤더 추가
         resp = Response("OK", status=200)
@@ -395,9 +2149,12 @@ def import_config():
 # =========================
 
 @socketio.on("join_game")
+@traced("join_game")
 def join_game(data=None):
     sid = request.sid
-    cid = (data or {}).get("client_id")
+    data = data or {}
+    cid = data.get("client_id")
+    register_outbound(sid)
 
     # 1. 재접속 확인 (기존 ID가 user3인지도 확인됨)
     if cid in client_map:
@@ -405,7 +2162,8 @@ def join_game(data=None):
         # 만약 role이 user3인데 connected_users엔 없으면 다시 연결
         connected_users[role] = sid
         emit("assign_role", {"role": role, "mode": "player", "source": "uuid"})
-        emit_state_to_players()
+        # 재접속은 다른 사람 화면에 바뀌는 게 없으니 본인 것만 (놓친 이벤트 or 스냅샷)
+        resume_or_snapshot(sid, role, data)
         return
 
     # 2. 빈 자리 찾기 (순서대로 채움)
@@ -417,35 +2175,45 @@ def join_game(data=None):
     if target_role:
         connected_users[target_role] = sid
         client_map[cid] = target_role
-        save_data()
         emit("assign_role", {"role": target_role, "mode": "player", "source": "new"})
-        emit_state_to_players()
+        emit_state_to_sid(sid, target_role)
+        schedule_state_broadcast(save=True)
         return
 
     # 3. 만석 (관전)
     readonly_sids.add(sid)
     emit("assign_role", {"role": "readonly", "mode": "readonly"})
-    emit_state_to_players()
+    resume_or_snapshot(sid, "readonly", data)
 
 @socketio.on("disconnect")
 def on_disconnect():
     sid = request.sid
+    record_disconnect(sid)
     admin_sids.discard(sid)
+    typing_last_event.pop(sid, None)
+    cancel_deferred_typing(sid)
+    drop_outbound(sid)
 
     # user1, user2, user3 모두 체크
+    left = []
     for role in ("user1", "user2", "user3"):
         if connected_users[role] == sid:
             connected_users[role] = None
-            typing_users.discard(role)
-            state.get("pending_inputs", {}).pop(role, None)
+            set_typing(role, False)
+            left.append(role)
 
     readonly_sids.discard(sid)
-    save_data()
-    emit_state_to_players()
+    # 관전자가 나간 건 아무 화면도 바꾸지 않음
+    if left:
+        def apply():
+            for role in left: state.get("pending_inputs", {}).pop(role, None)
+        mutate(apply)
+        schedule_state_broadcast(save=True)
 
 @socketio.on("clear_all_roles")
+@traced("clear_all_roles")
 def clear_all_roles(data):
-    if str(data.get("password")) != str(state.get("admin_password")): return
+    if str(data.get("password")) != str(current_snapshot().get("admin_password")): return
 
     global client_map
     client_map = {}
@@ -454,214 +2222,718 @@ def clear_all_roles(data):
 
     save_data()
     # 클라이언트의 UUID까지 지우도록 신호를 보냄
-    socketio.emit("reload_signal", {"clear_uuid": True})
+    broadcast_event("reload_signal", {"clear_uuid": True})
 
 @socketio.on("start_typing")
+@traced("start_typing")
 def start_typing(data):
     uid = data.get("uid")
     # ✅ user3 포함
-    if uid in ("user1", "user2", "user3"):
-        typing_users.add(uid)
-        socketio.emit("typing_update", {"typing_users": list(typing_users)})
+    if uid not in ("user1", "user2", "user3"): return
+    if connected_users.get(uid) != request.sid: return
+    if typing_rate_limited(request.sid):
+        defer_start_typing(request.sid, uid)
+        return
+    set_typing(uid, True)
 
 @socketio.on("stop_typing")
+@traced("stop_typing")
 def stop_typing(data):
     uid = data.get("uid")
-    if uid in ("user1", "user2", "user3"):
-        typing_users.discard(uid)
-        # broadcast=True 삭제
-        socketio.emit("typing_update", {"typing_users": list(typing_users)})
+    if uid not in ("user1", "user2", "user3"): return
+    if connected_users.get(uid) != request.sid: return
+    cancel_deferred_typing(request.sid)
+    set_typing(uid, False)
 
 @socketio.on("edit_history_msg")
+@traced("edit_history_msg")
 def edit_history_msg(data):
     try:
-        idx = int(data.get("index"))
-        text = data.get("text")
-        if 0 <= idx < len(state["ai_history"]):
-            # 기존 태그(**AI**: 등)가 사라지지 않게 처리할 수도 있지만,
-            # 여기서는 클라이언트가 보내준 전체 텍스트로 교체
-            state["ai_history"][idx] = text
-            save_data()
-            emit_state_to_players()
+        rid = int(data.get("round_id"))
+        text = data.get("text") or ""
+        def apply():
+            rec = find_round(rid, state["rounds"])
+            if rec is None: return False
+            # 클라이언트가 보내준 AI 응답 본문으로 교체 (새 객체라 이전 스냅샷은 그대로)
+            state["rounds"][round_index[rid]] = rec.replace(ai_text=text)
+            return True
+        if mutate(apply):
+            search_index.add_round(find_round(rid))
+            publish_state()
+        else:
+            # 보관 묶음으로 내려간 라운드는 고치지 않음 (묶음 파일/색인은 안 바뀌는 걸로 둠)
+            emit("edit_history_res", {"ok": False, "round_id": rid,
+                                      "msg": f"{rid}번 라운드는 보관된 옛 기록이라 수정할 수 없습니다. (최근 라운드만 수정 가능)"})
     except: pass
 
+HISTORY_PAGE_MAX = 50
+
+@socketio.on("get_history_page")
+@traced("get_history_page")
+def get_history_page(data):
+    """보관된 옛 라운드를 페이지 단위로 (채팅창 '이전 라운드 불러오기')"""
+    try:
+        before_id = int((data or {}).get("before_id"))
+        limit = max(1, min(int((data or {}).get("limit", HISTORY_PAGE_MAX)), HISTORY_PAGE_MAX))
+    except (TypeError, ValueError): return
+    page = rounds_before(before_id, limit)
+    emit("history_page_res", {"before_id": before_id, "rounds": [r.to_dict() for r in page]})
+
+@socketio.on("search_history")
+@traced("search_history")
+def search_history_req(data):
+    query = ((data or {}).get("query") or "").strip()[:100]
+    if not query: return
+    t0 = time.perf_counter()
+    results = search_history(query)
+    emit("search_results", {"query": query, "results": results, "took_ms": round((time.perf_counter() - t0) * 1000, 2)})
+
 @socketio.on("check_admin")
+@traced("check_admin")
 def check_admin(data):
-    ok = str(data.get("password")) == str(state.get("admin_password"))
+    ok = str(data.get("password")) == str(current_snapshot().get("admin_password"))
     if ok: admin_sids.add(request.sid)
     emit("admin_auth_res", {"success": ok})
 
-@socketio.on("save_master_all")
-def save_master_all(data):
-    # 1. 엔진 설정
-    state["sys_prompt"] = (data.get("sys", state["sys_prompt"]) or "")[:4000]
-    state["summary"] = (data.get("sum", state["summary"]) or "")[:SUMMARY_MAX_CHARS]
-    state["ai_model"] = data.get("model", state.get("ai_model","gpt-5.2"))
-    state["output_limit"] = int(data.get("output_limit", 2000))
+@socketio.on("get_router_stats")
+def get_router_stats_req(_=None):
+    if request.sid not in admin_sids: return
+    emit("router_stats_res", get_router_stats())
 
-    try:
-        pc = int(data.get("player_count", 3))
-        if pc in (1, 2, 3):
-            state["player_count"] = pc
-            state["solo_mode"] = (pc == 1)
-    except: pass
+@socketio.on("get_outbound_stats")
+def get_outbound_stats_req(_=None):
+    if request.sid not in admin_sids: return
+    emit("outbound_stats_res", {"sockets": get_outbound_stats(), "dirty": dict(dirty_stats)})
 
-    # 2. 서사 설정
-    old_title = state["session_title"]
-    old_pro = state["prologue"]
-    state["session_title"] = (data.get("title", state["session_title"]) or "")[:30]
-    state["prologue"] = (data.get("pro", state["prologue"]) or "")[:1000]
+@socketio.on("get_usage_stats")
+def get_usage_stats_req(_=None):
+    if request.sid not in admin_sids: return
+    emit("usage_stats_res", get_usage_stats())
 
-    # 제목이나 프롤로그가 바뀌었을 때만 테마 분석
-    if old_title != state["session_title"] or old_pro != state["prologue"]:
-        combined = state["sys_prompt"] + "\n\n[PROLOGUE]\n" + state["prologue"]
-        if combined.strip():
-            state["theme"] = analyze_theme_color(state["session_title"], combined)
+@socketio.on("dry_run_prompt")
+@traced("dry_run_prompt")
+def dry_run_prompt_req(data=None):
+    if request.sid not in admin_sids: return
+    emit("dry_run_res", dry_run_prompt(bool((data or {}).get("include_text"))))
 
-    save_data()
-    emit_state_to_players()
+@socketio.on("start_recording")
+def start_recording_req(data=None):
+    if request.sid not in admin_sids: return
+    start_recording(bool((data or {}).get("redact_bios")))
+    emit("recording_status", recording_status())
+
+@socketio.on("stop_recording")
+def stop_recording_req(_=None):
+    if request.sid not in admin_sids: return
+    stop_recording()
+    emit("recording_status", recording_status())
+
+@socketio.on("get_recording_status")
+def get_recording_status_req(_=None):
+    if request.sid not in admin_sids: return
+    emit("recording_status", recording_status())
+
+@socketio.on("get_traces")
+def get_traces_req(data=None):
+    if request.sid not in admin_sids: return
+    name = (data or {}).get("name")
+    # 라운드 생성은 client_message 트레이스 안에 들어가 있을 수도 있음
+    traces = [t for t in list(trace_ring) if not name or t["name"] == name or any(sp["name"] == name for sp in t["spans"])]
+    emit("traces_res", {"traces": traces[:30], "sample_rate": TRACE_SAMPLE_RATE, "round_sample_rate": TRACE_ROUND_SAMPLE_RATE})
+
+def set_theme(theme):
+    def apply(): state["theme"] = theme
+    mutate(apply)
+
+@socketio.on("save_master_all")
+@traced("save_master_all")
+def save_master_all(data):
+    def apply():
+        # 1. 엔진 설정
+        state["sys_prompt"] = (data.get("sys", state["sys_prompt"]) or "")[:4000]
+        state["summary"] = (data.get("sum", state["summary"]) or "")[:SUMMARY_MAX_CHARS]
+        state["ai_model"] = data.get("model", state.get("ai_model","gpt-5.2"))
+        state["allow_provider_switch"] = bool(data.get("allow_provider_switch", state.get("allow_provider_switch", False)))
+        state["output_limit"] = int(data.get("output_limit", 2000))
+
+        try:
+            pc = int(data.get("player_count", 3))
+            if pc in (1, 2, 3):
+                state["player_count"] = pc
+                state["solo_mode"] = (pc == 1)
+        except: pass
+
+        # 2. 서사 설정
+        old_title = state["session_title"]
+        old_pro = state["prologue"]
+        state["session_title"] = (data.get("title", state["session_title"]) or "")[:30]
+        state["prologue"] = (data.get("pro", state["prologue"]) or "")[:1000]
+        return old_title != state["session_title"] or old_pro != state["prologue"]
+
+    with transaction():
+        # 제목이나 프롤로그가 바뀌었을 때만 테마 분석 (외부 호출이라 writer 밖에서)
+        if mutate(apply):
+            snap = current_snapshot()
+            combined = snap["sys_prompt"] + "\n\n[PROLOGUE]\n" + snap["prologue"]
+            if combined.strip():
+                set_theme(analyze_theme_color(snap["session_title"], combined))
+        publish_state()
 
 
 # 프로필 잠금 해제 기능 추가
 @socketio.on("unlock_profile")
+@traced("unlock_profile")
 def unlock_profile(data):
     # 비밀번호 검사 줄을 아예 삭제!
     target = data.get("target")
-    if target in state["profiles"]:
+    def apply():
+        if target not in state["profiles"]: return False
         state["profiles"][target]["locked"] = False
-        save_data()
-        emit_state_to_players()
+        return True
+    if mutate(apply):
+        publish_state()
 
 @socketio.on("theme_analyze_request")
+@traced("theme_analyze_request")
 def theme_analyze_request(_=None):
-    if not (state.get("sys_prompt","").strip() and state.get("prologue","").strip()):
+    snap = current_snapshot()
+    if not (snap.get("sys_prompt","").strip() and snap.get("prologue","").strip()):
         return
     # prologue까지 합쳐서 분석 품질 올리기
-    combined = state.get("sys_prompt","") + "\n\n[PROLOGUE]\n" + state.get("prologue","")
-    state["theme"] = analyze_theme_color(state.get("session_title",""), combined)
-    save_data()
-    emit_state_to_players()
+    combined = snap.get("sys_prompt","") + "\n\n[PROLOGUE]\n" + snap.get("prologue","")
+    set_theme(analyze_theme_color(snap.get("session_title",""), combined))
+    publish_state()
 
 
 @socketio.on("save_examples")
+@traced("save_examples")
 def save_examples(data):
     out = []
     for i in range(3):
         ex = data[i] if i < len(data) else {"q":"","a":""}
         out.append({"q": (ex.get("q","") or "")[:500], "a": (ex.get("a","") or "")[:500]})
-    state["examples"] = out
-    save_data()
-    emit_state_to_players()
+    def apply(): state["examples"] = out
+    mutate(apply)
+    publish_state()
 
 @socketio.on("update_profile")
+@traced("update_profile")
 def update_profile(data):
     uid = data.get("uid")
     # ✅ user3 추가
     if uid not in ("user1", "user2", "user3"): return
     if connected_users.get(uid) != request.sid: return
 
-    # 잠겨있으면 수정 불가
-    if state["profiles"][uid].get("locked"): return
-
     name = (data.get("name") or "").strip()
     if not name: return
 
-    state["profiles"][uid]["name"] = name[:12]
-    state["profiles"][uid]["bio"] = (data.get("bio") or "")[:200]
-    state["profiles"][uid]["canon"] = (data.get("canon") or "")[:400]
-    state["profiles"][uid]["locked"] = True # 저장하면 잠금
+    def apply():
+        # 잠겨있으면 수정 불가
+        if state["profiles"][uid].get("locked"): return False
+        state["profiles"][uid]["name"] = name[:12]
+        state["profiles"][uid]["bio"] = (data.get("bio") or "")[:200]
+        state["profiles"][uid]["canon"] = (data.get("canon") or "")[:400]
+        state["profiles"][uid]["locked"] = True # 저장하면 잠금
+        return True
 
-    save_data()
-    emit_state_to_players()
+    if mutate(apply):
+        publish_state()
 
 @socketio.on("start_session")
+@traced("start_session")
 def start_session(_=None):
     if request.sid not in admin_sids: return
 
-    # [수정] 설정된 인원수에 맞춰 모두가 프로필 잠금을 했는지 체크
-    pc = state.get("player_count", 3)
-    p1 = state["profiles"]["user1"].get("locked")
-    p2 = state["profiles"]["user2"].get("locked")
-    p3 = state["profiles"]["user3"].get("locked")
+    def apply():
+        # [수정] 설정된 인원수에 맞춰 모두가 프로필 잠금을 했는지 체크
+        pc = state.get("player_count", 3)
+        p1 = state["profiles"]["user1"].get("locked")
+        p2 = state["profiles"]["user2"].get("locked")
+        p3 = state["profiles"]["user3"].get("locked")
 
-    is_ready = False
-    if pc == 1: is_ready = p1
-    elif pc == 2: is_ready = p1 and p2
-    else: is_ready = p1 and p2 and p3
+        is_ready = False
+        if pc == 1: is_ready = p1
+        elif pc == 2: is_ready = p1 and p2
+        else: is_ready = p1 and p2 and p3
 
-    if not is_ready:
+        if is_ready: state["session_started"] = True
+        return is_ready
+
+    if not mutate(apply):
         emit("status_update", {"msg": "⚠️ 모든 플레이어가 프로필 설정을 저장(확정)해야 시작할 수 있습니다."})
         return
 
-    state["session_started"] = True
-    save_data()
     emit_state_to_players()
-    socketio.emit("status_update", {"msg": "✅ 세션이 시작되었습니다! 이제 행동을 입력하세요."})
+    broadcast_event("status_update", {"msg": "✅ 세션이 시작되었습니다! 이제 행동을 입력하세요."})
 
-@socketio.on("add_lore")
-def add_lore(data):
-    idx = int(data.get("index", -1))
+LORE_MAX_ITEMS = 20
+
+def make_lore_item(data):
     title = (data.get("title","") or "")[:20]
     triggers = (data.get("triggers","") or "")
     content = (data.get("content","") or "")[:400]
-    item = {"title": title, "triggers": triggers, "content": content}
-    state.setdefault("lorebook", [])
-    if (idx < 0 or idx >= len(state["lorebook"])) and len(state["lorebook"]) >= 20:
+    return {"title": title, "triggers": triggers, "content": content}
+
+def apply_lore_op(book, op):
+    """book(list)에 편집 하나 적용. 한도 초과나 모르는 op면 ValueError"""
+    kind = op.get("op", "upsert")
+    if kind == "upsert":
+        idx = int(op.get("index", -1))
+        item = make_lore_item(op)
+        if 0 <= idx < len(book): book[idx] = item
+        elif len(book) >= LORE_MAX_ITEMS: raise ValueError("lore_full")
+        else: book.append(item)
+    elif kind == "delete":
+        book.pop(int(op.get("index")))
+    elif kind == "move":
+        f, t = int(op.get("from")), int(op.get("to"))
+        book.insert(t, book.pop(f))
+    else:
+        raise ValueError(kind)
+
+@socketio.on("add_lore")
+@traced("add_lore")
+def add_lore(data):
+    op = dict(data, op="upsert")
+    def apply():
+        state.setdefault("lorebook", [])
+        try: apply_lore_op(state["lorebook"], op)
+        except ValueError: return False
+        return True
+    if not mutate(apply):
         emit("status_update", {"msg": "⚠️ 키워드북은 최대 20개까지 가능합니다."})
         return
-    if 0 <= idx < len(state["lorebook"]): state["lorebook"][idx] = item
-    else: state["lorebook"].append(item)
-    save_data()
-    emit_state_to_players()
+    publish_state()
 
 @socketio.on("del_lore")
+@traced("del_lore")
 def del_lore(data):
-    try: state["lorebook"].pop(int(data.get("index"))); save_data(); emit_state_to_players()
+    def apply(): apply_lore_op(state["lorebook"], {"op": "delete", "index": data.get("index")})
+    try: mutate(apply); publish_state()
     except: pass
 
 @socketio.on("reorder_lore")
+@traced("reorder_lore")
 def reorder_lore(data):
+    def apply(): apply_lore_op(state["lorebook"], {"op": "move", "from": data.get("from"), "to": data.get("to")})
     try:
-        f, t = int(data.get("from")), int(data.get("to"))
-        state["lorebook"].insert(t, state["lorebook"].pop(f))
-        save_data(); emit_state_to_players()
+        mutate(apply)
+        publish_state()
     except: pass
 
+@socketio.on("bulk_lore_update")
+@traced("bulk_lore_update")
+def bulk_lore_update(data):
+    """키워드 편집 여러 개를 한 번에: {"ops": [{"op": "upsert"|"delete"|"move", ...}, ...]}
+    전부 적용되거나 하나도 적용 안 되거나 (저장/전송도 한 번)"""
+    ops = (data or {}).get("ops") or []
+    def apply():
+        book = list(state.get("lorebook", []))
+        try:
+            for op in ops: apply_lore_op(book, op)
+        except (ValueError, TypeError, IndexError):
+            return False
+        state["lorebook"] = book
+        return True
+    if not mutate(apply):
+        emit("status_update", {"msg": "⚠️ 키워드 일괄 편집 실패 (최대 20개, 잘못된 위치)"})
+        return
+    publish_state()
+
 @socketio.on("reset_session")
+@traced("reset_session")
 def reset_session(data):
-    if str(data.get("password")) != str(state.get("admin_password")):
+    if str(data.get("password")) != str(current_snapshot().get("admin_password")):
         emit("status_update", {"msg": "❌ 비밀번호가 일치하지 않습니다."})
         return
 
-    # 1. 세션 상태 초기화
-    state["session_title"] = "드림놀이"
-    state["theme"] = {"bg": "#ffffff", "panel": "#f1f3f5", "accent": "#e91e63"}
-    # AI 모델이나 인원수는 엔진 설정이므로 유지하거나, 원하면 초기화해도 됨 (여기선 유지)
-    state["session_started"] = False
-
-    # 2. 프로필: 내용은 유지하되 잠금만 해제! (요청사항 반영)
-    for u in ["user1", "user2", "user3"]:
-        if u in state["profiles"]:
-            state["profiles"][u]["locked"] = False
-
-    # 3. 나머지 데이터 삭제
-    state["pending_inputs"] = {}
-    typing_users.clear()
-    state["ai_history"] = []
-    state["summary"] = ""
-    state["prologue"] = ""
-    state["sys_prompt"] = ""
-    state["lorebook"] = []
-    state["examples"] = [{"q": "", "a": ""}, {"q": "", "a": ""}, {"q": "", "a": ""}]
+    def apply():
+        # 1. 세션 상태 초기화
+        state["session_title"] = "드림놀이"
+        state["theme"] = {"bg": "#ffffff", "panel": "#f1f3f5", "accent": "#e91e63"}
+        # AI 모델이나 인원수는 엔진 설정이므로 유지하거나, 원하면 초기화해도 됨 (여기선 유지)
+        state["session_started"] = False
 
-    save_data()
+        # 2. 프로필: 내용은 유지하되 잠금만 해제! (요청사항 반영)
+        for u in ["user1", "user2", "user3"]:
+            if u in state["profiles"]:
+                state["profiles"][u]["locked"] = False
+
+        # 3. 나머지 데이터 삭제
+        reset_round()
+        clear_history()
+        state["summary"] = ""
+        state["prologue"] = ""
+        state["sys_prompt"] = ""
+        state["lorebook"] = []
+        state["examples"] = [{"q": "", "a": ""}, {"q": "", "a": ""}, {"q": "", "a": ""}]
+    mutate(apply)
+
+    with typing_lock: typing_users.clear()
+    schedule_typing_broadcast()
     emit_state_to_players()
-    socketio.emit("status_update", {"msg": "🧹 세션 데이터가 초기화되었습니다. (프로필 유지)"})
+    broadcast_event("status_update", {"msg": "🧹 세션 데이터가 초기화되었습니다. (프로필 유지)"})
+
+# =========================
+# Round state machine (collecting → generating → 커밋하면 다음 라운드 collecting)
+# =========================
+# writer 스레드가 명령을 하나씩 처리하니 아래 전이는 서로 겹치지 않음
+# 커밋하면 round_id가 넘어가므로 같은 라운드를 두 번 커밋할 수 없음
+ROUND_COLLECTING = "collecting"
+ROUND_GENERATING = "generating"
+
+def try_submit(uid, text, client_round_id=None):
+    """입력을 현재 라운드에 넣음. 반환: (거절 메시지 or None, 생성을 시작할 round id or None)"""
+    def apply():
+        rid = state["round_id"]
+        if state["round_phase"] != ROUND_COLLECTING:
+            return "⏳ AI가 이번 라운드를 쓰는 중입니다. 끝난 뒤 다시 입력해주세요.", None
+        if client_round_id is not None and client_round_id != rid:
+            return "⚠️ 지난 라운드의 입력이라 반영하지 않았습니다.", None
+        if uid in state.get("pending_inputs", {}):
+            return "⚠️ 이번 라운드 입력은 이미 받았습니다.", None
+
+        record_pending(uid, text)
+        if not check_all_ready(): return None, None
+        # 마지막 입력을 넣은 요청 하나만 생성 권한을 가짐
+        state["round_phase"] = ROUND_GENERATING
+        return None, rid
+    return mutate(apply)
+
+def commit_round(rid, record):
+    """생성 결과(RoundRecord)를 기록. 그 사이 초기화됐거나 이미 커밋된 라운드면 False"""
+    def apply():
+        if state["round_id"] != rid or state["round_phase"] != ROUND_GENERATING: return False
+        state["rounds"].append(record)
+        round_index[rid] = len(state["rounds"]) - 1
+        state["pending_inputs"] = {}
+        # 다음 라운드 열기
+        state["round_id"] = rid + 1
+        state["round_phase"] = ROUND_COLLECTING
+        return True
+    return mutate(apply)
+
+def reopen_round(rid):
+    """생성이 commit_round까지 못 가고 끝났으면 (예외 등) 같은 라운드를 다시 입력받게. 되돌렸으면 True"""
+    def apply():
+        if state["round_id"] != rid or state["round_phase"] != ROUND_GENERATING: return False
+        state["round_phase"] = ROUND_COLLECTING
+        state["pending_inputs"] = {}
+        return True
+    return mutate(apply)
+
+def reset_round():
+    """초기화/시나리오 로드 시: 진행 중인 생성 결과는 버려지도록 라운드 번호를 넘김"""
+    def apply():
+        state["round_id"] = state.get("round_id", 1) + 1
+        state["round_phase"] = ROUND_COLLECTING
+        state["pending_inputs"] = {}
+    mutate(apply)
+
+# =========================
+# Archive (최근 라운드만 메모리에, 옛 라운드는 gzip 묶음으로 디스크에)
+# =========================
+HOT_ROUNDS_MAX = 100          # 메모리/저장 파일/initial_state에 남기는 최근 라운드 수
+ARCHIVE_SEGMENT_ROUNDS = 50   # 한 번에 디스크로 내리는 라운드 수 (= 묶음 크기)
+ARCHIVE_DIR = os.path.join(SAVE_PATH, "archive")
+ARCHIVE_CACHE_SEGMENTS = 4    # 최근에 읽은 묶음 몇 개는 메모리에 들고 있음
+
+archive_lock = threading.Lock()
+
+def segment_path(entry):
+    return os.path.join(ARCHIVE_DIR, entry["file"])
+
+def write_segment(records):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    entry = {
+        "file": f"rounds_{records[0].round_id:07d}_{records[-1].round_id:07d}.jsonl.gz",
+        "first_id": records[0].round_id, "last_id": records[-1].round_id, "count": len(records),
+    }
+    path = segment_path(entry)
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+        for r in records:
+            f.write(json.dumps(r.to_dict(), ensure_ascii=False) + "\n")
+    os.replace(path + ".tmp", path)
+    return entry
+
+@functools.lru_cache(maxsize=ARCHIVE_CACHE_SEGMENTS)
+def load_segment(fname):
+    try:
+        with gzip.open(os.path.join(ARCHIVE_DIR, fname), "rt", encoding="utf-8") as f:
+            return tuple(RoundRecord.from_dict(json.loads(line)) for line in f if line.strip())
+    except Exception as e:
+        print(f"⚠️ 보관 기록 읽기 실패 ({fname}): {e}")
+        return ()
+
+def maybe_archive():
+    """최근 라운드가 HOT_ROUNDS_MAX + 묶음 크기를 넘으면 제일 오래된 묶음을 디스크로 내림"""
+    if not archive_lock.acquire(blocking=False): return
+    try:
+        archived = False
+        while True:
+            rounds = current_snapshot().get("rounds", ())
+            if len(rounds) < HOT_ROUNDS_MAX + ARCHIVE_SEGMENT_ROUNDS: break
+            chunk = rounds[:ARCHIVE_SEGMENT_ROUNDS]
+            gen = search_index.generation
+            # 파일 쓰기는 writer 밖에서, 목록 교체만 writer에서
+            entry = write_segment(chunk)
+            def apply():
+                hot = state["rounds"]
+                if len(hot) < len(chunk) or any(a is not b for a, b in zip(hot, chunk)): return False
+                del hot[:len(chunk)]
+                state["archive"].append(entry)
+                rebuild_round_index()
+                return True
+            if not mutate(apply):
+                # 그 사이 초기화됨 → 방금 쓴 파일은 버림
+                try: os.remove(segment_path(entry))
+                except OSError: pass
+                break
+            search_index.freeze_rounds(chunk, gen)  # 이제 안 바뀌니 압축 색인으로
+            archived = True
+        if archived: publish_state()
+    except Exception as e:
+        print(f"⚠️ 보관 실패: {e}")
+    finally:
+        archive_lock.release()
+
+def clear_history():
+    """writer 안에서 호출: 최근/보관 기록을 모두 비움 (보관 파일은 뒤에서 지움)"""
+    dropped = list(state.get("archive", []))
+    state["rounds"] = []
+    state["archive"] = []
+    rebuild_round_index()
+    search_index.clear_rounds()
+    if dropped: socketio.start_background_task(delete_segments, dropped)
+
+def delete_segments(entries):
+    for entry in entries:
+        try: os.remove(segment_path(entry))
+        except OSError: pass
+    load_segment.cache_clear()
+
+def iter_rounds(snap=None):
+    """보관 묶음부터 최근 라운드까지 전부 오래된 순으로 (묶음은 하나씩만 읽음)"""
+    snap = snap or current_snapshot()
+    for entry in snap.get("archive", ()):
+        yield from load_segment(entry["file"])
+    yield from snap.get("rounds", ())
+
+def rounds_before(before_id, limit, snap=None):
+    """before_id보다 오래된 라운드를 최대 limit개 (오래된 순). 필요한 묶음만 읽음"""
+    snap = snap or current_snapshot()
+    out = [r for r in snap.get("rounds", ()) if r.round_id < before_id][-limit:]
+    for entry in reversed(snap.get("archive", ())):
+        if len(out) >= limit: break
+        if entry["first_id"] >= before_id: continue
+        older = [r for r in load_segment(entry["file"]) if r.round_id < before_id]
+        out = older[-(limit - len(out)):] + out
+    return out
+
+# =========================
+# Search (라운드 기록 + 키워드북 전문 검색)
+# =========================
+SEARCH_RESULTS_MAX = 30
+SEARCH_SNIPPET_CHARS = 90
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_word_re = re.compile(r"\w+")
+
+def search_terms(text, unigrams=False):
+    """한국어는 띄어쓰기/조사 때문에 단어 단위가 잘 안 맞아서 글자 2-gram으로 쪼갬 (한 글자 단어는 그대로).
+    unigrams=True(색인할 때)면 글자 하나씩도 넣음 → 한 글자 검색어(칼, 문, 손...)가 '칼을', '왼손'에도 걸림"""
+    terms = []
+    for word in _word_re.findall((text or "").lower()):
+        if len(word) == 1: terms.append(word)
+        else:
+            terms.extend(word[i:i+2] for i in range(len(word) - 1))
+            if unigrams: terms.extend(word)
+    return terms
+
+def round_search_text(rec):
+    parts = [f"{n}: {t}" for _, n, t in rec.actions]
+    if rec.ai_text: parts.append(rec.ai_text)
+    return "\n".join(parts)
+
+def lore_search_text(item):
+    return f"{item.get('title','')}\n{item.get('triggers','')}\n{item.get('content','')}"
+
+class SearchIndex:
+    """역색인. 최근 라운드/키워드북은 term -> {문서 키: 빈도} (수정될 때마다 그 문서만 다시 색인),
+    보관 묶음으로 내려간 라운드는 안 바뀌니까 term -> array [round id, 빈도, ...]로만 들고 있음 (문서별 term 목록 없음).
+    키워드북은 20개뿐이라 바뀌었으면 검색할 때 통째로 다시 색인"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.doc_terms = {}   # 문서 키 -> {term: tf} (지울 때 필요, 최근 라운드/키워드북만)
+        self.frozen = {}      # term -> array("I") [round id, tf, round id, tf, ...] (보관된 라운드)
+        self.frozen_ids = set()
+        self.doc_len = {}     # 모든 문서
+        self.total_len = 0
+        self.generation = 0   # 기록을 비울 때마다 올라감 (진행 중인 전체 색인 중단용)
+        self.built = False
+        self.lore_source = None
+
+    def _remove(self, key):
+        tf = self.doc_terms.pop(key, None)
+        if tf is None: return
+        for term in tf:
+            docs = self.postings.get(term)
+            if docs is None: continue
+            docs.pop(key, None)
+            if not docs: del self.postings[term]
+        self.total_len -= self.doc_len.pop(key, 0)
+
+    @staticmethod
+    def _count(text):
+        terms = search_terms(text, unigrams=True)
+        tf = {}
+        for t in terms: tf[t] = tf.get(t, 0) + 1
+        return tf, len(terms)
+
+    def _add(self, key, text):
+        self._remove(key)
+        tf, n = self._count(text)
+        for t, c in tf.items(): self.postings.setdefault(t, {})[key] = c
+        self.doc_terms[key] = tf
+        self.doc_len[key] = n
+        self.total_len += n
+
+    def add_round(self, rec, overwrite=True, gen=None):
+        key = ("r", rec.round_id)
+        with self.lock:
+            if gen is not None and gen != self.generation: return
+            if rec.round_id in self.frozen_ids: return
+            if not overwrite and key in self.doc_terms: return
+            self._add(key, round_search_text(rec))
+
+    def freeze_rounds(self, recs, gen=None):
+        """보관 묶음으로 내려간 라운드를 압축 색인으로 옮김 (이미 옮긴 건 건너뜀)"""
+        counted = [(rec.round_id, *self._count(round_search_text(rec))) for rec in recs]  # 쪼개기는 잠금 밖에서
+        with self.lock:
+            if gen is not None and gen != self.generation: return
+            for rid, tf, n in counted:
+                if rid in self.frozen_ids: continue
+                key = ("r", rid)
+                self._remove(key)
+                for t, c in tf.items():
+                    packed = self.frozen.get(t)
+                    if packed is None: packed = self.frozen[t] = array("I")
+                    packed.append(rid)
+                    packed.append(c)
+                self.frozen_ids.add(rid)
+                self.doc_len[key] = n
+                self.total_len += n
+
+    def clear_rounds(self):
+        with self.lock:
+            for key in [k for k in self.doc_terms if k[0] == "r"]: self._remove(key)
+            for rid in self.frozen_ids: self.total_len -= self.doc_len.pop(("r", rid), 0)
+            self.frozen, self.frozen_ids = {}, set()
+            self.generation += 1
+            self.built = True  # 비운 기록은 다 색인된 셈 (진행 중이던 전체 색인은 중단됨)
+
+    def sync_lore(self, lorebook):
+        with self.lock:
+            if lorebook is self.lore_source: return
+            for key in [k for k in self.doc_terms if k[0] == "l"]: self._remove(key)
+            for i, item in enumerate(lorebook): self._add(("l", i), lore_search_text(item))
+            self.lore_source = lorebook
+
+    def build(self, snap=None):
+        """보관 묶음까지 전부 색인 (시작할 때 뒤에서 한 번). 묶음 하나씩 읽어 압축 색인에 넣고, 그 사이 들어온 최신 내용은 덮어쓰지 않음"""
+        snap = snap or current_snapshot()
+        gen = self.generation
+        for entry in snap.get("archive", ()):
+            if self.generation != gen: return
+            self.freeze_rounds(load_segment(entry["file"]), gen)
+        for rec in snap.get("rounds", ()):
+            if self.generation != gen: return
+            self.add_round(rec, overwrite=False, gen=gen)
+        self.built = True
+
+    def max_idf(self):
+        """한 문서에만 있는 term의 idf (문서 수에 따라 커짐)"""
+        n_docs = len(self.doc_len)
+        return math.log(1 + (n_docs - 0.5) / 1.5) if n_docs else 0.0
+
+    def query(self, text, limit=SEARCH_RESULTS_MAX, keep=None, min_score=0.0):
+        """BM25 상위 limit개 [(문서 키, 점수)]. keep(키)가 False이거나 점수가 min_score 미만인 문서는 순위에 안 넣음"""
+        terms = list(dict.fromkeys(search_terms(text)))
+        if not terms: return []
+        with self.lock:
+            n_docs = len(self.doc_len) or 1
+            avgdl = (self.total_len / n_docs) or 1.0
+            scores = {}
+            for t in terms:
+                docs = self.postings.get(t, {})
+                packed = self.frozen.get(t, ())
+                df = len(docs) + len(packed) // 2
+                if not df: continue
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                frozen_docs = ((("r", rid), tf) for rid, tf in zip(packed[::2], packed[1::2]))
+                for key, tf in itertools.chain(docs.items(), frozen_docs):
+                    if keep is not None and not keep(key): continue
+                    dl = self.doc_len[key]
+                    scores[key] = scores.get(key, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl))
+        items = [kv for kv in scores.items() if kv[1] >= min_score] if min_score > 0 else scores.items()
+        return heapq.nlargest(limit, items, key=lambda kv: kv[1])
+
+search_index = SearchIndex()
+search_build_lock = threading.Lock()
+
+def ensure_search_index():
+    # 서버 시작 때 뒤에서 한 번 돌림. 검색은 끝날 때까지 기다리고, 라운드 생성(recall)은 안 기다리고 건너뜀
+    with search_build_lock:
+        if search_index.built: return
+        t0 = time.perf_counter()
+        search_index.build()
+        if search_index.built: print(f"🔎 검색 색인 완료 ({len(search_index.doc_len)}개, {time.perf_counter() - t0:.1f}초)")
+
+def find_any_round(rid, snap=None):
+    """최근 기록에 없으면 보관 묶음에서 (해당 묶음 하나만 읽음)"""
+    snap = snap or current_snapshot()
+    rec = find_round(rid, snap.get("rounds", ()))
+    if rec is not None: return rec
+    for entry in snap.get("archive", ()):
+        if entry["first_id"] <= rid <= entry["last_id"]:
+            return next((r for r in load_segment(entry["file"]) if r.round_id == rid), None)
+    return None
+
+def make_snippet(text, query):
+    low = text.lower()
+    q = (query or "").strip().lower()
+    pos = low.find(q) if q else -1
+    if pos < 0:
+        words = _word_re.findall(q)
+        pos = next((p for p in (low.find(w) for w in words) if p >= 0), 0)
+    start = max(0, pos - SEARCH_SNIPPET_CHARS // 3)
+    snippet = text[start:start + SEARCH_SNIPPET_CHARS].replace("\n", " ")
+    return ("…" if start > 0 else "") + snippet + ("…" if start + SEARCH_SNIPPET_CHARS < len(text) else "")
+
+def search_history(query, limit=SEARCH_RESULTS_MAX):
+    snap = current_snapshot()
+    ensure_search_index()
+    lorebook = snap.get("lorebook", ())
+    search_index.sync_lore(lorebook)
+    results = []
+    for (kind, ident), score in search_index.query(query, limit):
+        if kind == "r":
+            rec = find_any_round(ident, snap)
+            if rec is None: continue
+            results.append({"type": "round", "id": ident, "score": round(score, 3),
+                            "snippet": make_snippet(round_search_text(rec), query)})
+        elif ident < len(lorebook):
+            item = lorebook[ident]
+            results.append({"type": "lore", "index": ident, "title": item.get("title", ""), "score": round(score, 3),
+                            "snippet": make_snippet(item.get("content", ""), query)})
+    return results
 
 def record_pending(uid, text):
     state.setdefault("pending_inputs", {})
     state["pending_inputs"][uid] = {"text": (text or "")[:600], "ts": datetime.now().isoformat()}
-    save_data()
 
 def check_all_ready():
     """설정된 인원수가 모두 입력을 마쳤는지 확인"""
@@ -674,22 +2946,26 @@ def check_all_ready():
     else: # 3인
         return "user1" in p and "user2" in p and "user3" in p
 
-def build_full_system_content(profile_content, sys_prompt, active_context, summary):
+def build_full_system_content(profile_content, sys_prompt, active_context, summary, snap=None, recalled=None, sections=None):
+    profiles = (snap or current_snapshot())["profiles"]
     # 1. 월드 정보
-    lore_text = ""
+    lore_block = recall_block = ""
     if active_context:
-        lore_text = "### [IMPLICIT CONTEXT]\n" + "\n".join(active_context) + "\n\n"
+        lore_block = "### [IMPLICIT CONTEXT]\n" + "\n".join(active_context) + "\n\n"
+    # 1-1. 오래전 라운드 중 지금과 관련 있는 장면
+    if recalled:
+        recall_block = "### [RECALLED MEMORY] (earlier scenes relevant to this moment)\n" + "\n".join(recalled) + "\n\n"
 
     # 2. 페어링 정보
     pair_block = "### [RELATIONSHIPS]\n"
-    u1 = state['profiles']['user1']
+    u1 = profiles['user1']
     pair_block += f"- Protagonist 1: '{u1.get('name', 'Char 1')}' (Partner: See Profile 1)\n"
-    if 'user2' in state['profiles']:
-        u2 = state['profiles']['user2']
+    if 'user2' in profiles:
+        u2 = profiles['user2']
         if u2.get('name'):
             pair_block += f"- Protagonist 2: '{u2.get('name', 'Char 2')}' (Partner: See Profile 2)\n"
-    if 'user3' in state['profiles']:
-        u3 = state['profiles']['user3']
+    if 'user3' in profiles:
+        u3 = profiles['user3']
         if u3.get('name'):
             pair_block += f"- Protagonist 3: '{u3.get('name', 'Char 3')}' (Partner: See Profile 3)\n"
     pair_block += "\n*Focus strictly on the interactions defined in the profiles.*\n"
@@ -714,19 +2990,16 @@ def build_full_system_content(profile_content, sys_prompt, active_context, summa
             "- **RESTRICTION**: NO explicit sexual acts. NO extreme gore. Keep descriptions emotional and atmospheric."
         )
 
-    return (
+    identity_block = (
         f"### [ENGINE IDENTITY: INVISIBLE SIMULATOR]\n"
         f"You are a text simulation engine for a 'Dream Novel' (OC x Canon).\n"
         f"Your goal is to simulate the **process** of the scene, not just the result.\n\n"
 
         f"{rating_instruction}\n\n"
-
-        f"### [USER SCENARIO]\n"
-        f"{sys_prompt}\n\n"
-
-        f"### [CHARACTERS]\n{profile_content}\n\n"
-        f"{pair_block}\n"
-
+    )
+    scenario_block = f"### [USER SCENARIO]\n{sys_prompt}\n\n"
+    characters_block = f"### [CHARACTERS]\n{profile_content}\n\n{pair_block}\n"
+    rules_block = (
         f"### [ABSOLUTE SIMULATION RULES]\n"
         f"1. **Timeframe**: One response covers approx. **30 seconds** of in-world time. (One specific event).\n"
         f"2. **Pacing**: Write short, dense sentences. Stack micro-details (minimum 6 sensory details).\n"
@@ -734,18 +3007,26 @@ def build_full_system_content(profile_content, sys_prompt, active_context, summa
         f"4. **No God-Modding**: NEVER write the Protagonist's dialogue, thoughts, or feelings. If they are silent, they remain silent.\n"
         f"5. **Hidden Mechanics**: If a probability/dice check is implied, apply the result naturally in the narration. NEVER write 'Success' or 'Fail' explicitly.\n"
         f"6. **Language**: Korean Only. Remove parenthetical English (e.g., '처녀성(Virginity)' -> '처녀성').\n\n"
+    )
+    summary_block = f"### [PREVIOUS SUMMARY]\n{summary}\n"
+
+    # 프롬프트 점검(dry run)용 구간별 길이
+    if sections is not None:
+        sections.update({
+            "system_rules": len(identity_block) + len(rules_block), "scenario": len(scenario_block),
+            "characters": len(characters_block), "lore": len(lore_block), "recalled": len(recall_block),
+            "summary": len(summary_block),
+        })
 
-        f"{lore_text}"
-        f"### [PREVIOUS SUMMARY]\n{summary}\n"
-    ).strip()
+    return (identity_block + scenario_block + characters_block + rules_block + lore_block + recall_block + summary_block).strip()
 
-def build_gemini_prompt(system_content, priority_instruction, examples, prologue_text, round_block, limit):
+def build_gemini_prompt(system_content, priority_instruction, examples, prologue_text, round_block, limit, snap=None, history_limit=HISTORY_SOFT_LIMIT_CHARS):
     return f"""
 {system_content}
 
 [STORY CONTEXT]
 {prologue_text if prologue_text else ""}
-{"/".join(build_history_block())}
+{"/".join(build_history_block(snap, history_limit))}
 
 [NEW ACTIONS]
 {round_block}
@@ -758,30 +3039,94 @@ def build_gemini_prompt(system_content, priority_instruction, examples, prologue
 """.strip()
 
 # 3. AI 실행 함수 (🔴 여기 수정됨: 쉼표 오류 수정 & 모델명 교정)
-def trigger_ai_from_pending():
-    pc = state.get("player_count", 3)
-    limit = int(state.get("output_limit", 2000))
+def trigger_ai_from_pending(rid):
+    usage_local.round_id = rid  # 이 라운드 동안의 모델 호출은 라운드별 사용량으로 묶임
+    try:
+        with trace("round", round_id=rid, sample_rate=TRACE_ROUND_SAMPLE_RATE):
+            set_trace_round(rid)
+            run_profiled(generate_round, rid)
+    except Exception as e:
+        print(f"🔥 라운드 {rid} 생성 중 오류: {e}")
+        GENERATION_ERRORS.inc()
+    finally:
+        usage_local.round_id = None
+        profile_round_done()
+        # 커밋 전에 멈췄으면 '집필 중'에 갇히지 않게 라운드를 다시 엶
+        if reopen_round(rid):
+            broadcast_event("status_update", {"msg": "⚠️ 이번 라운드 생성에 실패했습니다. 다시 입력해주세요."})
+            emit_state_to_players()
+
+def match_lore(lorebook, merged_text, limit=3):
+    """트리거 단어가 merged_text(소문자)에 들어 있는 로어 항목들 (앞에서부터 limit개)"""
+    return [f"[{l.get('title','')}]: {l.get('content','')}" for l in lorebook
+            if any(t.strip().lower() in merged_text for t in l.get("triggers","").split(",") if t.strip())][:limit]
 
-    pending = state.get("pending_inputs", {})
+def postprocess_ai_response(text, limit):
+    """영어 지문/선택지 꼬리 지우기 + limit 근처 문장 끝에서 자르기"""
+    try:
+        import re
+        replacements = {
+            r'(?i)curtsy': '무릎을 굽혀 인사', r'(?i)smirk': '비릿한 미소', r'(?i)wink': '윙크',
+            r'(?i)shrug': '어깨를 으쓱', r'(?i)nod': '고개를 끄덕', r'(?i)sigh': '한숨',
+            r'(?i)giggle': '킥킥대', r'(?i)gm': '', r'(?i)pc': '', r'(?i)npc': ''
+        }
+        for pat, rep in replacements.items(): text = re.sub(pat, rep, text)
+        text = re.sub(r'\([A-Za-z\s]+\)', '', text)
+        text = re.sub(r'\(|\)', '', text)
+        bad_endings = [
+            r'어떻게 하시겠습니까\?', r'무엇을 하시겠습니까\?', r'선택하시겠습니까\?',
+            r'행동을 선택하세요.', r'당신의 선택은\?'
+        ]
+        for bad in bad_endings: text = re.sub(bad, '', text)
+        text = re.sub(r'\d+\.\s.*', '', text)
+    except: pass
+
+    if len(text) > limit:
+        temp_cut = text[:limit + 100]
+        last_punc = max(temp_cut.rfind('.'), temp_cut.rfind('!'), temp_cut.rfind('?'), temp_cut.rfind('"'))
+        if last_punc > limit * 0.5: text = temp_cut[:last_punc+1]
+        else: text = text[:limit] + "..."
+    return text
+
+def build_round_prompt(snap, sections=None):
+    """지금 대기 중인 입력으로 이번 라운드 프롬프트를 조립 (모델은 안 부름). 생성과 dry run이 같이 씀"""
+    trace_phase("lore_match")
+    pc = snap.get("player_count", 3)
+    limit = int(snap.get("output_limit", 2000))
+
+    pending = snap.get("pending_inputs", {})
     p1_text = pending.get("user1", {}).get("text", "(스킵)")
     p2_text = pending.get("user2", {}).get("text", "(스킵)")
     p3_text = pending.get("user3", {}).get("text", "(스킵)") if pc >= 3 else ""
 
-    u1, u2, u3 = state["profiles"]["user1"], state["profiles"]["user2"], state["profiles"]["user3"]
+    u1, u2, u3 = snap["profiles"]["user1"], snap["profiles"]["user2"], snap["profiles"]["user3"]
     p1_name = u1.get("name", "P1")
     p2_name = u2.get("name", "P2")
     p3_name = u3.get("name", "P3") if pc >= 3 else ""
 
-    last_ai_msg = next((h.replace("**AI**:", "").strip() for h in reversed(state.get("ai_history", [])) if h.startswith("**AI**:")), "")
+    last_ai_msg = next((r.ai_text for r in reversed(snap.get("rounds", ())) if r.ai_text), "")
     merged_for_lore = f"{p1_text} {p2_text} {p3_text} {last_ai_msg}".lower()
-    active_context = [f"[{l.get('title','')}]: {l.get('content','')}" for l in state.get("lorebook", [])
-                      if any(t.strip().lower() in merged_for_lore for t in l.get("triggers","").split(",") if t.strip())][:3]
+    active_context = match_lore(snap.get("lorebook", []), merged_for_lore)
 
     profile_content = f"1. {p1_name} (Bio: {u1.get('bio','')}, Canon: {u1.get('canon','')})\n"
     if pc >= 2: profile_content += f"2. {p2_name} (Bio: {u2.get('bio','')}, Canon: {u2.get('canon','')})\n"
     if pc >= 3: profile_content += f"3. {p3_name} (Bio: {u3.get('bio','')}, Canon: {u3.get('canon','')})\n"
 
-    system_content = build_full_system_content(profile_content, state.get("sys_prompt", ""), active_context, state.get("summary", ""))
+    # 불러오기 예산을 다 써도 최근 기록에 남는 라운드는 빼고 관련 있는 옛 라운드를 불러옴
+    trace_phase("recall")
+    _, window_ids = history_window(snap, HISTORY_SOFT_LIMIT_CHARS - RECALL_BUDGET_CHARS)
+    recall_query = " ".join(t for t in (p1_text, p2_text, p3_text) if t and t != "(스킵)")
+    recalled_ids = []
+    recalled = recall_rounds(recall_query, window_ids, snap, recalled_ids, last_ai_msg[-RECALL_QUERY_AI_TAIL:])
+    history_limit = HISTORY_SOFT_LIMIT_CHARS - sum(len(t) + 1 for t in recalled)
+    history, history_ids = history_window(snap, history_limit)
+    # 예산이 남아 창이 넓어졌으면 창에 들어간 라운드는 불러온 목록에서 뺌 (두 번 넣지 않게)
+    if history_ids & set(recalled_ids):
+        keep = [i for i, rid in enumerate(recalled_ids) if rid not in history_ids]
+        recalled, recalled_ids = [recalled[i] for i in keep], [recalled_ids[i] for i in keep]
+
+    trace_phase("prompt_build")
+    system_content = build_full_system_content(profile_content, snap.get("sys_prompt", ""), active_context, snap.get("summary", ""), snap, recalled, sections)
 
     priority_instruction = (
         "### [URGENT: SLOW MOTION & HIGH DENSITY ENFORCEMENT]\n"
@@ -798,18 +3143,82 @@ def trigger_ai_from_pending():
     if pc >= 3: round_block += f"- {p3_name}: {p3_text}\n"
 
     messages = [{"role": "system", "content": system_content}]
-    for h in build_history_block():
-        messages.append({"role": "assistant" if h.startswith("**AI**") else "user", "content": h})
+    for role, h in history:
+        messages.append({"role": role, "content": h})
     messages.append({"role": "user", "content": round_block + "\n" + priority_instruction})
 
-    current_model = state.get("ai_model", "gemini-3-pro-preview")
-    socketio.emit("status_update", {"msg": f"🤔 {current_model} 집필 중..."})
+    if sections is not None:
+        sections.update({"history": sum(len(h) for _, h in history), "round_block": len(round_block), "priority_instruction": len(priority_instruction)})
 
-    ai_response = ""
-    try:
-        safe_max_tokens = 4000
+    actions = [("user1", p1_name, p1_text)]
+    if pc >= 2: actions.append(("user2", p2_name, p2_text))
+    if pc >= 3: actions.append(("user3", p3_name, p3_text))
+    return {
+        "limit": limit, "actions": actions, "active_context": active_context, "recalled": recalled, "recalled_ids": recalled_ids,
+        "history_limit": history_limit, "history_ids": history_ids, "system_content": system_content,
+        "priority_instruction": priority_instruction, "round_block": round_block, "messages": messages,
+    }
 
-        if "gemini" in current_model.lower() and gemini_model:
+def dry_run_prompt(include_text=False):
+    """모델은 부르지 않고 지금 대기 중인 입력으로 프롬프트를 조립해서 구간별 크기/빠진 라운드/예상 비용을 돌려줌"""
+    snap = current_snapshot()
+    sections = {}
+    prompt = build_round_prompt(snap, sections)
+    preferred = snap.get("ai_model", "gemini-3-pro-preview")
+    routed = route_candidates("narration", preferred)
+    model = routed[0] if routed else preferred
+
+    if model_provider(model) == "gemini":
+        # Gemini는 messages 대신 한 덩어리 프롬프트 (프롤로그 포함, 우선 지시문은 빠짐)
+        text = build_gemini_prompt(prompt["system_content"], prompt["priority_instruction"], [], snap.get("prologue", ""),
+                                   prompt["round_block"], prompt["limit"], snap, prompt["history_limit"])
+        sections["prologue"] = len(snap.get("prologue", ""))
+        sections.pop("priority_instruction", None)
+    else:
+        text = "\n".join(m["content"] for m in prompt["messages"])
+    ratio = len(text) / max(1, estimate_tokens(text, model))
+    breakdown = {name: {"chars": n, "tokens": int(n / ratio)} for name, n in sections.items()}
+
+    prompt_tokens = estimate_tokens(text, model)
+    # 출력은 직전 AI 응답으로 글자당 토큰을 어림 (output_limit 글자를 꽉 채운다고 보고)
+    sample = next((r.ai_text for r in reversed(snap.get("rounds", ())) if r.ai_text), "") or "가" * 100
+    completion_tokens = int(prompt["limit"] * estimate_tokens(sample, model) / len(sample))
+    st = model_stats(model)
+
+    included = set(prompt["history_ids"]) | set(prompt["recalled_ids"])
+    res = {
+        "model": preferred, "routed_model": model, "provider": model_provider(model),
+        "sections": breakdown, "total_chars": len(text), "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+        "token_ratio": "measured" if model in chars_per_token else "estimated",
+        "output_limit": prompt["limit"], "history_limit": prompt["history_limit"],
+        "history_rounds": sorted(prompt["history_ids"]), "recalled_rounds": prompt["recalled_ids"],
+        "dropped_rounds": [r.round_id for r in snap.get("rounds", ()) if r.round_id not in included],
+        "archived_rounds": sum(e.get("count", 0) for e in snap.get("archive", ())),
+        "lore": [c.split("]:", 1)[0].lstrip("[") for c in prompt["active_context"]],
+        "est_cost": round(usage_cost(model, (prompt_tokens, completion_tokens, 0)), 6),
+        "est_latency": {"p50": st["p50"], "p95": st["p95"], "calls": st["calls"]},
+    }
+    if include_text:
+        res["messages"] = prompt["messages"] if res["provider"] == "openai" else [{"role": "user", "content": text}]
+    return res
+
+def generate_round(rid):
+    round_started = time.time()  # 마지막 입력이 들어온 직후
+    # 생성 내내 같은 스냅샷을 읽음 (도중에 state가 바뀌어도 프롬프트가 섞이지 않음)
+    snap = current_snapshot()
+    prompt = build_round_prompt(snap)
+    limit, messages, round_block = prompt["limit"], prompt["messages"], prompt["round_block"]
+    system_content, priority_instruction, history_limit = prompt["system_content"], prompt["priority_instruction"], prompt["history_limit"]
+    if prompt["active_context"]: LORE_ACTIVATIONS.inc(len(prompt["active_context"]))
+    if prompt["recalled"]: print(f"🧠 옛 라운드 {len(prompt['recalled'])}개 불러옴")
+
+    current_model = snap.get("ai_model", "gemini-3-pro-preview")
+    safe_max_tokens = 4000
+    sent_chars = {}  # 모델 -> 실제로 보낸 프롬프트 글자 수 (토큰 추정 보정용)
+
+    def run(model):
+        """(응답, (prompt_tokens, completion_tokens, cached_tokens) or None)"""
+        if model_provider(model) == "gemini":
             # ✅ 기술적으로는 BLOCK_NONE을 유지 (안 그러면 키스나 싸움도 막힘)
             # 하지만 위에서 프롬프트로 [RATING: PG-13]을 걸었기 때문에 AI가 스스로 자제함.
             from google.generativeai.types import HarmCategory, HarmBlockThreshold
@@ -820,115 +3229,126 @@ def trigger_ai_from_pending():
                 HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
             }
 
-            prompt = build_gemini_prompt(system_content, priority_instruction, [], state.get("prologue", ""), round_block, limit)
-            response = gemini_model.generate_content(prompt, safety_settings=safe, generation_config={"max_output_tokens": safe_max_tokens, "temperature": 0.8})
-            ai_response = response.text if response.text else ""
+            gemini_prompt = build_gemini_prompt(system_content, priority_instruction, [], snap.get("prologue", ""), round_block, limit, snap, history_limit)
+            sent_chars[model] = len(gemini_prompt)
+            response = get_gemini(model).generate_content(gemini_prompt, stream=True, safety_settings=safe, generation_config={"max_output_tokens": safe_max_tokens, "temperature": 0.8})
+            try:
+                for _ in response: note_first_token()  # 스트리밍은 첫 토큰 시각을 재려고 (화면엔 다 받은 뒤 한 번에)
+            finally:
+                usage = note_usage(response)  # 차단된 응답은 .text에서 예외라 사용량부터 (입력 토큰은 청구됨)
+            return (response.text or ""), usage
+
+        sent_chars[model] = sum(len(m["content"]) for m in messages)
+        stream = openai_client(model).chat.completions.create(model=model, messages=messages, stream=True, stream_options={"include_usage": True},
+                                                              **openai_token_kwargs(model, safe_max_tokens))
+        parts, usage = [], None
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                note_first_token()
+                parts.append(chunk.choices[0].delta.content)
+            if getattr(chunk, "usage", None) is not None: usage = note_usage(chunk)
+        return "".join(parts), usage
+
+    def announce(model):
+        broadcast_event("status_update", {"msg": f"🤔 {model} 집필 중..."})
 
-        elif client:
-            res = client.chat.completions.create(model="gpt-4o", messages=messages, max_tokens=safe_max_tokens)
-            ai_response = res.choices[0].message.content
+    ai_response = ""
+    usage = None
+    used_model = current_model  # 실제로 호출한 모델 (기록용)
+    started_at = time.time()
+    trace_phase("llm")
+    try:
+        (ai_response, usage), used_model = route_call("narration", run, preferred=current_model, on_select=announce)
+        if usage: observe_token_ratio(used_model, sent_chars.get(used_model), usage[0])
     except Exception as e:
         print(f"🔥 Error: {e}")
+        GENERATION_ERRORS.inc()
         ai_response = "생성 오류. 다시 시도해주세요."
 
     # 후처리 (동일)
-    try:
-        import re
-        replacements = {
-            r'(?i)curtsy': '무릎을 굽혀 인사', r'(?i)smirk': '비릿한 미소', r'(?i)wink': '윙크',
-            r'(?i)shrug': '어깨를 으쓱', r'(?i)nod': '고개를 끄덕', r'(?i)sigh': '한숨',
-            r'(?i)giggle': '킥킥대', r'(?i)gm': '', r'(?i)pc': '', r'(?i)npc': ''
-        }
-        for pat, rep in replacements.items(): ai_response = re.sub(pat, rep, ai_response)
-        ai_response = re.sub(r'\([A-Za-z\s]+\)', '', ai_response)
-        ai_response = re.sub(r'\(|\)', '', ai_response)
-        bad_endings = [
-            r'어떻게 하시겠습니까\?', r'무엇을 하시겠습니까\?', r'선택하시겠습니까\?',
-            r'행동을 선택하세요.', r'당신의 선택은\?'
-        ]
-        for bad in bad_endings: ai_response = re.sub(bad, '', ai_response)
-        ai_response = re.sub(r'\d+\.\s.*', '', ai_response)
-    except: pass
+    trace_phase("post_process")
+    ai_response = postprocess_ai_response(ai_response, limit)
 
-    if len(ai_response) > limit:
-        temp_cut = ai_response[:limit + 100]
-        last_punc = max(temp_cut.rfind('.'), temp_cut.rfind('!'), temp_cut.rfind('?'), temp_cut.rfind('"'))
-        if last_punc > limit * 0.5: ai_response = temp_cut[:last_punc+1]
-        else: ai_response = ai_response[:limit] + "..."
-
-    history_line = f"**Round**: {p1_name}: {p1_text}"
-    if pc >= 2: history_line += f" / {p2_name}: {p2_text}"
-    if pc >= 3: history_line += f" / {p3_name}: {p3_text}"
-    state["ai_history"].append(history_line)
-    state["ai_history"].append(f"**AI**: {ai_response}")
-    state["pending_inputs"] = {}
+    trace_phase("commit")
+    record = RoundRecord(rid, prompt["actions"], ai_response, used_model, usage, started_at, time.time())
+    if not commit_round(rid, record):
+        print(f"⚠️ 라운드 {rid} 결과 폐기 (생성 중에 세션이 초기화됨)")
+        return
+    search_index.add_round(record)
+    ROUND_SECONDS.observe(time.time() - round_started)
+    trace_phase("broadcast")
     save_data()
-    socketio.emit("ai_typewriter_event", {"content": ai_response})
+    broadcast_event("ai_typewriter_event", {"content": ai_response})
     emit_state_to_players()
+    trace_phase("archive")
+    maybe_archive()
 
 # GPT 백업 함수 (필요 시 복구)
 def trigger_gpt_failsafe(messages, limit):
-    if not client: return "AI 생성이 거부되었습니다. (백업 모델 없음)"
-    try:
-        res = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            max_tokens=limit
-        )
+    if not route_candidates("retry", current_snapshot().get("ai_model")): return "AI 생성이 거부되었습니다. (백업 모델 없음)"
+    def run(model):
+        if model_provider(model) == "gemini":
+            response = get_gemini(model).generate_content("\n\n".join(m["content"] for m in messages))
+            note_usage(response)
+            return response.text
+        res = openai_client(model).chat.completions.create(model=model, messages=messages, **openai_token_kwargs(model, limit))
+        note_usage(res)
         return res.choices[0].message.content
+    try:
+        return route_call("retry", run, preferred=current_snapshot().get("ai_model"))[0]
     except:
         return "AI 생성 실패."
 
-@socketio.on("client_message")
-def client_message(data):
-    uid = data.get("uid")
-    text = (data.get("text") or "").strip()
-
-    # 인원수와 상관없이 일단 허용된 유저인지 확인
-    if uid not in ("user1", "user2", "user3") or not state.get("session_started"): return
+def submit_action(uid, text, client_round_id):
+    """client_message / skip_turn 공통: 라운드에 입력을 넣고, 다 모이면 생성은 딱 한 번만"""
+    reject, rid = try_submit(uid, text, client_round_id)
+    if reject:
+        # 거절은 보낸 사람한테만, 쓰던 글은 돌려줌
+        emit("submit_rejected", {"msg": reject, "text": text})
+        return
 
-    record_pending(uid, text)
-    typing_users.discard(uid)
+    cancel_deferred_typing(request.sid)
+    set_typing(uid, False)
     emit_state_to_players()
 
-    if check_all_ready():
-        trigger_ai_from_pending()
+    if rid is not None:
+        trigger_ai_from_pending(rid)
     else:
         # 대기 메시지 전송 로직
-        pc = state.get("player_count", 3)
+        snap = current_snapshot()
+        pc = snap.get("player_count", 3)
         needed = ["user1", "user2", "user3"][:pc]
-        done = state.get("pending_inputs", {}).keys()
+        done = snap.get("pending_inputs", {}).keys()
         not_yet = [u for u in needed if u not in done]
 
-        names = [state["profiles"][u].get("name") or u for u in not_yet]
+        names = [snap["profiles"][u].get("name") or u for u in not_yet]
         msg_str = ", ".join(names)
-        socketio.emit("status_update", {"msg": f"⏳ {msg_str} 입력 대기... (스킵 가능)"})
+        broadcast_event("status_update", {"msg": f"⏳ {msg_str} 입력 대기... (스킵 가능)"})
 
-@socketio.on("skip_turn")
-def skip_turn(data):
+@socketio.on("client_message")
+@traced("client_message")
+def client_message(data):
     uid = data.get("uid")
-    # ✅ user3 포함 검사
-    if uid not in ("user1", "user2", "user3") or not state.get("session_started"): return
+    text = (data.get("text") or "").strip()
 
-    record_pending(uid, "(스킵)")
-    typing_users.discard(uid)
-    emit_state_to_players()
+    # 인원수와 상관없이 일단 허용된 유저인지 확인
+    if uid not in ("user1", "user2", "user3") or not current_snapshot().get("session_started"): return
+    if connected_users.get(uid) != request.sid: return
 
-    # ✅ check_all_ready로 변경
-    if check_all_ready():
-        trigger_ai_from_pending()
-    else:
-        # ✅ 대기 메시지 로직 (위와 동일)
-        needed = ["user1", "user2", "user3"]
-        done = state.get("pending_inputs", {}).keys()
-        not_yet = [u for u in needed if u not in done]
+    submit_action(uid, text, data.get("round_id"))
 
-        names = [state["profiles"][u].get("name") or u for u in not_yet]
-        msg_str = ", ".join(names)
+@socketio.on("skip_turn")
+@traced("skip_turn")
+def skip_turn(data):
+    uid = data.get("uid")
+    # ✅ user3 포함 검사
+    if uid not in ("user1", "user2", "user3") or not current_snapshot().get("session_started"): return
+    if connected_users.get(uid) != request.sid: return
 
-        socketio.emit("status_update", {"msg": f"⏳ {msg_str} 입력 대기... (스킵 가능)"})
+    submit_action(uid, "(스킵)", data.get("round_id"))
 
 @socketio.on("get_scenario_list")
+@traced("get_scenario_list")
 def get_scenario_list(_=None):
     LIB_URL = "https://raw.githubusercontent.com/sou-venir/sou-venir-scenario/refs/heads/main/library.json"
     try:
@@ -939,6 +3359,7 @@ def get_scenario_list(_=None):
         socketio.emit("scenario_list_res", {"success": False, "msg": str(e)})
 
 def import_config_only(data: dict):
+    # state를 직접 바꾸므로 mutate() 안에서만 호출
     # ❌ ai_model, player_count는 여기서 제외했어! 
     # 이제 시나리오를 불러와도 현재 설정된 모델과 인원수는 변하지 않아.
     allow = {
@@ -960,12 +3381,13 @@ def import_config_only(data: dict):
         state["theme"] = copy.deepcopy(data["theme"])
 
 @socketio.on("load_scenario_url")
+@traced("load_scenario_url")
 def load_scenario_url(data):
     url = data.get("url")
     auth_key = data.get("auth_key")
     is_adult = data.get("is_adult", False)
 
-    socketio.emit("status_update", {"msg": "⏳ 파일 다운로드 중..."})
+    broadcast_event("status_update", {"msg": "⏳ 파일 다운로드 중..."})
 
     try:
         # 1. 서버 키 가져오기 & 공백 제거(빗자루질)
@@ -985,35 +3407,36 @@ def load_scenario_url(data):
         # 3. 성인 시나리오 처리
         if is_adult:
             if not auth_key or auth_key != real_key:
-                socketio.emit("status_update", {"msg": "❌ 비밀번호가 틀렸습니다."})
+                broadcast_event("status_update", {"msg": "❌ 비밀번호가 틀렸습니다."})
                 return
             
             scenario_data = simple_decrypt(raw_text, auth_key)
             if not scenario_data:
-                socketio.emit("status_update", {"msg": "❌ 파일 해독 실패! (파일이 손상됐거나 암호화 도구를 안 썼어)"})
+                broadcast_event("status_update", {"msg": "❌ 파일 해독 실패! (파일이 손상됐거나 암호화 도구를 안 썼어)"})
                 return
         else:
             # 일반 시나리오
             scenario_data = json.loads(raw_text)
 
         # 4. 데이터 적용 (초기화)
-        state["ai_history"] = []
-        state["pending_inputs"] = {}
-        state["session_started"] = False
-        
-        import_config_only(scenario_data)
+        def apply():
+            reset_round()
+            clear_history()
+            state["session_started"] = False
+            import_config_only(scenario_data)
+        mutate(apply)
 
         # 5. 테마 분석 및 저장
-        socketio.emit("status_update", {"msg": "🎨 테마 분석 중..."})
-        combined = state.get("sys_prompt", "") + "\n" + state.get("prologue", "")
-        state["theme"] = analyze_theme_color(state.get("session_title", ""), combined)
+        broadcast_event("status_update", {"msg": "🎨 테마 분석 중..."})
+        snap = current_snapshot()
+        combined = snap.get("sys_prompt", "") + "\n" + snap.get("prologue", "")
+        set_theme(analyze_theme_color(snap.get("session_title", ""), combined))
 
-        save_data()
         emit_state_to_players()
-        socketio.emit("status_update", {"msg": "✅ 로드 완료!"})
+        broadcast_event("status_update", {"msg": "✅ 로드 완료!"})
 
     except Exception as e:
-        socketio.emit("status_update", {"msg": f"❌ 오류: {str(e)}"})
+        broadcast_event("status_update", {"msg": f"❌ 오류: {str(e)}"})
         
 # =========================
 # HTML Template
@@ -1180,6 +3603,7 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
     .center-ai .name-tag { font-weight:900; color:var(--accent); }
 
     .typing-anim{animation:blink 1.4s infinite;}
+    .load-more{align-self:center;background:transparent!important;color:#999!important;border:1px solid rgba(0,0,0,0.1)!important;font-size:12px;padding:6px 14px;}
     @keyframes blink{50%{opacity:.45;}}
 
     /* [추가] 글자수 카운터 스타일 */
@@ -1385,6 +3809,7 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
 
     <div id="input-area" style="padding:20px;background:var(--bg);">
       <div id="status" style="font-size:12px;margin-bottom:5px;color:var(--accent);font-weight:bold;">대기 중</div>
+      <div id="typing-indicator" class="typing-anim" style="font-size:11px;min-height:14px;margin-bottom:4px;color:#888;"></div>
 
       <div class="input-row" style="display:flex;gap:10px;align-items:stretch;">
         <textarea id="msg-input" maxlength="600" placeholder="프로필 설정을 완료하고 마스터가 세션을 시작할 때까지 대기해주세요." disabled></textarea>
@@ -1435,6 +3860,13 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
       <!-- //profile-wrap 끝 -->
 
       <button onclick="saveProfile()" id="ready-btn">설정 저장</button>
+
+      <label style="margin-top:14px;">기록 검색</label>
+      <div style="display:flex;gap:4px;">
+        <input type="text" id="search-input" maxlength="100" placeholder="라운드/키워드 검색" onkeydown="if(event.key==='Enter') runSearch()">
+        <button class="mini-btn" onclick="runSearch()" style="width:auto;">검색</button>
+      </div>
+      <div id="search-results" style="font-size:12px;max-height:240px;overflow-y:auto;"></div>
     </div>
 
     <div id="sidebar-footer">
@@ -1450,6 +3882,7 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
           <button class="tab-btn" onclick="openTab(event,'t-story')">서사</button>
           <button class="tab-btn" onclick="openTab(event,'t-ex')">학습</button>
           <button class="tab-btn" onclick="openTab(event,'t-lore')">키워드</button>
+          <button class="tab-btn" onclick="openTab(event,'t-mon'); refreshMonitor();">모니터</button>
         </div>
         <button onclick="closeModal()" class="close-btn">✕</button>
       </div>
@@ -1480,6 +3913,9 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
                     <a href="/export" style="flex:1; display:block;">
                         <button style="width:100%; background:#444!important;" class="mini-btn">백업</button>
                     </a>
+                    <a href="/export_history" style="flex:1; display:block;">
+                        <button style="width:100%; background:#555!important;" class="mini-btn">기록 내보내기</button>
+                    </a>
                     <!-- 불러오기 버튼도 flex:1 -->
                     <button onclick="document.getElementById('import-file').click()" style="flex:1; background:#666!important;" class="mini-btn">불러오기</button>
                     <input type="file" id="import-file" style="display:none;" onchange="uploadSessionFile(this)">
@@ -1494,7 +3930,13 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
                     <option value="gpt-4o">OpenAI GPT-4o</option>
                     <option value="gemini-3-pro-preview">Google Gemini 3 Pro</option>
                     <option value="gemini-3-flash-preview">Google Gemini 3 flash</option>
+                    {% if show_fake_models %}
+                    <option value="fake-openai">테스트용 가짜 모델 (OpenAI 형식)</option>
+                    <option value="fake-gemini">테스트용 가짜 모델 (Gemini 형식)</option>
+                    {% endif %}
+                    {% for alias, m in provider_models.items() %}<option value="{{ alias }}">{{ alias }} ({{ m.provider }}: {{ m.model }})</option>{% endfor %}
                 </select>
+                <label style="font-weight:normal;"><input type="checkbox" id="m-provider-switch" style="width:auto;"> 막히면 다른 공급자 모델로도 넘어가기 (OpenAI ↔ Gemini, 서술 톤이 바뀔 수 있음)</label>
 
                 <label>플레이 모드</label>
                 <select id="m-player-count" onchange="updateAdminBtnVisibility()">
@@ -1595,6 +4037,55 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
             <div id="lore-list" style="flex:1; overflow-y:auto; display:flex; flex-direction:column; gap:8px;"></div>
           </div>
         </div>
+
+        <!-- 모니터 탭 -->
+        <div id="t-mon" class="tab-content">
+          <div class="editor-side">
+            <label style="display:flex;justify-content:space-between;align-items:center;">접속 소켓 송신 대기열 <button onclick="refreshMonitor()" class="mini-btn">새로고침</button></label>
+            <div id="mon-outbound" style="font-size:12px;font-family:monospace;white-space:pre;overflow-x:auto;"></div>
+            <label style="margin-top:10px;">변경 없는 저장/전송 생략</label>
+            <div id="mon-dirty" style="font-size:12px;font-family:monospace;white-space:pre;"></div>
+            <label style="margin-top:10px;">모델 라우팅 (모델별 최근 50회 기준)</label>
+            <div id="mon-router" style="font-size:12px;font-family:monospace;white-space:pre;overflow-x:auto;"></div>
+            <label style="margin-top:10px;">토큰 사용량 / 예상 비용 (USD, 가격표 기준)</label>
+            <div id="mon-usage" style="font-size:12px;font-family:monospace;white-space:pre;overflow-x:auto;"></div>
+            <label style="margin-top:10px;display:flex;justify-content:space-between;align-items:center;">프롬프트 점검 (모델 호출 없이 지금 입력으로 조립)
+              <span><input type="checkbox" id="dry-text" style="width:auto;"> 본문 <button onclick="socket.emit('dry_run_prompt', {include_text: document.getElementById('dry-text').checked})" class="mini-btn">점검</button></span>
+            </label>
+            <div id="mon-dryrun" style="font-size:12px;font-family:monospace;white-space:pre-wrap;overflow-x:auto;"></div>
+            <label style="margin-top:10px;">세션 녹화 (들어온 이벤트 + 모델 응답 → tools/replay.py로 재생)</label>
+            <div style="display:flex;gap:4px;flex-wrap:wrap;align-items:center;font-size:12px;">
+              <input type="checkbox" id="rec-redact" style="width:auto;"> 프로필 bio/canon 가리기
+              <button class="mini-btn" onclick="socket.emit('start_recording', {redact_bios: document.getElementById('rec-redact').checked})">녹화 시작</button>
+              <button class="mini-btn" onclick="socket.emit('stop_recording')">녹화 중지</button>
+            </div>
+            <div id="mon-recording" style="font-size:12px;font-family:monospace;white-space:pre;overflow-x:auto;"></div>
+            <label style="margin-top:10px;">프로파일링 (다음 N초 또는 N라운드)</label>
+            <div style="display:flex;gap:4px;flex-wrap:wrap;align-items:center;font-size:12px;">
+              <select id="prof-mode" style="width:auto;"><option value="sample">sample (전체 스레드)</option><option value="cprofile">cProfile</option></select>
+              <input id="prof-seconds" type="number" placeholder="초" style="width:60px;">
+              <input id="prof-rounds" type="number" placeholder="라운드" style="width:60px;">
+              <button class="mini-btn" onclick="profileStart()">시작</button>
+              <button class="mini-btn" onclick="debugCall('POST', '/debug/profile/stop')">중지</button>
+              <button class="mini-btn" onclick="debugDownload('/debug/profile/download?format=' + (document.getElementById('prof-mode').value === 'sample' ? 'collapsed' : 'pstats'))">받기</button>
+              <button class="mini-btn" onclick="debugDownload('/debug/profile/download?format=txt')">요약</button>
+            </div>
+            <div style="display:flex;gap:4px;flex-wrap:wrap;margin-top:4px;font-size:12px;">
+              <button class="mini-btn" onclick="debugCall('POST', '/debug/memory/start')">메모리 기준점</button>
+              <button class="mini-btn" onclick="debugDownload('/debug/memory/diff?top=30')">메모리 증가분 받기</button>
+              <button class="mini-btn" onclick="debugCall('POST', '/debug/memory/stop')">tracemalloc 끄기</button>
+            </div>
+            <div id="mon-profile" style="font-size:12px;font-family:monospace;white-space:pre;overflow-x:auto;"></div>
+            <label style="margin-top:10px;display:flex;justify-content:space-between;align-items:center;">최근 트레이스
+              <select id="mon-trace-filter" onchange="socket.emit('get_traces', {name: this.value})" style="width:auto;">
+                <option value="round">라운드만</option>
+                <option value="">전체</option>
+              </select>
+            </label>
+            <div id="mon-traces" style="font-size:12px;font-family:monospace;white-space:pre;overflow-x:auto;"></div>
+          </div>
+          <div class="list-side"></div>
+        </div>
       </div> <!-- /.modal-body -->
 <script>
 {% raw %}
@@ -1604,9 +4095,22 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
   let tags = [];
   let sortable = null;
   let isTypewriter = false;
-  let editingIdx = -1;
+  let editingRound = -1; // 수정 중인 라운드 id
   let currentLibrary = [];
   let isRefusedMode = false; // 중복 선언 제거됨
+  let lastSeq = 0;          // 마지막으로 받은 브로드캐스트 seq (재접속 시 이어받기용)
+  let serverEpoch = null;
+  // 채팅 렌더링 캐시: key -> 말풍선 노드 (바뀐 메시지만 다시 그림)
+  const chatNodes = new Map();
+  const mdCache = new Map();
+  const MD_CACHE_MAX = 600;
+  const CHAT_WINDOW_DEFAULT = 40; // 긴 세션은 최근 N라운드만 DOM에 올려둠
+  const CHAT_WINDOW_STEP = 20;
+  let chatWindowSize = CHAT_WINDOW_DEFAULT;
+  let archivedRounds = [];   // 서버 보관함에서 불러온 옛 라운드 (오래된 순)
+  let archiveTotal = 0;      // 서버에 보관된 라운드 수 (바뀌면 불러온 것 버림)
+  let archiveLoading = false;
+  let typewriterNode = null;
   function toggleSidebar() {
     const sb = document.getElementById('sidebar');
     const ov = document.getElementById('mobile-overlay');
@@ -1623,8 +4127,15 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
     return id;
   }
   socket.on('connect', () => {
-    socket.emit('join_game', { client_id: getClientId() });
+    socket.emit('join_game', { client_id: getClientId(), last_seq: lastSeq, epoch: serverEpoch });
   });
+  // 이미 받은 seq면 true (재접속 재전송과 겹칠 때 중복 방지)
+  function seenSeq(d){
+    if(!d || !d.seq) return false;
+    if(d.seq <= lastSeq) return true;
+    lastSeq = d.seq;
+    return false;
+  }
 
   // [2] 역할 할당
   socket.on('assign_role', payload => {
@@ -1649,6 +4160,7 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
 
   // [3] 상태 및 채팅 업데이트
   socket.on('status_update', d => {
+    if(seenSeq(d)) return;
     const s = document.getElementById('status');
     if(gState && gState.session_started){
         s.innerHTML = d.msg;
@@ -1657,6 +4169,16 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
     }
   });
 
+  // 라운드가 이미 넘어갔거나 집필 중이라 입력이 거절됨: 쓰던 글 되돌려놓기
+  socket.on('submit_rejected', d => {
+    const msg = document.getElementById('msg-input');
+    if(d.text && d.text !== "(스킵)" && !msg.value) msg.value = d.text;
+    refreshUI();
+    const s = document.getElementById('status');
+    s.innerHTML = d.msg;
+    s.style.color = 'red';
+  });
+
   socket.on('ai_generation_failed', () => {
     isRefusedMode = true; // 이 변수는 상단에 let isRefusedMode = false;로 선언해둬!
 
@@ -1671,12 +4193,14 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
   });
 
   socket.on('ai_typewriter_event', d => {
+    if(seenSeq(d)) return;
     isTypewriter = true;
     const cc = document.getElementById('chat-content');
     const wrap = document.createElement('div');
     wrap.className = 'bubble center-ai';
     wrap.innerHTML = `<div class="name-tag">AI</div>`;
     cc.appendChild(wrap);
+    typewriterNode = wrap;
     const full = d.content || "";
     let i = 0;
     const tick = setInterval(()=>{
@@ -1684,11 +4208,16 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
       if(i > full.length) i = full.length;
       wrap.innerHTML = `<div class="name-tag">AI</div>` + mdToSafeHtml(full.slice(0, i));
       document.getElementById('chat-window').scrollTop = document.getElementById('chat-window').scrollHeight;
-      if(i >= full.length){ clearInterval(tick); isTypewriter = false; refreshUI(); }
+      if(i >= full.length){
+        clearInterval(tick); isTypewriter = false;
+        wrap.remove(); typewriterNode = null;
+        refreshUI();
+      }
     }, 20);
   });
 
-  socket.on('typing_update', d => refreshUI());
+  // 입력 중 표시는 채팅창을 건드리지 않고 작은 표시줄만 갱신
+  socket.on('typing_update', d => { if(!seenSeq(d)) renderTypingIndicator(d.typing_users || []); });
 
   // [4] 관리자 및 설정
   socket.on('admin_auth_res', d => {
@@ -1704,7 +4233,12 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
   });
 
   socket.on('initial_state', data => {
+    // 스냅샷은 몇 번 받아도 같으니 중복 검사 없이 seq만 따라감
+    if(data.epoch !== serverEpoch){ serverEpoch = data.epoch; lastSeq = data.seq || 0; }
+    else lastSeq = Math.max(lastSeq, data.seq || 0);
     gState = data;
+    const total = (data.archive || []).reduce((n, e) => n + e.count, 0);
+    if(total !== archiveTotal){ archiveTotal = total; archivedRounds = []; }
     if(data.theme){
       const root = document.documentElement.style;
       root.setProperty('--bg', data.theme.bg);
@@ -1714,6 +4248,119 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
     if(!isTypewriter) refreshUI();
   });
 
+  socket.on('outbound_stats_res', d => {
+    const rows = (d.sockets || []).map(q => `${q.sid}  ${q.role.padEnd(8)}  대기 ${q.depth}  전송중 ${q.backlog}  보냄 ${q.sent}  버린 스냅샷 ${q.dropped_snapshots}`);
+    document.getElementById('mon-outbound').textContent = rows.join("\n") || "접속한 소켓 없음";
+    const dz = d.dirty || {};
+    document.getElementById('mon-dirty').textContent =
+      `변경 명령 ${dz.mutations||0} (변화 없음 ${dz.noop_mutations||0})\n` +
+      `저장 ${dz.saves||0} (생략 ${dz.saves_skipped||0})\n` +
+      `전송 ${dz.emits||0} (생략 ${dz.emits_skipped||0})`;
+  });
+  function refreshMonitor(){
+    socket.emit('get_outbound_stats'); socket.emit('get_router_stats'); socket.emit('get_usage_stats'); socket.emit('get_recording_status');
+    debugCall('GET', '/debug/profile');
+    socket.emit('get_traces', {name: document.getElementById('mon-trace-filter').value});
+  }
+  function showProfileStatus(d){
+    const fmt = c => c ? `${c.mode}  라운드 ${c.rounds}${c.rounds_target ? '/' + c.rounds_target : ''}  샘플 ${c.samples}  호출 ${c.calls}${c.skipped ? ` (겹쳐서 건너뜀 ${c.skipped})` : ''}` : '없음';
+    document.getElementById('mon-profile').textContent =
+      `수집 중: ${d.running ? fmt(d.running) + `  (${d.running.remaining_s}s 남음)` : '없음'}\n마지막 결과: ${fmt(d.last)}\ntracemalloc: ${d.tracemalloc ? '켜짐' : '꺼짐'}`;
+  }
+  function debugCall(method, url){
+    fetch(url, {method, headers: {'X-Admin-Password': adminPw}})
+      .then(r => r.ok || r.status === 409 ? r.json() : Promise.reject(r.status))
+      .then(d => { if(d.msg) alert(d.msg); if(d.running !== undefined) showProfileStatus(d); })
+      .catch(e => { document.getElementById('mon-profile').textContent = '요청 실패: ' + e; });
+  }
+  function profileStart(){
+    const q = new URLSearchParams({mode: document.getElementById('prof-mode').value});
+    const sec = document.getElementById('prof-seconds').value, rnd = document.getElementById('prof-rounds').value;
+    if(sec) q.set('seconds', sec);
+    if(rnd) q.set('rounds', rnd);
+    debugCall('POST', '/debug/profile/start?' + q);
+  }
+  function debugDownload(url){
+    fetch(url, {headers: {'X-Admin-Password': adminPw}}).then(async r => {
+      if(!r.ok) { alert(await r.text()); return; }
+      const name = (r.headers.get('Content-Disposition') || '').split('filename=')[1] || 'memory_diff.txt';
+      const a = document.createElement('a');
+      a.href = URL.createObjectURL(await r.blob());
+      a.download = name;
+      a.click();
+      URL.revokeObjectURL(a.href);
+    });
+  }
+  socket.on('recording_status', d => {
+    const el = document.getElementById('mon-recording');
+    el.textContent = d.recording ? `⏺️ 녹화 중: ${d.path}  이벤트 ${d.events}  클라이언트 ${d.clients}\n` : '녹화 안 함\n';
+    (d.files || []).slice().reverse().forEach(name => {
+      const b = document.createElement('button');
+      b.className = 'mini-btn';
+      b.textContent = '⬇ ' + name;
+      b.onclick = () => debugDownload('/debug/recording/' + encodeURIComponent(name));
+      el.appendChild(b);
+    });
+  });
+  socket.on('dry_run_res', d => {
+    const names = {system_rules: '시스템 규칙', scenario: '시나리오', characters: '캐릭터', lore: '로어북', recalled: '불러온 옛 라운드',
+                   summary: '요약', history: '최근 기록', round_block: '이번 라운드 입력', priority_instruction: '우선 지시문', prologue: '프롤로그'};
+    const ids = a => a.length ? (a.length > 12 ? a.slice(0, 5).join(',') + ` … ${a.slice(-5).join(',')}` : a.join(',')) + ` (${a.length})` : '없음';
+    const sec = Object.entries(d.sections).sort((a, b) => b[1].chars - a[1].chars).map(([k, v]) =>
+      `  ${(names[k] || k).padEnd(12)} ${String(v.chars).padStart(7)}자 ${String(v.tokens).padStart(7)}토큰  ${'█'.repeat(Math.round(v.chars / Math.max(1, d.total_chars) * 30))}`);
+    const lat = d.est_latency.p50 != null ? `p50 ${d.est_latency.p50.toFixed(1)}s / p95 ${d.est_latency.p95.toFixed(1)}s (최근 ${d.est_latency.calls}회)` : '기록 없음';
+    const out = [
+      `모델 ${d.model}${d.routed_model !== d.model ? ' → 라우터가 ' + d.routed_model : ''} (${d.provider})`,
+      `합계 ${d.total_chars}자 ≈ 입력 ${d.prompt_tokens}토큰 + 출력 최대 ${d.completion_tokens}토큰 (${d.token_ratio === 'measured' ? '실측 비율' : '어림셈'})`,
+      `예상 비용 $${d.est_cost.toFixed(4)}   예상 지연 ${lat}`, '', ...sec, '',
+      `최근 기록 예산 ${d.history_limit}자 / 출력 제한 ${d.output_limit}자`,
+      `들어간 라운드 ${ids(d.history_rounds)}`, `불러온 옛 라운드 ${ids(d.recalled_rounds)}`,
+      `빠진 라운드 ${ids(d.dropped_rounds)}  + 보관함 ${d.archived_rounds}개`, `켜진 로어 ${d.lore.join(', ') || '없음'}`,
+    ];
+    if (d.messages) d.messages.forEach(m => out.push('', `──── ${m.role} (${m.content.length}자) ────`, m.content));
+    document.getElementById('mon-dryrun').textContent = out.join("\n");
+  });
+  socket.on('usage_stats_res', d => {
+    // 합계 행: [이름, 호출, 입력, 출력, 캐시, 비용]
+    const usd = v => '$' + v.toFixed(4);
+    const row = r => `${String(r[0]).slice(0, 24).padEnd(24)} 호출 ${String(r[1]).padStart(4)}  입력 ${String(r[2]).padStart(8)}  출력 ${String(r[3]).padStart(7)}  캐시 ${String(r[4]).padStart(7)}  ${usd(r[5])}`;
+    const t = d.today || [0, 0, 0, 0, 0];
+    const out = [`오늘: 호출 ${t[0]}  입력 ${t[1]}  출력 ${t[2]}  캐시 ${t[3]}  ${usd(t[4])}`];
+    out.push("\n날짜별", ...(d.days || []).map(row));
+    out.push("\n모델별", ...(d.models || []).map(row));
+    out.push("\n세션(시나리오)별", ...(d.sessions || []).map(row));
+    out.push("\n이번 세션 라운드별 (최근 호출 기준)", ...(d.rounds || []).map(r =>
+      `#${String(r.round_id).padEnd(5)} 호출 ${r.calls}  입력 ${String(r.prompt).padStart(7)}  출력 ${String(r.completion).padStart(6)}  캐시 ${String(r.cached).padStart(6)}  ${usd(r.cost)}  ${r.latency}s`));
+    out.push("\n최근 호출", ...(d.recent || []).map(c =>
+      `${c.ts} ${c.task.padEnd(9)} ${c.model.padEnd(22)} ${c.ok ? '' : '❌ '}입력 ${c.usage[0]} 출력 ${c.usage[1]} 캐시 ${c.usage[2]}  ${c.latency}s  ${usd(c.cost)}`));
+    document.getElementById('mon-usage').textContent = out.join("\n");
+  });
+  socket.on('traces_res', d => {
+    // 트레이스마다 단계를 들여쓰기 + 막대로 (폭 40칸 = 트레이스 전체 시간)
+    const out = [];
+    (d.traces || []).forEach(t => {
+      out.push(`${t.ts} ${t.name}${t.round_id != null ? ' #' + t.round_id : ''}  ${t.dur_ms}ms${t.error ? ' ❌ ' + t.error : ''}`);
+      const depth = {};
+      (t.spans || []).forEach(sp => {
+        depth[sp.id] = sp.parent == null ? 0 : depth[sp.parent] + 1;
+        const scale = 40 / Math.max(t.dur_ms, 1);
+        const bar = ' '.repeat(Math.round(sp.start_ms * scale)) + '█'.repeat(Math.max(1, Math.round((sp.dur_ms || 0) * scale)));
+        const attrs = sp.attrs ? ' ' + Object.entries(sp.attrs).map(([k, v]) => `${k}=${v}`).join(' ') : '';
+        out.push(`  ${('  '.repeat(depth[sp.id]) + sp.name).padEnd(18)} ${String(sp.dur_ms).padStart(9)}ms ${bar.padEnd(41)}${attrs}${sp.error ? ' ❌ ' + sp.error : ''}`);
+      });
+    });
+    document.getElementById('mon-traces').textContent =
+      `샘플링: 라운드 ${Math.round(d.round_sample_rate*100)}% / 소켓 이벤트 ${Math.round(d.sample_rate*100)}%\n\n` + (out.join("\n") || "기록 없음");
+  });
+  socket.on('router_stats_res', d => {
+    const ms = v => v == null ? '   -  ' : (v.toFixed(2) + 's').padStart(6);
+    const rows = (d.models || []).map(m =>
+      `${m.model.padEnd(24)} ${m.tier.padEnd(8)} ${m.available ? '' : '(키 없음) '}호출 ${m.calls}  p50 ${ms(m.p50)}  p95 ${ms(m.p95)}  오류 ${Math.round(m.error_rate*100)}%${m.cooldown > 0 ? `  휴식 ${m.cooldown}s` : ''}`);
+    const dec = (d.decisions || []).map(x =>
+      `${x.ts} ${x.task.padEnd(9)} → ${x.model} (${x.reason})${x.provider_switch ? ' ⚠️ 공급자 바뀜 ' + x.provider_switch : ''}${x.latency != null ? ' ' + x.latency + 's' : ''}${x.error ? ' ❌ ' + x.error : ''}`);
+    document.getElementById('mon-router').textContent = rows.join("\n") + "\n\n최근 결정\n" + (dec.join("\n") || "없음");
+  });
+
   // [5] 시나리오 라이브러리
   socket.on('scenario_list_res', (res) => {
     if(res.success) {
@@ -1738,6 +4385,7 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
   });
 
   socket.on('reload_signal', payload => {
+    if(seenSeq(payload)) return;
     if(payload && payload.clear_uuid) localStorage.removeItem('dream_client_id');
     window.location.reload();
   });
@@ -1793,50 +4441,9 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
         else msg.placeholder = "행동을 입력하세요...";
     }
 
-    // 3. Chat Rendering
-    const cc = document.getElementById('chat-content');
-    let html = `<div style="text-align:center;padding:20px;color:var(--accent);font-weight:bold;font-size:1.4em;">${gState.session_title}</div>`;
-    html += `<div class="bubble center-ai"><div class="name-tag">PROLOGUE</div>${mdToSafeHtml(replacePlaceholders(gState.prologue||""))}</div>`;
-
-    (gState.ai_history||[]).forEach((m, idx) => {
-      if(idx === editingIdx) {
-        let rawText = m.startsWith("**AI**:") ? m.replace("**AI**:","").trim() : m;
-        html += `<div class="bubble center-ai" style="width:90%;"><div class="name-tag">EDIT MODE</div><div class="edit-mode-wrap"><textarea id="edit-area-${idx}" class="edit-mode-textarea">${rawText}</textarea><div class="edit-actions"><button class="mini-btn" style="background:#888" onclick="cancelEdit()">취소</button><button class="mini-btn" style="background:var(--accent);color:#fff" onclick="saveEdit(${idx})">저장</button></div></div></div>`;
-        return;
-      }
-      if(m.startsWith("**AI**:")){
-        html += `<div class="bubble center-ai"><div class="name-tag">AI <button class="edit-btn" onclick="startEdit(${idx})">수정</button></div>${mdToSafeHtml(replacePlaceholders(m.replace("**AI**:","").trim()))}</div>`;
-      } else if(m.startsWith("**Round**:")){
-        let roundHtml = "";
-        m.replace("**Round**:", "").trim().split(" / ").forEach(p => {
-            const sep = p.indexOf(":");
-            if(sep > -1){
-                const name = p.substring(0, sep).trim();
-                const isMe = (myRole !== 'readonly') && (name === gState.profiles[myRole]?.name);
-                roundHtml += `<div class="bubble ${isMe?"align-right":"align-left"}"><div class="name-tag">${name}</div>${mdToSafeHtml(p.substring(sep+1).trim())}</div>`;
-            } else roundHtml += `<div class="bubble align-left">${mdToSafeHtml(p)}</div>`;
-        });
-        html += roundHtml;
-      } else {
-        html += `<div class="bubble align-left">${mdToSafeHtml(m)}</div>`;
-      }
-    });
-
-    let pendingMsgs = [];
-    if(gState.pending_inputs){
-        Object.keys(gState.pending_inputs).forEach(uid => {
-            if(gState.pending_inputs[uid]?.text) pendingMsgs.push({uid:uid, text:gState.pending_inputs[uid].text, ts:gState.pending_inputs[uid].ts||""});
-        });
-    }
-    pendingMsgs.sort((a,b)=>(a.ts<b.ts?-1:1)).forEach(msg=>{
-        const isMe=(msg.uid===myRole);
-        html += `<div class="bubble ${isMe?"align-right":"align-left"}"><div class="name-tag">${gState.profiles[msg.uid].name}</div>${mdToSafeHtml(msg.text)}</div>`;
-    });
-
-    if(cc.innerHTML !== html) {
-        cc.innerHTML = html;
-        if(editingIdx === -1) document.getElementById('chat-window').scrollTop = document.getElementById('chat-window').scrollHeight;
-    }
+    // 3. Chat Rendering (바뀐 말풍선만 패치)
+    renderChat();
+    renderTypingIndicator(gState.typing_status || []);
 
     // 4. Profile Sync (입력 보호 적용)
     // 4. Profile Sync (강력한 입력 보호: 작성 중인 내용 절대 지키기)
@@ -1890,6 +4497,7 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
     document.getElementById('m-output-limit').value = gState.output_limit || 2000;
     document.getElementById('val-output-limit').innerText = gState.output_limit || 2000;
     document.getElementById('m-ai-model').value = gState.ai_model || "gpt-5.2";
+    document.getElementById('m-provider-switch').checked = !!gState.allow_provider_switch;
     if(activeId !== 'm-player-count') document.getElementById('m-player-count').value = (gState.player_count || (gState.solo_mode?1:3));
 
     if(gState.examples){
@@ -1904,6 +4512,165 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
     renderLoreList();
   }
 
+  // 채팅 항목 목록을 만들고 key 기준으로 기존 노드와 비교해서 필요한 것만 갱신
+  function buildChatItems(){
+    const items = [];
+    const rounds = archivedRounds.concat(gState.rounds || []);
+    const start = Math.max(0, rounds.length - chatWindowSize);
+    const archivedLeft = archiveTotal - archivedRounds.length;
+
+    if(start > 0){
+      items.push({key: 'load-more', cls: 'load-more-wrap', sig: 'more:' + start,
+        html: () => `<button class="load-more" onclick="loadMoreChat()">이전 라운드 ${start}개 더 보기</button>`});
+    } else if(archivedLeft > 0){
+      items.push({key: 'load-more', cls: 'load-more-wrap', sig: 'arch:' + archivedLeft,
+        html: () => `<button class="load-more" onclick="loadArchivedChat()">보관된 이전 라운드 ${archivedLeft}개 불러오기</button>`});
+    } else {
+      const title = gState.session_title || "";
+      items.push({key: 'title', cls: '', sig: 'title:' + title,
+        html: () => `<div style="text-align:center;padding:20px;color:var(--accent);font-weight:bold;font-size:1.4em;">${title}</div>`});
+      const pro = replacePlaceholders(gState.prologue || "");
+      items.push({key: 'prologue', cls: 'bubble center-ai', sig: 'pro:' + pro,
+        html: () => `<div class="name-tag">PROLOGUE</div>${mdCached(pro)}`});
+    }
+
+    for(let idx = start; idx < rounds.length; idx++){
+      const r = rounds[idx];
+      (r.actions || []).forEach((a, j) => {
+        const isMe = (myRole !== 'readonly') && (a.uid ? a.uid === myRole : a.name === gState.profiles[myRole]?.name);
+        const cls = 'bubble ' + (isMe ? "align-right" : "align-left");
+        const key = 'r-' + r.id + '-' + j;
+        if(a.name){
+          items.push({key, cls, sig: cls + '|' + a.name + '|' + a.text,
+            html: () => `<div class="name-tag">${a.name}</div>${mdCached(a.text)}`});
+        } else {
+          items.push({key, cls: 'bubble align-left', sig: 'raw:' + a.text, html: () => mdCached(a.text)});
+        }
+      });
+      if(r.id === editingRound) {
+        items.push({key: 'r-' + r.id + '-ai', cls: 'bubble center-ai', style: 'width:90%;', sig: 'edit:' + r.ai,
+          html: () => `<div class="name-tag">EDIT MODE</div><div class="edit-mode-wrap"><textarea id="edit-area-${r.id}" class="edit-mode-textarea">${r.ai}</textarea><div class="edit-actions"><button class="mini-btn" style="background:#888" onclick="cancelEdit()">취소</button><button class="mini-btn" style="background:var(--accent);color:#fff" onclick="saveEdit(${r.id})">저장</button></div></div>`});
+      } else if(r.ai){
+        const body = replacePlaceholders(r.ai);
+        const editBtn = idx < archivedRounds.length ? '' : ` <button class="edit-btn" onclick="startEdit(${r.id})">수정</button>`;  // 보관된 라운드는 수정 불가
+        items.push({key: 'r-' + r.id + '-ai', cls: 'bubble center-ai', sig: 'ai:' + (editBtn ? '' : 'ro:') + body,
+          html: () => `<div class="name-tag">AI${editBtn}</div>${mdCached(body)}`});
+      }
+    }
+
+    let pendingMsgs = [];
+    if(gState.pending_inputs){
+        Object.keys(gState.pending_inputs).forEach(uid => {
+            if(gState.pending_inputs[uid]?.text) pendingMsgs.push({uid:uid, text:gState.pending_inputs[uid].text, ts:gState.pending_inputs[uid].ts||""});
+        });
+    }
+    pendingMsgs.sort((a,b)=>(a.ts<b.ts?-1:1)).forEach(msg=>{
+        const isMe = (msg.uid===myRole);
+        const cls = 'bubble ' + (isMe ? "align-right" : "align-left");
+        const name = gState.profiles[msg.uid].name;
+        items.push({key: 'pending-' + msg.uid, cls, sig: cls + '|' + name + '|' + msg.text,
+          html: () => `<div class="name-tag">${name}</div>${mdCached(msg.text)}`});
+    });
+    return items;
+  }
+
+  function renderChat(keepScroll = false){
+    const cc = document.getElementById('chat-content');
+    const cw = document.getElementById('chat-window');
+    const items = buildChatItems();
+    const wanted = new Set(items.map(it => it.key));
+    let changed = false;
+
+    for(const [key, el] of chatNodes){
+      if(!wanted.has(key)){ el.remove(); chatNodes.delete(key); changed = true; }
+    }
+
+    const prevHeight = cw.scrollHeight;
+    let prev = null;
+    items.forEach(it => {
+      let el = chatNodes.get(it.key);
+      if(!el){ el = document.createElement('div'); chatNodes.set(it.key, el); }
+      if(el._sig !== it.sig){
+        el.className = it.cls;
+        el.style.cssText = it.style || "";
+        el.innerHTML = it.html();
+        el._sig = it.sig;
+        changed = true;
+      }
+      const expected = prev ? prev.nextSibling : cc.firstChild;
+      if(expected !== el){ cc.insertBefore(el, expected); changed = true; }
+      prev = el;
+    });
+
+    if(!changed) return;
+    if(keepScroll) cw.scrollTop += cw.scrollHeight - prevHeight;
+    else if(editingRound === -1) cw.scrollTop = cw.scrollHeight;
+  }
+
+  function loadMoreChat(){
+    chatWindowSize += CHAT_WINDOW_STEP;
+    renderChat(true);
+  }
+
+  // 기록 검색
+  function escHtml(s){ return String(s).replace(/[&<>"']/g, c => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'}[c])); }
+  function runSearch(){
+    const q = document.getElementById('search-input').value.trim();
+    if(q) socket.emit('search_history', {query: q});
+  }
+  socket.on('search_results', d => {
+    const box = document.getElementById('search-results');
+    if(!(d.results || []).length){ box.innerHTML = `<div style="color:#888;padding:6px 0;">"${escHtml(d.query)}" 결과 없음</div>`; return; }
+    box.innerHTML = d.results.map(r => {
+      const label = r.type === 'round' ? `라운드 ${r.id}` : `키워드 · ${escHtml(r.title)}`;
+      const click = r.type === 'round' ? `onclick="jumpToRound(${r.id})"` : '';
+      return `<div ${click} style="padding:6px 0;border-bottom:1px solid rgba(0,0,0,0.08);cursor:${r.type === 'round' ? 'pointer' : 'default'};"><b>${label}</b><br>${escHtml(r.snippet)}</div>`;
+    }).join('') + `<div style="color:#aaa;padding-top:4px;">${d.results.length}건 · ${d.took_ms}ms</div>`;
+  });
+  function jumpToRound(rid){
+    const el = chatNodes.get('r-' + rid + '-ai') || chatNodes.get('r-' + rid + '-0');
+    if(el){ el.scrollIntoView({behavior: 'smooth', block: 'center'}); el.style.outline = '2px solid var(--accent)'; setTimeout(() => el.style.outline = '', 1500); }
+    else alert(`라운드 ${rid}는 화면에 없습니다. '이전 라운드 더 보기'로 불러온 뒤 다시 눌러주세요.`);
+  }
+
+  // 메모리에 없는 옛 라운드는 서버 보관함에서 한 페이지씩
+  function loadArchivedChat(){
+    if(archiveLoading) return;
+    const first = archivedRounds.length ? archivedRounds[0] : (gState.rounds || [])[0];
+    if(!first) return;
+    archiveLoading = true;
+    socket.emit('get_history_page', {before_id: first.id, limit: CHAT_WINDOW_STEP});
+  }
+  socket.on('edit_history_res', d => { if(!d.ok) alert(d.msg); });
+  socket.on('history_page_res', d => {
+    archiveLoading = false;
+    const first = archivedRounds.length ? archivedRounds[0] : (gState.rounds || [])[0];
+    if(!first || first.id !== d.before_id) return; // 그 사이 기록이 바뀜
+    const page = d.rounds || [];
+    if(!page.length){ archiveTotal = archivedRounds.length; renderChat(true); return; }
+    archivedRounds = page.concat(archivedRounds);
+    chatWindowSize += page.length;
+    renderChat(true);
+  });
+
+  // 맨 아래로 돌아오면 창 크기를 다시 줄여 DOM 노드 수를 유지
+  document.getElementById('chat-window').addEventListener('scroll', e => {
+    const cw = e.currentTarget;
+    if(chatWindowSize > CHAT_WINDOW_DEFAULT && cw.scrollHeight - cw.scrollTop - cw.clientHeight < 40){
+      chatWindowSize = CHAT_WINDOW_DEFAULT;
+      archivedRounds = [];
+      renderChat();
+    }
+  });
+
+  function renderTypingIndicator(uids){
+    const el = document.getElementById('typing-indicator');
+    if(!el || !gState) return;
+    const names = uids.filter(u => u !== myRole).map(u => gState.profiles[u]?.name || u);
+    const txt = names.length ? `✍️ ${names.join(", ")} 입력 중...` : "";
+    if(el.textContent !== txt) el.textContent = txt;
+  }
+
   function updateAdminBtnVisibility() {
     if (!gState) return;
     const pcSelect = document.getElementById('m-player-count');
@@ -1942,14 +4709,16 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
     }
   }
 
+  let adminPw = "";  // 프로파일링 HTTP 엔드포인트용 (헤더로 보냄)
   function requestAdmin(){
     const pw = prompt("관리자 비밀번호를 입력하세요:");
-    if(pw) socket.emit('check_admin', {password: pw});
+    if(pw) { adminPw = pw; socket.emit('check_admin', {password: pw}); }
   }
   function saveAllSettings(isClosing = false) {
     const data = {
         sys: document.getElementById('m-sys').value, sum: document.getElementById('m-sum').value,
-        model: document.getElementById('m-ai-model').value, player_count: document.getElementById('m-player-count').value,
+        model: document.getElementById('m-ai-model').value, allow_provider_switch: document.getElementById('m-provider-switch').checked,
+        player_count: document.getElementById('m-player-count').value,
         output_limit: document.getElementById('m-output-limit').value, title: document.getElementById('m-title').value,
         pro: document.getElementById('m-pro').value
     };
@@ -1971,29 +4740,29 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
   function unlockProfile(target){
     if(confirm(target + "의 잠금을 해제하시겠습니까?")) socket.emit('unlock_profile', {target: target});
   }
-  function startEdit(idx){ editingIdx = idx; refreshUI(); }
-  function cancelEdit(){ editingIdx = -1; refreshUI(); }
-  function saveEdit(idx){
-    const txt = document.getElementById(`edit-area-${idx}`).value;
-    socket.emit('edit_history_msg', {index: idx, text: "**AI**: " + txt});
-    editingIdx = -1;
+  function startEdit(rid){ editingRound = rid; refreshUI(); }
+  function cancelEdit(){ editingRound = -1; refreshUI(); }
+  function saveEdit(rid){
+    const txt = document.getElementById(`edit-area-${rid}`).value;
+    socket.emit('edit_history_msg', {round_id: rid, text: txt});
+    editingRound = -1;
   }
   function send(){
     const t = document.getElementById('msg-input').value.trim();
     if(!t) return;
     document.getElementById('send-btn').disabled = true;
 
-    socket.emit('client_message', {uid: myRole, text: t});
+    socket.emit('client_message', {uid: myRole, text: t, round_id: gState ? gState.round_id : null});
 
     isRefusedMode = false; // 👈 [추가] 다시 보냈으니 거절 모드 해제!
 
     document.getElementById('msg-input').value='';
-    socket.emit('stop_typing', {uid: myRole});
+    stopTyping();
   }
   function skipTurn(){
     if(!confirm("스킵하시겠습니까?")) return;
-    socket.emit('skip_turn', {uid: myRole});
-    socket.emit('stop_typing', {uid: myRole});
+    socket.emit('skip_turn', {uid: myRole, round_id: gState ? gState.round_id : null});
+    stopTyping();
   }
   function saveProfile(){
     const name = document.getElementById('p-name').value;
@@ -2054,6 +4823,16 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
 
   // Helpers
   function mdToSafeHtml(mdText){ return DOMPurify.sanitize(marked.parse(mdText || "", {breaks: true}), {USE_PROFILES: {html: true}}); }
+  function mdCached(mdText){
+    const k = mdText || "";
+    let html = mdCache.get(k);
+    if(html === undefined){
+      html = mdToSafeHtml(k);
+      if(mdCache.size >= MD_CACHE_MAX) mdCache.delete(mdCache.keys().next().value);
+      mdCache.set(k, html);
+    }
+    return html;
+  }
   function replacePlaceholders(text) {
     if (!text || !gState) return text;
     return text.replace(/\{\{p1\}\}/g, gState.profiles.user1?.name || "Player 1")
@@ -2103,11 +4882,17 @@ HTML_TEMPLATE = r"""<!DOCTYPE html>
   const msgInputEl = document.getElementById('msg-input');
   msgInputEl.addEventListener('keydown', (e) => { if (e.key === 'Enter' && !e.shiftKey) { e.preventDefault(); send(); } });
   let typingTimer = null;
+  let typingSent = false; // 키 입력마다 보내지 않고 상태가 바뀔 때만 보냄
+  function stopTyping(){
+    clearTimeout(typingTimer);
+    if(typingSent) socket.emit('stop_typing', {uid: myRole});
+    typingSent = false;
+  }
   msgInputEl.addEventListener('input', ()=>{
     if(!myRole || myRole==='readonly') return;
-    socket.emit('start_typing', {uid: myRole});
+    if(!typingSent){ socket.emit('start_typing', {uid: myRole}); typingSent = true; }
     clearTimeout(typingTimer);
-    typingTimer = setTimeout(()=> socket.emit('stop_typing', {uid: myRole}), 1200);
+    typingTimer = setTimeout(stopTyping, 1200);
   });
   {% endraw %}
 </script>
@@ -2122,6 +4907,9 @@ if __name__ == "__main__":
     print("\n" + "="*50)
     print(f"🚀 [드림놀이] 서버 시작! (Port: {port})")
     print("="*50 + "\n")
+    # 옛 저장 파일이라 최근 기록이 너무 길면 시작하자마자 보관함으로 내림
+    socketio.start_background_task(maybe_archive)
+    socketio.start_background_task(ensure_search_index)
 
     # 서버 실행 (배포용 설정)
     socketio.run(app, host="0.0.0.0", port=port, allow_unsafe_werkzeug=True)
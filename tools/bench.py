@@ -0,0 +1,237 @@
+"""드림놀이 마이크로 벤치마크 (서버의 순수 함수 위주, 네트워크/LLM 없음)
+
+합성 세션(한국어 라운드 10~5000개, 로어 20~10000개)을 만들어 함수별 1회 시간과 1회 최대 할당량을 잼.
+대상: build_history_block, build_full_system_content, build_gemini_prompt, match_lore,
+      postprocess_ai_response, simple_decrypt, get_sanitized_state, save_data
+(대상 함수가 없는 옛 리비전에서는 그 항목만 건너뜀)
+
+예:
+  python tools/bench.py                          # 지금 작업 트리
+  python tools/bench.py --quick --json out.json
+  python tools/bench.py --compare HEAD~5         # HEAD~5의 app.py vs 지금 작업 트리
+  python tools/bench.py --compare v2.2.0 HEAD    # 두 리비전끼리
+"""
+import argparse
+import base64
+import contextlib
+import importlib
+import inspect
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+WORDS = ("숨결이", "떨리는", "눈동자가", "천천히", "차가운", "손끝에", "머문다", "먼지가", "빛 속에서", "흩어지고",
+         "그는", "그녀는", "잠시", "말없이", "시선을", "피했다", "낮은", "목소리로", "심장이", "조용히")
+ROUND_SIZES = (10, 100, 1000, 5000)
+LORE_SIZES = (20, 1000, 10000)
+QUICK_ROUND_SIZES = (10, 1000)
+QUICK_LORE_SIZES = (20, 1000)
+
+
+def korean(rng, n_chars):
+    out, size = [], 0
+    while size < n_chars:
+        w = rng.choice(WORDS) + ("." if rng.random() < 0.1 else "")
+        out.append(w)
+        size += len(w) + 1
+    return " ".join(out)[:n_chars]
+
+
+def load_app(app_dir):
+    """app_dir의 app.py를 임시 작업 폴더에서 import (./data가 저장소를 더럽히지 않게)"""
+    os.environ.pop("OPENAI_API_KEY", None)
+    os.environ.pop("GEMINI_API_KEY", None)
+    os.chdir(tempfile.mkdtemp(prefix="dream_bench_"))
+    sys.path.insert(0, app_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return importlib.import_module("app")
+
+
+def has_param(fn, name):
+    return name in inspect.signature(fn).parameters
+
+
+def set_state(app, **updates):
+    """리비전마다 state 다루는 방식이 달라서 (writer 있으면 mutate로)"""
+    if hasattr(app, "mutate"):
+        def apply():
+            app.state.update(updates)
+            if hasattr(app, "rebuild_round_index"): app.rebuild_round_index()
+        app.mutate(apply)
+    else:
+        app.state.update(updates)
+
+
+def make_session(app, rng, n_rounds, n_lore):
+    actions = lambda i: [("user1", "하나", korean(rng, 80)), ("user2", "둘", korean(rng, 80)), ("user3", "셋", korean(rng, 80))]
+    if hasattr(app, "RoundRecord"):
+        history = {"rounds": [app.RoundRecord(i + 1, actions(i), korean(rng, 1500), "gpt-4o", (3000, 800)) for i in range(n_rounds)]}
+    else:
+        history = {"ai_history": [line for i in range(n_rounds) for line in (
+            "**Round**: " + " / ".join(f"{n}: {t}" for _, n, t in actions(i)), "**AI**: " + korean(rng, 1500))]}
+    lore = [{"title": f"항목{i}", "triggers": f"{rng.choice(WORDS)},키워드{i}", "content": korean(rng, 200)} for i in range(n_lore)]
+    set_state(app, lorebook=lore, sys_prompt=korean(rng, 3000), prologue=korean(rng, 800), summary=korean(rng, 400), **history)
+
+
+def measure(fn, min_time=0.2, repeat=5):
+    """(1회 최소 초, 1회 중앙값 초, 1회 최대 할당 바이트)"""
+    fn()  # 캐시/지연 초기화 한 번
+    n, t = 1, 0.0
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(n): fn()
+        t = time.perf_counter() - t0
+        if t >= min_time / repeat or n >= 1_000_000: break
+        n *= 2
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(n): fn()
+        times.append((time.perf_counter() - t0) / n)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    times.sort()
+    return times[0], times[len(times) // 2], max(0, peak)
+
+
+def benchmarks(app, rng, round_sizes, lore_sizes):
+    """(이름, 크기 라벨, 준비 함수, 잴 함수) 목록. 준비 함수는 state를 맞춰 둠"""
+    out = []
+    snap = lambda: app.current_snapshot() if hasattr(app, "current_snapshot") else app.state
+    profile = "1. 하나 (Bio: 부하, Canon: 테스트)\n2. 둘 (Bio: 부하, Canon: 테스트)\n3. 셋 (Bio: 부하, Canon: 테스트)\n"
+    active = [f"[항목{i}]: {korean(rng, 200)}" for i in range(3)]
+
+    def history_block():
+        return app.build_history_block(snap()) if has_param(app.build_history_block, "snap") else app.build_history_block()
+
+    def full_system():
+        s = snap()
+        args = (profile, s.get("sys_prompt", ""), active, s.get("summary", ""))
+        return app.build_full_system_content(*args, s) if has_param(app.build_full_system_content, "snap") else app.build_full_system_content(*args)
+
+    def gemini_prompt():
+        args = ("system " * 500, "priority " * 100, [], snap().get("prologue", ""), "--- [PROTAGONIST ACTIONS] ---\n- 하나: 검을 든다\n", 2000)
+        return app.build_gemini_prompt(*args, snap()) if has_param(app.build_gemini_prompt, "snap") else app.build_gemini_prompt(*args)
+
+    for n in round_sizes:
+        setup = lambda n=n: make_session(app, random.Random(n), n, 20)
+        out.append(("build_history_block", f"rounds={n}", setup, history_block))
+        out.append(("build_gemini_prompt", f"rounds={n}", setup, gemini_prompt))
+        out.append(("get_sanitized_state", f"rounds={n}", setup, app.get_sanitized_state))
+        if hasattr(app, "last_saved_key"):
+            def save():
+                app.last_saved_key = None  # 변경 없으면 건너뛰는 최적화는 빼고 직렬화+쓰기만
+                app.save_data()
+        else:
+            save = app.save_data
+        out.append(("save_data", f"rounds={n}", setup, save))
+    out.append(("build_full_system_content", "lore=3", lambda: make_session(app, random.Random(1), 10, 20), full_system))
+
+    if hasattr(app, "match_lore"):
+        merged = korean(rng, 600).lower()
+        for n in lore_sizes:
+            out.append(("match_lore", f"lore={n}", lambda n=n: make_session(app, random.Random(n), 10, n),
+                        lambda: app.match_lore(snap().get("lorebook", []), merged)))
+    if hasattr(app, "postprocess_ai_response"):
+        text = (korean(rng, 1200) + " (smirk) 그가 nod 했다. 1. 선택지 어떻게 하시겠습니까? " + korean(rng, 1200))
+        out.append(("postprocess_ai_response", "2.4k chars", lambda: None, lambda: app.postprocess_ai_response(text, 2000)))
+
+    key = "benchkey"
+    scenario = json.dumps({"session_title": "벤치", "sys_prompt": korean(rng, 4000), "prologue": korean(rng, 1000),
+                           "lorebook": [{"title": f"t{i}", "triggers": "a,b", "content": korean(rng, 200)} for i in range(20)]}, ensure_ascii=False)
+    raw = scenario.encode("utf-8")
+    blob = base64.b64encode(bytes(b ^ key.encode()[i % len(key)] for i, b in enumerate(raw))).decode()
+    out.append(("simple_decrypt", f"{len(raw) // 1024}KiB", lambda: None, lambda: app.simple_decrypt(blob, key)))
+    return out
+
+
+def run_suite(args):
+    app = load_app(os.path.abspath(args.app_dir))
+    rng = random.Random(args.seed)
+    sizes = (QUICK_ROUND_SIZES, QUICK_LORE_SIZES) if args.quick else (ROUND_SIZES, LORE_SIZES)
+    results = []
+    for name, label, setup, fn in benchmarks(app, rng, *sizes):
+        if args.only and not any(o in name for o in args.only): continue
+        setup()
+        best, median, peak = measure(fn, args.min_time)
+        results.append({"name": name, "size": label, "best_s": best, "median_s": median, "peak_bytes": peak})
+        print(f"{name:28} {label:12} {fmt_time(median):>10}  (최소 {fmt_time(best):>9})  할당 {peak / 1024:9.1f}KiB", file=sys.stderr)
+    return results
+
+
+def fmt_time(s):
+    if s >= 1: return f"{s:.2f}s"
+    if s >= 1e-3: return f"{s * 1e3:.2f}ms"
+    return f"{s * 1e6:.1f}µs"
+
+
+def run_revision(rev, args):
+    """리비전의 app.py만 꺼내서 이 스크립트(지금 버전)로 잼. rev가 '.'이면 작업 트리"""
+    app_dir = ROOT
+    if rev != ".":
+        app_dir = tempfile.mkdtemp(prefix="dream_bench_rev_")
+        with open(os.path.join(app_dir, "app.py"), "wb") as f:
+            f.write(subprocess.check_output(["git", "show", f"{rev}:app.py"], cwd=ROOT))
+    out = os.path.join(tempfile.mkdtemp(), "result.json")
+    cmd = [sys.executable, os.path.abspath(__file__), "--app-dir", app_dir, "--json", out, "--seed", str(args.seed), "--min-time", str(args.min_time)]
+    if args.quick: cmd.append("--quick")
+    for o in args.only or (): cmd += ["--only", o]
+    print(f"== {rev} ==", file=sys.stderr)
+    subprocess.check_call(cmd)
+    with open(out, encoding="utf-8") as f:
+        return json.load(f)["results"]
+
+
+def compare(args):
+    rev_a, rev_b = args.compare[0], (args.compare[1] if len(args.compare) > 1 else ".")
+    a = {(r["name"], r["size"]): r for r in run_revision(rev_a, args)}
+    b = {(r["name"], r["size"]): r for r in run_revision(rev_b, args)}
+    print(f"\n{'함수':28} {'크기':12} {rev_a:>12} {rev_b if rev_b != '.' else '작업 트리':>12}   비율   할당 비율")
+    regressions = 0
+    for key in list(a) + [k for k in b if k not in a]:
+        ra, rb = a.get(key), b.get(key)
+        if not ra or not rb:
+            print(f"{key[0]:28} {key[1]:12} {fmt_time(ra['median_s']) if ra else '-':>12} {fmt_time(rb['median_s']) if rb else '-':>12}")
+            continue
+        ratio = rb["median_s"] / ra["median_s"] if ra["median_s"] else float("inf")
+        mem = rb["peak_bytes"] / ra["peak_bytes"] if ra["peak_bytes"] else 1.0
+        flag = " ⚠️" if ratio > args.threshold else (" ✅" if ratio < 1 / args.threshold else "")
+        regressions += ratio > args.threshold
+        print(f"{key[0]:28} {key[1]:12} {fmt_time(ra['median_s']):>12} {fmt_time(rb['median_s']):>12}  {ratio:5.2f}x  {mem:5.2f}x{flag}")
+    return 1 if regressions else 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description="드림놀이 핫패스 마이크로 벤치마크")
+    ap.add_argument("--app-dir", default=ROOT, help="app.py가 있는 폴더")
+    ap.add_argument("--compare", nargs="+", metavar="REV", help="git 리비전 1~2개 비교 (하나면 작업 트리와)")
+    ap.add_argument("--quick", action="store_true", help="작은 크기만")
+    ap.add_argument("--only", action="append", help="이름에 이 문자열이 든 벤치만 (여러 번 지정)")
+    ap.add_argument("--min-time", type=float, default=0.2, help="항목당 최소 측정 시간(초)")
+    ap.add_argument("--threshold", type=float, default=1.10, help="--compare에서 이 배수 넘게 느려지면 회귀")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="결과를 JSON으로 저장")
+    args = ap.parse_args()
+
+    if args.compare:
+        sys.exit(compare(args))
+    results = run_suite(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, ensure_ascii=False, indent=2)
+    os._exit(0)  # app의 백그라운드 writer 스레드를 기다리지 않음
+
+
+if __name__ == "__main__":
+    main()
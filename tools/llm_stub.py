@@ -0,0 +1,126 @@
+"""OpenAI 호환 가짜 서버 (PROVIDERS_FILE의 base_url 공급자 설정을 키 없이 시험할 때)
+
+POST /v1/chat/completions (stream 포함), GET /v1/models 만 흉내냄. 응답은 모델+프롬프트로 정해지는 아무 말,
+response_format이 json_object면 테마용 색 JSON. 동시에 처리 중인 요청 수의 최대값을 /stats로 보여줌
+(app.py의 max_concurrency가 지켜지는지 확인용).
+
+예:
+  python tools/llm_stub.py --port 8081 --ttft 0.2 --tps 200
+  data/providers.json:
+    {"stub": {"base_url": "http://127.0.0.1:8081/v1", "max_concurrency": 2,
+              "models": {"stub-small": {"model": "stub-7b", "tier": "local", "tasks": ["summary", "theme"]}}}}
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("숨결이", "떨리는", "눈동자가", "천천히", "차가운", "손끝에", "머문다", "먼지가", "빛 속에서", "흩어지고",
+         "그는", "그녀는", "잠시", "말없이", "시선을", "피했다", "낮은", "목소리로", "심장이", "조용히")
+
+stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0, "models": {}}
+stats_lock = threading.Lock()
+
+
+def make_reply(model, messages, max_tokens, json_mode, tokens):
+    prompt = "\n".join(str(m.get("content", "")) for m in messages)
+    rng = random.Random(hashlib.sha256(f"{model}|{prompt}".encode("utf-8")).hexdigest())
+    if json_mode:
+        pieces = [json.dumps({k: "#%06x" % rng.randrange(0x1000000) for k in ("bg", "panel", "accent")})]
+    else:
+        pieces = [rng.choice(WORDS) + " " for _ in range(min(tokens, max_tokens or tokens))]
+    return pieces, max(1, len(prompt) // 2)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose: super().log_message(fmt, *args)
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": m, "object": "model"} for m in sorted(stats["models"])]})
+        elif self.path == "/stats":
+            with stats_lock: self.send_json(200, stats)
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self.send_json(404, {"error": {"message": "not found"}})
+        req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = req.get("model", "stub")
+        with stats_lock:
+            stats["requests"] += 1
+            stats["in_flight"] += 1
+            stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+            stats["models"][model] = stats["models"].get(model, 0) + 1
+        try:
+            json_mode = (req.get("response_format") or {}).get("type") == "json_object"
+            pieces, prompt_tokens = make_reply(model, req.get("messages", []), req.get("max_tokens") or req.get("max_completion_tokens"),
+                                               json_mode, self.server.tokens)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces), "total_tokens": prompt_tokens + len(pieces)}
+            time.sleep(self.server.ttft)
+            if req.get("stream"): self.stream(model, pieces, usage, (req.get("stream_options") or {}).get("include_usage"))
+            else:
+                if self.server.tps > 0: time.sleep(len(pieces) / self.server.tps)
+                self.send_json(200, {"id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+                                     "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)}, "finish_reason": "stop"}],
+                                     "usage": usage})
+        finally:
+            with stats_lock: stats["in_flight"] -= 1
+
+    def stream(self, model, pieces, usage, include_usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta, finish=None, u=None):
+            obj = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                   "choices": [] if u else [{"index": 0, "delta": delta, "finish_reason": finish}]}
+            if u: obj["usage"] = u
+            self.wfile.write(f"data: {json.dumps(obj, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        for i, piece in enumerate(pieces):
+            if i and self.server.tps > 0: time.sleep(1 / self.server.tps)
+            chunk({"content": piece})
+        chunk({}, "stop")
+        if include_usage: chunk(None, u=usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="OpenAI 호환 가짜 LLM 서버")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--ttft", type=float, default=0.2, help="첫 토큰까지 초")
+    ap.add_argument("--tps", type=float, default=200, help="초당 토큰 (0이면 바로)")
+    ap.add_argument("--tokens", type=int, default=200, help="응답 토큰 수 (max_tokens가 더 작으면 그쪽)")
+    ap.add_argument("--verbose", action="store_true")
+    args = ap.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.ttft, server.tps, server.tokens, server.verbose = args.ttft, args.tps, args.tokens, args.verbose
+    print(f"🧪 가짜 OpenAI 호환 서버: http://{args.host}:{args.port}/v1")
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+
+
+if __name__ == "__main__":
+    main()
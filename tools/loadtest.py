@@ -0,0 +1,312 @@
+"""드림놀이 부하 테스트 (실제 소켓 프로토콜 그대로, 가짜 LLM 상대로)
+
+서버 하나가 테이블(세션) 하나라서, 테이블 N개 = 서버 N개.
+--spawn N 이면 이 컴퓨터에서 app.py를 N개 띄우고 (FAKE_LLM=1, 포트 base-port부터, 각자 임시 data 폴더),
+--url 을 주면 이미 떠 있는 서버들에 붙음 (그 서버의 ai_model은 --model로 바꿈, 기본 fake-openai).
+
+테이블마다 플레이어 3명 + 관전자 M명이 join_game → update_profile → (관리자) start_session 후
+라운드마다 start_typing → client_message / skip_turn 을 보냄.
+
+재는 것:
+  - 라운드 지연: 마지막 입력을 보낸 순간 → 그 플레이어가 ai_typewriter_event를 받은 순간
+  - 팬아웃 지연: 같은 seq 이벤트를 테이블에서 처음 받은 클라이언트 대비 각 클라이언트가 늦게 받은 시간
+  - 클라이언트당 받은 바이트 (이벤트 페이로드 JSON 기준)
+  - 서버 CPU / RSS (/metrics의 process_* 값)
+
+예:
+  python tools/loadtest.py --spawn 4 --spectators 10 --rounds 20
+  python tools/loadtest.py --url http://localhost:5000 --url http://localhost:5001 --admin-password 1234
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+import socketio
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app.py")
+ACTIONS = ["검을 든다", "조용히 주위를 살핀다", "문을 두드린다", "그의 손을 잡는다", "창밖을 바라본다", "대답 대신 웃는다"]
+
+
+def percentile(values, q):
+    if not values: return None
+    vals = sorted(values)
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+
+def wait_until(pred, timeout, step=0.01):
+    end = time.time() + timeout
+    while time.time() < end:
+        if pred(): return True
+        time.sleep(step)
+    return False
+
+
+class SimClient:
+    """소켓 하나. 받은 이벤트를 전부 세고, seq 붙은 이벤트는 받은 시각을 남김"""
+
+    def __init__(self, url, name):
+        self.url, self.name = url, name
+        self.client_id = str(uuid.uuid4())
+        self.role = None
+        self.state = {}
+        self.bytes_in = 0
+        self.events = 0
+        self.seq_times = {}       # seq -> 받은 시각
+        self.typewriter_times = []
+        self.admin = False
+        self.lock = threading.Lock()
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on("*", self.on_any)
+
+    def on_any(self, event, *args):
+        now = time.time()
+        size = len(json.dumps(args, ensure_ascii=False, default=str).encode("utf-8"))
+        with self.lock:
+            self.bytes_in += size
+            self.events += 1
+            payload = args[0] if args and isinstance(args[0], dict) else {}
+            if "seq" in payload and event != "initial_state": self.seq_times[payload["seq"]] = now
+            if event == "assign_role": self.role = payload.get("role")
+            elif event == "initial_state": self.state = payload
+            elif event == "ai_typewriter_event": self.typewriter_times.append(now)
+            elif event == "admin_auth_res": self.admin = bool(payload.get("success"))
+
+    def connect(self):
+        self.sio.connect(self.url, wait_timeout=10)
+        self.sio.emit("join_game", {"client_id": self.client_id})
+
+    def emit(self, event, data=None):
+        self.sio.emit(event, data or {})
+
+    def close(self):
+        try: self.sio.disconnect()
+        except Exception: pass
+
+
+class Table:
+    def __init__(self, url, args, index):
+        self.url, self.args, self.index = url, args, index
+        self.rng = random.Random(args.seed + index)
+        self.players = [SimClient(url, f"t{index}-p{i + 1}") for i in range(args.players)]
+        self.spectators = [SimClient(url, f"t{index}-s{i + 1}") for i in range(args.spectators)]
+        self.round_latency = []
+        self.errors = []
+
+    @property
+    def clients(self):
+        return self.players + self.spectators
+
+    def setup(self):
+        admin = self.players[0]
+        for c in self.players:
+            c.connect()
+        if not wait_until(lambda: all(c.role for c in self.players), 10):
+            raise RuntimeError(f"테이블 {self.index}: 역할 배정 안 됨 (이미 다른 플레이어가 앉아 있나?)")
+        if [c.role for c in self.players] != [f"user{i + 1}" for i in range(len(self.players))]:
+            raise RuntimeError(f"테이블 {self.index}: 플레이어 자리가 비어 있지 않음 {[c.role for c in self.players]}")
+        admin.emit("check_admin", {"password": self.args.admin_password})
+        if not wait_until(lambda: admin.admin, 5):
+            raise RuntimeError(f"테이블 {self.index}: 관리자 비밀번호 틀림")
+        admin.emit("save_master_all", {"player_count": len(self.players), "model": self.args.model, "output_limit": self.args.output_limit})
+        for i, c in enumerate(self.players):
+            c.emit("update_profile", {"uid": c.role, "name": f"플레이어{i + 1}", "bio": "부하 테스트용 캐릭터", "canon": "테스트"})
+        wait_until(lambda: all(admin.state.get("profiles", {}).get(c.role, {}).get("locked") for c in self.players), 5)
+        admin.emit("start_session")
+        if not wait_until(lambda: admin.state.get("session_started"), 10):
+            raise RuntimeError(f"테이블 {self.index}: 세션 시작 안 됨")
+        for c in self.spectators:
+            c.connect()
+        wait_until(lambda: all(c.role for c in self.spectators), 10)
+
+    def play(self):
+        for r in range(self.args.rounds):
+            rid = self.players[0].state.get("round_id")
+            seen = [len(c.typewriter_times) for c in self.players]
+            order = self.players[:]
+            self.rng.shuffle(order)
+            last_sent = None
+            for c in order:
+                c.emit("start_typing", {"uid": c.role})
+                time.sleep(self.rng.uniform(0, self.args.think))
+                if self.rng.random() < self.args.skip_rate:
+                    c.emit("skip_turn", {"uid": c.role, "round_id": rid})
+                else:
+                    c.emit("client_message", {"uid": c.role, "text": f"{self.rng.choice(ACTIONS)} ({r})", "round_id": rid})
+                last_sent = (c, time.time())
+            c, sent_at = last_sent
+            i = self.players.index(c)
+            if not wait_until(lambda: len(c.typewriter_times) > seen[i], self.args.round_timeout):
+                self.errors.append(f"라운드 {rid}: {self.args.round_timeout}s 안에 응답 없음")
+                continue
+            self.round_latency.append(c.typewriter_times[seen[i]] - sent_at)
+            # 다음 라운드 번호가 담긴 스냅샷까지 기다림
+            wait_until(lambda: self.players[0].state.get("round_id") != rid, 5)
+
+    def fanout(self):
+        """seq 이벤트마다 (각 클라이언트 수신 시각 - 테이블에서 가장 먼저 받은 시각)"""
+        by_seq = {}
+        for c in self.clients:
+            with c.lock:
+                for seq, t in c.seq_times.items(): by_seq.setdefault(seq, []).append(t)
+        out = []
+        for times in by_seq.values():
+            first = min(times)
+            out.extend(t - first for t in times)
+        return out
+
+
+class MetricsPoller(threading.Thread):
+    """서버 /metrics에서 process_cpu_seconds_total / process_resident_memory_bytes를 1초마다 읽음"""
+
+    def __init__(self, url):
+        super().__init__(daemon=True)
+        self.url = url.rstrip("/") + "/metrics"
+        self.samples = []  # (시각, cpu 초, rss)
+        self.stop = threading.Event()
+
+    def read(self):
+        try:
+            text = requests.get(self.url, timeout=2).text
+        except Exception:
+            return
+        vals = {}
+        for line in text.splitlines():
+            if line.startswith(("process_cpu_seconds_total ", "process_resident_memory_bytes ")):
+                k, v = line.split()
+                vals[k] = float(v)
+        self.samples.append((time.time(), vals.get("process_cpu_seconds_total"), vals.get("process_resident_memory_bytes")))
+
+    def run(self):
+        while not self.stop.is_set():
+            self.read()
+            self.stop.wait(1.0)
+
+    def summary(self):
+        cpu = [(t, c) for t, c, _ in self.samples if c is not None]
+        rss = [r for _, _, r in self.samples if r]
+        cpu_pct = (cpu[-1][1] - cpu[0][1]) / (cpu[-1][0] - cpu[0][0]) * 100 if len(cpu) >= 2 and cpu[-1][0] > cpu[0][0] else None
+        return {"cpu_percent": cpu_pct, "rss_max": max(rss) if rss else None, "rss_last": rss[-1] if rss else None}
+
+
+def spawn_servers(args):
+    procs, urls = [], []
+    for i in range(args.spawn):
+        port = args.base_port + i
+        workdir = tempfile.mkdtemp(prefix=f"dream_load_{port}_")
+        env = dict(os.environ, PORT=str(port), ADMIN_PASSWORD=args.admin_password, FAKE_LLM="1",
+                   FAKE_LLM_TTFT=str(args.ttft), FAKE_LLM_TPS=str(args.tps), FAKE_LLM_TOKENS=str(args.tokens))
+        log = open(os.path.join(workdir, "server.log"), "w")
+        procs.append(subprocess.Popen([sys.executable, os.path.abspath(APP_PATH)], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT))
+        urls.append(f"http://127.0.0.1:{port}")
+        print(f"🚀 서버 {i + 1}: {urls[-1]} (로그 {workdir}/server.log)")
+    for url, proc in zip(urls, procs):
+        def up():
+            try: return requests.get(url + "/metrics", timeout=1).ok
+            except Exception: return proc.poll() is not None
+        if not wait_until(up, 60, 0.2) or proc.poll() is not None:
+            raise RuntimeError(f"{url} 서버가 안 뜸")
+    return procs, urls
+
+
+def fmt_s(v):
+    return "-" if v is None else f"{v:.2f}s"
+
+
+def fmt_ms(v):
+    return "-" if v is None else f"{v * 1000:.1f}ms"
+
+
+def fmt_bytes(v):
+    if v is None: return "-"
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if v < 1024 or unit == "GiB": return f"{v:.1f}{unit}"
+        v /= 1024
+
+
+def main():
+    ap = argparse.ArgumentParser(description="드림놀이 멀티 클라이언트 부하 테스트")
+    ap.add_argument("--url", action="append", default=[], help="이미 떠 있는 서버 (테이블 하나당 하나, 여러 번 지정)")
+    ap.add_argument("--spawn", type=int, default=0, help="app.py를 이만큼 띄워서 테스트 (FAKE_LLM=1)")
+    ap.add_argument("--base-port", type=int, default=5100)
+    ap.add_argument("--players", type=int, default=3, choices=(1, 2, 3))
+    ap.add_argument("--spectators", type=int, default=2, help="테이블당 관전자 수")
+    ap.add_argument("--rounds", type=int, default=10, help="테이블당 라운드 수")
+    ap.add_argument("--think", type=float, default=0.5, help="플레이어 입력 사이 최대 대기(초)")
+    ap.add_argument("--skip-rate", type=float, default=0.1)
+    ap.add_argument("--round-timeout", type=float, default=120)
+    ap.add_argument("--admin-password", default=os.getenv("ADMIN_PASSWORD", "1234"))
+    ap.add_argument("--model", default="fake-openai", help="테이블에 설정할 ai_model")
+    ap.add_argument("--output-limit", type=int, default=2000)
+    ap.add_argument("--ttft", type=float, default=0.5, help="--spawn 서버의 가짜 LLM 첫 토큰 지연")
+    ap.add_argument("--tps", type=float, default=80, help="--spawn 서버의 가짜 LLM 초당 토큰")
+    ap.add_argument("--tokens", type=int, default=600, help="--spawn 서버의 가짜 LLM 응답 토큰 수")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="원자료를 JSON으로 저장할 경로")
+    args = ap.parse_args()
+
+    procs, urls = [], list(args.url)
+    if args.spawn:
+        procs, spawned = spawn_servers(args)
+        urls += spawned
+    if not urls: ap.error("--url 또는 --spawn 필요")
+
+    tables = [Table(url, args, i) for i, url in enumerate(urls)]
+    pollers = {url: MetricsPoller(url) for url in urls}
+    try:
+        for t in tables: t.setup()
+        print(f"✅ 테이블 {len(tables)}개 준비 (플레이어 {args.players}명 + 관전자 {args.spectators}명씩)")
+        for p in pollers.values(): p.start()
+        started = time.time()
+        threads = [threading.Thread(target=t.play) for t in tables]
+        for th in threads: th.start()
+        for th in threads: th.join()
+        elapsed = time.time() - started
+        for p in pollers.values():
+            p.stop.set()
+            p.read()
+    finally:
+        for t in tables:
+            for c in t.clients: c.close()
+        for proc in procs:
+            proc.terminate()
+            try: proc.wait(10)
+            except subprocess.TimeoutExpired: proc.kill()
+
+    lat = [x for t in tables for x in t.round_latency]
+    fan = [x for t in tables for x in t.fanout()]
+    player_bytes = [c.bytes_in for t in tables for c in t.players]
+    spec_bytes = [c.bytes_in for t in tables for c in t.spectators]
+    errors = [e for t in tables for e in t.errors]
+    servers = {url: p.summary() for url, p in pollers.items()}
+
+    print(f"\n== 결과: 테이블 {len(tables)}개, 라운드 {len(lat)}개 완료, {elapsed:.1f}초 ==")
+    print(f"라운드 지연 (마지막 입력 → 타자기 이벤트)  p50 {fmt_s(percentile(lat, .5))}  p95 {fmt_s(percentile(lat, .95))}"
+          f"  p99 {fmt_s(percentile(lat, .99))}  max {fmt_s(max(lat) if lat else None)}")
+    print(f"이벤트 팬아웃 (테이블 첫 수신 대비)          p50 {fmt_ms(percentile(fan, .5))}  p95 {fmt_ms(percentile(fan, .95))}"
+          f"  p99 {fmt_ms(percentile(fan, .99))}  max {fmt_ms(max(fan) if fan else None)}")
+    avg = lambda v: sum(v) / len(v) if v else None
+    print(f"받은 바이트 (클라이언트당 평균)  플레이어 {fmt_bytes(avg(player_bytes))}  관전자 {fmt_bytes(avg(spec_bytes))}"
+          f"  전체 {fmt_bytes(sum(player_bytes) + sum(spec_bytes))}")
+    for url, st in servers.items():
+        cpu = "-" if st["cpu_percent"] is None else f"{st['cpu_percent']:.1f}%"
+        print(f"서버 {url}  CPU {cpu}  RSS {fmt_bytes(st['rss_last'])} (최대 {fmt_bytes(st['rss_max'])})")
+    if errors:
+        print(f"⚠️ 오류 {len(errors)}개: " + "; ".join(errors[:5]))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "elapsed": elapsed, "round_latency": lat, "fanout": fan,
+                       "player_bytes": player_bytes, "spectator_bytes": spec_bytes, "servers": servers, "errors": errors}, f, ensure_ascii=False, indent=2)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""드림놀이 세션 재생 (관리자 모니터 탭에서 녹화한 data/recordings/session_*.jsonl 을 새 서버에 다시 틀기)
+
+녹화 파일 첫 줄의 state로 임시 data 폴더를 만들고 app.py를 REPLAY_FILE 모드로 띄움
+→ 모델은 안 부르고 녹화된 응답을 녹화된 지연만큼 (--llm-speed배) 기다렸다 돌려줌.
+녹화된 클라이언트(c1, c2...)마다 소켓을 하나씩 열어 들어온 이벤트를 그대로 보냄.
+  --speed 1   녹화 때 간격 그대로
+  --speed 10  10배 빠르게
+  --speed 0   간격 없이 (앞 이벤트 응답을 받자마자 다음)
+어느 속도든 라운드 순서는 지킴: 녹화 때 k번째 집필 뒤에 온 이벤트는 재생 서버가 k번째 집필을 끝낸 뒤에 보냄.
+
+비밀번호 칸은 녹화 때 지워지므로 --admin-password로 채움. 보관 묶음(archive) 파일은 녹화에 없어서 목록도 비우고 시작.
+
+재는 것: 이벤트별 ack 지연 (보냄 → 서버 핸들러 끝), 라운드 지연 (녹화 때 마지막 입력 → 타자기 이벤트), 전체 시간, 서버 CPU / RSS
+
+예:
+  python tools/replay.py data/recordings/session_20260101_120000.jsonl --speed 0 --llm-speed 0
+  python tools/replay.py session.jsonl --speed 1 --json replay.json
+"""
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import socketio
+
+from loadtest import APP_PATH, MetricsPoller, fmt_bytes, fmt_ms, fmt_s, percentile, wait_until
+
+REDACTED = "<redacted>"
+SECRET_FIELDS = ("password", "auth_key")
+
+
+def load_recording(path):
+    header, events, narrations = None, [], 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            kind = entry.get("kind")
+            if kind == "header": header = entry
+            elif kind == "llm" and entry.get("task") == "narration": narrations += 1
+            elif kind in ("event", "disconnect"):
+                entry["after_rounds"] = narrations  # 이 이벤트 전에 끝난 집필 수
+                events.append(entry)
+    if header is None: raise SystemExit(f"{path}: 녹화 헤더가 없음")
+    return header, events, narrations
+
+
+class ReplayClient:
+    """녹화된 클라이언트 하나 = 소켓 하나. 처음 이벤트를 보낼 때 연결"""
+
+    def __init__(self, url, name, ack_timeout):
+        self.url, self.name, self.ack_timeout = url, name, ack_timeout
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on("*", self.on_any)
+        self.typewriter_times = []
+        self.latency = {}  # 이벤트 이름 -> [ack 지연]
+        self.errors = []
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.worker = None
+
+    def on_any(self, event, *args):
+        if event == "ai_typewriter_event":
+            with self.lock: self.typewriter_times.append(time.time())
+
+    def send(self, event, data):
+        try:
+            if not self.sio.connected: self.sio.connect(self.url, transports=["websocket"], wait_timeout=10)
+            t0 = time.perf_counter()
+            self.sio.call(event, data, timeout=self.ack_timeout)
+            with self.lock: self.latency.setdefault(event, []).append(time.perf_counter() - t0)
+        except Exception as e:
+            self.errors.append(f"{self.name} {event}: {e}")
+
+    def close(self):
+        try: self.sio.disconnect()
+        except Exception: pass
+
+    def hang_up(self):
+        # 녹화된 disconnect: 소켓 닫기는 몇 초씩 걸려서 기다리지 않음
+        threading.Thread(target=self.close, daemon=True).start()
+
+    # 속도 > 0: 클라이언트마다 스레드 하나가 자기 이벤트를 순서대로 보냄 (다른 클라이언트와는 동시에)
+    def submit(self, event, data):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+        self.jobs.put((event, data))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None: return
+            if job[0] == "disconnect": self.hang_up()
+            else: self.send(*job)
+            self.jobs.task_done()
+
+    def drain(self):
+        if self.worker is None: return
+        self.jobs.join()
+        self.jobs.put(None)
+        self.worker.join()
+
+
+def fill_secrets(data, password):
+    if not isinstance(data, dict): return data
+    return {k: (password if k in SECRET_FIELDS and v == REDACTED else v) for k, v in data.items()}
+
+
+def spawn_server(header, path, args):
+    workdir = tempfile.mkdtemp(prefix=f"dream_replay_{args.port}_")
+    snap = dict(header["snapshot"], admin_password=args.admin_password, archive=[])
+    os.makedirs(os.path.join(workdir, "data"))
+    with open(os.path.join(workdir, "data", "save_data.json"), "w", encoding="utf-8") as f:
+        json.dump(snap, f, ensure_ascii=False)
+    env = dict(os.environ, PORT=str(args.port), ADMIN_PASSWORD=args.admin_password,
+               REPLAY_FILE=os.path.abspath(path), REPLAY_LLM_SPEED=str(args.llm_speed))
+    log = open(os.path.join(workdir, "server.log"), "w")
+    proc = subprocess.Popen([sys.executable, os.path.abspath(APP_PATH)], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{args.port}"
+    print(f"🚀 재생 서버: {url} (로그 {workdir}/server.log)")
+
+    def up():
+        try: return requests.get(url + "/metrics", timeout=1).ok
+        except Exception: return proc.poll() is not None
+    if not wait_until(up, 60, 0.2) or proc.poll() is not None:
+        proc.kill()
+        raise RuntimeError(f"{url} 서버가 안 뜸")
+    return proc, url
+
+
+def main():
+    ap = argparse.ArgumentParser(description="드림놀이 녹화 세션 재생")
+    ap.add_argument("recording", help="녹화 파일 (data/recordings/session_*.jsonl)")
+    ap.add_argument("--speed", type=float, default=1.0, help="이벤트 간격 배속 (1 = 녹화 그대로, 0 = 간격 없이)")
+    ap.add_argument("--llm-speed", type=float, default=1.0, help="녹화된 모델 지연에 곱할 값 (0 = 바로)")
+    ap.add_argument("--url", help="이미 REPLAY_FILE로 떠 있는 서버 (없으면 새로 띄움)")
+    ap.add_argument("--port", type=int, default=5200)
+    ap.add_argument("--admin-password", default=os.getenv("ADMIN_PASSWORD", "1234"))
+    ap.add_argument("--ack-timeout", type=float, default=60)
+    ap.add_argument("--round-timeout", type=float, default=120, help="k번째 집필이 끝나길 기다리는 최대 시간")
+    ap.add_argument("--json", help="원자료를 JSON으로 저장할 경로")
+    args = ap.parse_args()
+
+    header, events, narrations = load_recording(args.recording)
+    clients_seen = len({e["client"] for e in events})
+    print(f"📼 {args.recording}: 이벤트 {len(events)}개, 클라이언트 {clients_seen}개, 집필 {narrations}번 (녹화 {header['started']})")
+
+    proc, url = (None, args.url) if args.url else spawn_server(header, args.recording, args)
+    clients = {}
+    poller = MetricsPoller(url)
+    errors = []
+    round_latency = []
+    last_input = {}  # 집필 번호 -> 그 집필을 부른 마지막 입력을 보낸 시각
+
+    def rounds_done():
+        return max((len(c.typewriter_times) for c in clients.values()), default=0)
+
+    try:
+        poller.start()
+        started = time.time()
+        for entry in events:
+            if args.speed > 0:
+                delay = started + entry["t"] / args.speed - time.time()
+                if delay > 0: time.sleep(delay)
+            if rounds_done() < entry["after_rounds"] and not wait_until(lambda: rounds_done() >= entry["after_rounds"], args.round_timeout):
+                errors.append(f"{entry['after_rounds']}번째 집필이 {args.round_timeout:.0f}초 안에 안 끝남")
+                break
+            client = clients.get(entry["client"])
+            if client is None: client = clients[entry["client"]] = ReplayClient(url, entry["client"], args.ack_timeout)
+            event = entry.get("event", "disconnect")
+            if event in ("client_message", "skip_turn"): last_input[entry["after_rounds"] + 1] = time.time()
+            data = fill_secrets(entry.get("data"), args.admin_password)
+            if args.speed > 0: client.submit(event, data)
+            elif event == "disconnect": client.hang_up()
+            else: client.send(event, data)
+        for c in clients.values(): c.drain()
+        wait_until(lambda: rounds_done() >= narrations, args.round_timeout)
+        elapsed = time.time() - started
+        poller.stop.set()
+        poller.read()
+    finally:
+        for c in clients.values(): c.close()
+        if proc is not None:
+            proc.terminate()
+            try: proc.wait(10)
+            except subprocess.TimeoutExpired: proc.kill()
+
+    # 라운드 지연은 타자기 이벤트를 제일 많이 받은 클라이언트 기준
+    watcher = max(clients.values(), key=lambda c: len(c.typewriter_times), default=None)
+    if watcher:
+        for k, t in enumerate(watcher.typewriter_times, 1):
+            if k in last_input: round_latency.append(t - last_input[k])
+    latency = {}
+    for c in clients.values():
+        errors.extend(c.errors)
+        for ev, vals in c.latency.items(): latency.setdefault(ev, []).extend(vals)
+    server = poller.summary()
+
+    print(f"\n== 결과: 이벤트 {sum(map(len, latency.values()))}개, 집필 {rounds_done()}/{narrations}번, {elapsed:.1f}초 (배속 {args.speed:g}, 모델 {args.llm_speed:g}) ==")
+    for ev, vals in sorted(latency.items(), key=lambda kv: -len(kv[1])):
+        print(f"{ev:<22} {len(vals):>5}개  p50 {fmt_ms(percentile(vals, .5))}  p95 {fmt_ms(percentile(vals, .95))}"
+              f"  p99 {fmt_ms(percentile(vals, .99))}  max {fmt_ms(max(vals))}")
+    print(f"라운드 지연 (마지막 입력 → 타자기 이벤트)  p50 {fmt_s(percentile(round_latency, .5))}  p95 {fmt_s(percentile(round_latency, .95))}"
+          f"  max {fmt_s(max(round_latency) if round_latency else None)}")
+    cpu = "-" if server["cpu_percent"] is None else f"{server['cpu_percent']:.1f}%"
+    print(f"서버 {url}  CPU {cpu}  RSS {fmt_bytes(server['rss_last'])} (최대 {fmt_bytes(server['rss_max'])})")
+    if errors:
+        print(f"⚠️ 오류 {len(errors)}개: " + "; ".join(errors[:5]))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "elapsed": elapsed, "event_latency": latency, "round_latency": round_latency,
+                       "rounds": rounds_done(), "expected_rounds": narrations, "server": server, "errors": errors}, f, ensure_ascii=False, indent=2)
+    return 1 if errors or rounds_done() < narrations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())